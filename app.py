@@ -1,16 +1,32 @@
 import os
+import sys
 import json
+import io
 import time
+import random
+import math
+import types
+import asyncio
 import requests
 import re
 from pathlib import Path
 import concurrent.futures
-from typing import Dict, Optional, Tuple
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple, Union
 import uuid
+import atexit
+import socket
+from datetime import datetime, timedelta, timezone
+import hashlib
 import tempfile
 import shutil
 import traceback
 import logging
+import threading
+import queue
+import collections
+import contextvars
+import subprocess
+import multiprocessing
 
 # Flask and Web Server related imports
 from flask import Flask, request, jsonify, send_from_directory, redirect, url_for, render_template, flash
@@ -21,7 +37,9 @@ from werkzeug.security import generate_password_hash, check_password_hash
 import google.generativeai as genai
 from PIL import Image
 from PyPDF2 import PdfReader, PdfWriter, errors as PyPDF2Errors
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NullObject, StreamObject
 import pytesseract
+import numpy as np
 from pdf2image import convert_from_path, exceptions as PDF2ImageExceptions
 import pdfkit
 import boto3
@@ -30,6 +48,8 @@ from botocore.exceptions import NoCredentialsError, PartialCredentialsError, Cli
 # Flask-Login imports
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect as sqlalchemy_inspect, text as sqlalchemy_text
+from sqlalchemy.exc import IntegrityError
 
 # --- Environment Variable Loading ---
 from dotenv import load_dotenv
@@ -42,7 +62,7 @@ logger = logging.getLogger(__name__)
 # --- Flask App Initialization ---
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'change_this_secret')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///users.db')
 db = SQLAlchemy(app)
 
 login_manager = LoginManager()
@@ -55,13 +75,46 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(150), unique=True, nullable=False)
     password = db.Column(db.String(150), nullable=False)
 
+class Job(db.Model):
+    """A PDF processing job submitted through /api/jobs and run by a background worker."""
+    __tablename__ = 'jobs'
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    input_path = db.Column(db.String(500), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True) # queued, running, succeeded, failed
+    worker = db.Column(db.String(150))
+    attempts = db.Column(db.Integer, nullable=False, default=0) # Times a worker has claimed the job
+    heartbeat_at = db.Column(db.DateTime) # Refreshed by the worker running the job; a stale one means the worker is gone
+    pages_total = db.Column(db.Integer)
+    pages_done = db.Column(db.Integer, nullable=False, default=0)
+    progress = db.Column(db.Text) # JSON {page_num: {path, success, error, duration_sec}} for finished pages
+    summary = db.Column(db.Text) # JSON report["summary"] once the pipeline is done
+    result_location = db.Column(db.String(500))
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+class LLMUsage(db.Model):
+    """A user's LLM usage totals for one pipeline stage, added to by every job that user runs."""
+    __tablename__ = 'llm_usage'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    stage = db.Column(db.String(50), primary_key=True)
+    calls = db.Column(db.Integer, nullable=False, default=0)
+    unreported_calls = db.Column(db.Integer, nullable=False, default=0) # Calls whose response had no usage_metadata
+    prompt_token_count = db.Column(db.Integer, nullable=False, default=0)
+    candidates_token_count = db.Column(db.Integer, nullable=False, default=0)
+    total_token_count = db.Column(db.Integer, nullable=False, default=0)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
 # --- Configuration ---
-# Required
+# Required (unless LLM_BACKEND=local)
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'gemini').lower() # "gemini", or "local" for offline load testing
 # S3 (Optional - only if using S3 output)
 S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
 AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
@@ -101,7 +154,9 @@ def validate_file(file):
     return True, ""
 
 # --- Gemini Configuration ---
-if not GEMINI_API_KEY:
+if LLM_BACKEND == 'local':
+    app.logger.warning("LLM_BACKEND=local: Gemini is not configured, LLM calls return canned responses.")
+elif not GEMINI_API_KEY:
     app.logger.error("FATAL: GEMINI_API_KEY environment variable not set.")
 else:
     try:
@@ -149,6 +204,24 @@ Based on your analysis of the text for elements indicative of rows, columns, and
 Ensure your output is *only* the JSON object and nothing else. Calculate the confidence score based on the clarity and regularity of the detected row and column structure within the text.
 """
 
+TABLE_DETECTION_BATCH_PROMPT_TEMPLATE = """
+### INSTRUCTION ###
+You are an expert document layout analysis system. Below is the text extracted from several PDF page images, each introduced by a "### PAGE n ###" header. For every page, independently determine if it contains a table.
+A table is specifically defined as a structured arrangement of data organized into distinct rows and columns.
+Base each decision only on that page's text, looking for elements indicative of rows, columns, and structured data organization.
+### INPUT ###
+{pdf_pages_text}
+### OUTPUT FORMAT ###
+[
+  {{
+    "page": int,
+    "tableDetected": true | false,
+    "confidenceScore": float (0.0 - 1.0)
+  }}
+]
+Return exactly one object per input page, using the page numbers from the headers. Ensure your output is *only* the JSON array and nothing else. Calculate each confidence score based on the clarity and regularity of the detected row and column structure within that page's text.
+"""
+
 HTML_FROM_IMAGE_PROMPT_TEMPLATE="""
 You are an expert HTML/CSS coder specializing in pixel-perfect visual replication of webpage designs from screenshots. Your primary goal is to transform a given screenshot of a webpage into a single, self-contained HTML file that accurately reproduces its visual appearance and structure in meticulous detail.
 Your task is to replicate a webpage screenshot as a **single HTML file** using **embedded CSS** within a `<style>` tag. The result should match the screenshot as closely as possible in layout, typography, spacing, and color. Do not use JavaScript or external libraries.
@@ -461,6 +534,25 @@ IMPORTANT REMINDER:
 Please output only the final HTML file with embedded styles, no additional commentary.
 """
 
+# Combined mode: one multimodal call answers the detection question and, for table pages, returns the HTML
+DETECT_AND_RENDER_PROMPT_TEMPLATE = """
+### INSTRUCTION ###
+You are an expert document layout analysis system and HTML/CSS coder. First examine the provided page image ({image_reference}) and its OCR text, and determine if the page contains a table.
+A table is specifically defined as a structured arrangement of data organized into distinct rows and columns.
+- If the page contains NO table, do not generate any HTML: return "tableDetected": false and an empty "html" string.
+- If the page contains a table, replicate the whole page as HTML following the instructions below, and return it in "html".
+### PAGE REPLICATION INSTRUCTIONS ###
+""" + HTML_FROM_IMAGE_PROMPT_TEMPLATE + """
+### OUTPUT FORMAT ###
+These output rules override any output instruction above. Respond with *only* this JSON object:
+{{
+  "tableDetected": true | false,
+  "confidenceScore": float (0.0 - 1.0),
+  "html": "the complete HTML file as a JSON string, or an empty string when tableDetected is false"
+}}
+Calculate the confidence score based on the clarity and regularity of the detected row and column structure.
+"""
+
 # --- Logging Functions ---
 def log_component(name: str, data: dict):
     log_entry = {"component": name, **data, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ")}
@@ -478,8 +570,94 @@ def log_error(component: str, error: Exception, context: Optional[Dict] = None):
     app.logger.debug(traceback.format_exc())
 
 
+# --- Disk Cache ---
+class DiskCache:
+    """Content-addressed JSON store on local disk with size-based LRU eviction, shared by all jobs and workers."""
+
+    def __init__(self, directory: Path, max_bytes: int, name: str, ttl_seconds: Optional[float] = None):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "writes": 0, "evictions": 0}
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.total_bytes = sum(path.stat().st_size for path in self.directory.glob("*/*.json"))
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path) # Recency for LRU eviction
+        except (OSError, ValueError):
+            with self.lock: self.stats["misses"] += 1
+            return None
+        if self.ttl_seconds is not None and time.time() - entry["created"] > self.ttl_seconds:
+            try: path.unlink()
+            except OSError: pass
+            with self.lock: self.stats["misses"] += 1; self.stats["expired"] += 1
+            return None
+        with self.lock: self.stats["hits"] += 1
+        return entry["value"]
+
+    def put(self, key: str, value: Dict):
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": time.time(), "value": value}, f)
+            size = tmp_path.stat().st_size
+            os.replace(tmp_path, path) # Atomic, so concurrent readers never see a partial entry
+        except OSError as e:
+            log_error("Disk Cache Write Error", e, {"cache": self.name, "key": key})
+            return
+        with self.lock:
+            self.stats["writes"] += 1
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Rescans the directory, so the size estimate also corrects for writes from other processes
+        entries = []
+        for path in self.directory.glob("*/*.json"):
+            try: entries.append((path.stat().st_mtime, path.stat().st_size, path))
+            except OSError: continue
+        entries.sort()
+        self.total_bytes = sum(size for _, size, _ in entries)
+        target_bytes = int(self.max_bytes * 0.9)
+        for _, size, path in entries:
+            if self.total_bytes <= target_bytes: break
+            try: path.unlink()
+            except OSError: continue
+            self.total_bytes -= size
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {**self.stats, "size_bytes": self.total_bytes, "max_bytes": self.max_bytes}
+
+
 # --- Validation Function ---
-def validate_table_detection_response(response: Dict) -> bool:
+def validate_table_detection_response(response: Union[Dict, List], expected_pages: Optional[List[int]] = None) -> bool:
+    """Validates a single-page detection object, or the batched array form when `expected_pages` is given."""
+    if expected_pages is not None:
+        if not isinstance(response, list):
+            app.logger.warning(f"[Validation WARN] Batched response is not a list: {type(response)}")
+            return False
+        if not all(isinstance(item, dict) and isinstance(item.get("page"), int) and not isinstance(item.get("page"), bool) for item in response):
+            app.logger.warning("[Validation WARN] Batched response items must be objects with an integer 'page'.")
+            return False
+        returned_pages = [item["page"] for item in response]
+        if sorted(returned_pages) != sorted(expected_pages):
+            app.logger.warning(f"[Validation WARN] Batched response pages {returned_pages} do not match requested pages {expected_pages}.")
+            return False
+        return all(validate_table_detection_response(item) for item in response)
     if not isinstance(response, dict):
         app.logger.warning(f"[Validation WARN] Response is not a dict: {type(response)}")
         return False
@@ -506,60 +684,704 @@ def wrap_prompt(template: str, context: Dict[str, str]) -> str:
         raise KeyError(f"Missing key in context for prompt substitution: {e}")
 
 
+# --- Async LLM Client ---
+# Limits are per process and split across every process that calls the model, so together they stay under the account quota:
+# each gunicorn web worker (WEB_CONCURRENCY) plus its JOB_WORKERS embedded job workers, or the JOB_WORKERS external workers.
+# LLM_PROCESSES overrides the count, e.g. when external workers run on several hosts.
+def llm_process_count() -> int:
+    web_processes = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+    job_workers_per_unit = max(1, int(os.getenv('JOB_WORKERS', '1')))
+    if os.getenv('JOB_WORKER_MODE', 'embedded').lower() == 'embedded':
+        return web_processes * (1 + job_workers_per_unit)
+    return web_processes + job_workers_per_unit
+
+LLM_PROCESS_SHARE = max(1, int(os.getenv('LLM_PROCESSES', '0')) or llm_process_count())
+LLM_MAX_CONCURRENCY = max(1, int(os.getenv('LLM_MAX_CONCURRENCY', '8')) // LLM_PROCESS_SHARE)
+LLM_RPM_LIMIT = int(os.getenv('LLM_RPM_LIMIT', '60')) / LLM_PROCESS_SHARE # 0 disables the limit
+LLM_TPM_LIMIT = int(os.getenv('LLM_TPM_LIMIT', '120000')) / LLM_PROCESS_SHARE # 0 disables the limit
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+LLM_BACKOFF_BASE_SEC = float(os.getenv('LLM_BACKOFF_BASE_SEC', '1'))
+LLM_BACKOFF_MAX_SEC = float(os.getenv('LLM_BACKOFF_MAX_SEC', '30'))
+LLM_CALL_TIMEOUT_SEC = float(os.getenv('LLM_CALL_TIMEOUT_SEC', '120')) # Per attempt; 0 disables
+LLM_HEDGING = os.getenv('LLM_HEDGING', 'false').lower() == 'true' # Duplicate calls slower than the observed tail latency
+LLM_HEDGE_QUANTILE = float(os.getenv('LLM_HEDGE_QUANTILE', '0.95'))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20')) # Latencies needed per stage before hedging starts
+LLM_LATENCY_WINDOW = 200 # Recent successful latencies kept per stage
+IMAGE_TOKEN_ESTIMATE = 258 # Gemini bills each inline image as a fixed number of input tokens
+RETRY_AFTER_MESSAGE_RE = re.compile(r"retry (?:in|after) (\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1 # Rough chars-per-token ratio for Latin-script text
+
+def estimate_request_tokens(contents: Union[str, List]) -> int:
+    parts = contents if isinstance(contents, list) else [contents]
+    return sum(estimate_tokens(part) if isinstance(part, str) else IMAGE_TOKEN_ESTIMATE for part in parts)
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Extracts a server-provided retry delay from a Retry-After header, a RetryInfo detail or the error message."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('Retry-After'): return float(headers['Retry-After'])
+    except (TypeError, ValueError):
+        pass
+    for detail in getattr(error, 'details', None) or []:
+        retry_delay = getattr(detail, 'retry_delay', None)
+        if retry_delay is not None:
+            return retry_delay.total_seconds() if hasattr(retry_delay, 'total_seconds') else retry_delay.seconds + retry_delay.nanos / 1e9
+    match = RETRY_AFTER_MESSAGE_RE.search(str(error))
+    return float(match.group(1)) if match else None
+
+class LLMDeadlineExceeded(TimeoutError):
+    """Raised to a page thread when its page deadline expires before the LLM call resolves."""
+
+# Absolute time.monotonic() deadline of the page being processed on the current thread, if any
+page_deadline = contextvars.ContextVar("page_deadline", default=None)
+# Report entry of that page; flagged when one of its LLM calls runs out of page deadline
+page_deadline_report = contextvars.ContextVar("page_deadline_report", default=None)
+
+def page_deadline_exceeded(message: str) -> LLMDeadlineExceeded:
+    """Builds the error for an expired page deadline and flags the page, which then falls back to its original page."""
+    page_report = page_deadline_report.get()
+    if page_report is not None: page_report["llm_deadline_exceeded"] = True
+    return LLMDeadlineExceeded(message)
+
+class AsyncTokenBucket:
+    """Continuously refilling bucket of `rate_per_minute` units; acquire() waits on the event loop, never on a thread."""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount: float = 1) -> float:
+        """Takes `amount` units, sleeping until they are available; returns the time spent waiting."""
+        if self.capacity <= 0: return 0.0
+        amount = min(amount, self.capacity) # An oversized request still goes through once the bucket is full
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return waited
+            delay = (amount - self.tokens) * 60 / self.capacity
+            await asyncio.sleep(delay)
+            waited += delay
+
+class AsyncLLMClient:
+    """Runs every Gemini request on one background event loop shared by all jobs of the process.
+
+    The loop enforces a global cap on in-flight requests plus request- and token-per-minute buckets, and
+    retries failed requests with jittered exponential backoff (or the server's retry-after hint) as timers
+    on the loop, so no page thread sleeps while a request is waiting for its next attempt.
+
+    Each attempt is bounded by `call_timeout` (streams use an idle timeout instead), and the whole call by the
+    caller's page deadline. With hedging on, an attempt still running after the stage's observed p95 latency
+    gets a duplicate; the first to succeed wins and the other is cancelled.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, rpm_limit: float = LLM_RPM_LIMIT, tpm_limit: float = LLM_TPM_LIMIT,
+                 max_retries: int = LLM_MAX_RETRIES, backoff_base: float = LLM_BACKOFF_BASE_SEC, backoff_max: float = LLM_BACKOFF_MAX_SEC,
+                 call_timeout: float = LLM_CALL_TIMEOUT_SEC, hedging: bool = LLM_HEDGING, hedge_quantile: float = LLM_HEDGE_QUANTILE,
+                 hedge_min_samples: int = LLM_HEDGE_MIN_SAMPLES):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.call_timeout = call_timeout
+        self.hedging = hedging
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = {} # stage -> recent successful attempt latencies, only touched on the loop thread
+        self.request_bucket = AsyncTokenBucket(rpm_limit)
+        self.token_bucket = AsyncTokenBucket(tpm_limit)
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "attempts": 0, "retries": 0, "failures": 0, "in_flight": 0, "max_in_flight": 0,
+                      "rate_limit_wait_sec": 0.0, "backoff_sec": 0.0, "attempt_timeouts": 0, "deadline_exceeded": 0,
+                      "hedges": 0, "hedge_wins": 0}
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = None # Created on the loop thread
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run_loop, args=(ready,), name="llm-client-loop", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def _run_loop(self, ready: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        ready.set()
+        self.loop.run_forever()
+
+    def _bump(self, **deltas):
+        with self.stats_lock:
+            for key, delta in deltas.items():
+                self.stats[key] = round(self.stats[key] + delta, 2)
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+
+    def backoff_delay(self, attempt: int, error: Exception) -> float:
+        hinted = retry_after_seconds(error)
+        if hinted is not None:
+            return min(hinted, self.backoff_max) + random.uniform(0, self.backoff_base) # Spread clients released by the same hint
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt))) # "Full jitter"
+
+    def hedge_delay(self, stage: Optional[str]) -> Optional[float]:
+        """The stage's p95 (hedge_quantile) latency once enough samples exist, else None."""
+        samples = sorted(self.latencies.get(stage, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_quantile))]
+
+    async def _attempt(self, request_factory, tokens: int, timeout: Optional[float], stage: Optional[str]):
+        waited = await self.request_bucket.acquire(1) + await self.token_bucket.acquire(tokens)
+        async with self.semaphore:
+            self._bump(attempts=1, in_flight=1, rate_limit_wait_sec=waited)
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(request_factory(), timeout) if timeout else await request_factory()
+            except asyncio.TimeoutError:
+                self._bump(attempt_timeouts=1)
+                raise TimeoutError(f"LLM call timed out after {timeout:.0f}s")
+            finally:
+                self._bump(in_flight=-1)
+            window = self.latencies.setdefault(stage, collections.deque(maxlen=LLM_LATENCY_WINDOW))
+            window.append(time.monotonic() - started)
+            return result
+
+    async def _hedged_attempt(self, request_factory, tokens: int, timeout: Optional[float], stage: Optional[str], hedge: bool):
+        primary = asyncio.ensure_future(self._attempt(request_factory, tokens, timeout, stage))
+        delay = self.hedge_delay(stage) if hedge and self.hedging else None
+        tasks = [primary]
+        try:
+            if delay is None:
+                return await primary
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self._bump(hedges=1)
+                tasks.append(asyncio.ensure_future(self._attempt(request_factory, tokens, timeout, stage)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary: self._bump(hedge_wins=1)
+                        return task.result()
+            raise primary.exception() # Both copies failed
+        finally:
+            for task in tasks: # Cancels the losing copy, or both if the caller gave up
+                if not task.done(): task.cancel()
+
+    async def _call(self, request_factory, tokens: int, label: str, timeout: Optional[float], stage: Optional[str], hedge: bool):
+        self._bump(requests=1)
+        for attempt in range(self.max_retries):
+            try:
+                return await self._hedged_attempt(request_factory, tokens, timeout, stage, hedge)
+            except Exception as e:
+                error = e
+            log_error("LLM Client Request Error", error, {"label": label, "attempt": attempt + 1})
+            if attempt == self.max_retries - 1:
+                break
+            delay = self.backoff_delay(attempt, error)
+            self._bump(retries=1, backoff_sec=delay)
+            app.logger.warning(f"[{label}] LLM request failed. Retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+        self._bump(failures=1)
+        raise error
+
+    def run(self, request_factory, tokens: int = 0, label: str = "llm", stage: Optional[str] = None, hedge: bool = False,
+            bound_attempts: bool = True):
+        """Runs `request_factory()` (a coroutine function) under the global limits and blocks until it resolves.
+
+        Raises the last error once all retries are exhausted, or LLMDeadlineExceeded (after cancelling the
+        request) when the calling page's deadline passes first. `bound_attempts=False` drops the per-attempt
+        call_timeout, leaving only the page deadline.
+        """
+        deadline = page_deadline.get()
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+            self._bump(deadline_exceeded=1)
+            raise page_deadline_exceeded(f"Page deadline expired before the {label} call")
+        timeouts = [t for t in (self.call_timeout if bound_attempts else None, remaining) if t]
+        timeout = min(timeouts) if timeouts else None
+        future = asyncio.run_coroutine_threadsafe(self._call(request_factory, tokens, label, timeout, stage, hedge), self.loop)
+        try:
+            return future.result(timeout=remaining)
+        except concurrent.futures.TimeoutError:
+            if future.done(): raise # The call itself failed with a timeout (same class since Python 3.11)
+            future.cancel()
+            self._bump(deadline_exceeded=1)
+            raise page_deadline_exceeded(f"Page deadline expired during the {label} call")
+
+    def generate_content(self, stage: str, contents: Union[str, List], generation_config: Optional[Dict] = None, label: str = "llm"):
+        """Sends a generate_content request through the shared loop, using the registry's model handle for the stage."""
+        model_instance = gemini_models.get_model(stage, generation_config)
+        return self.run(lambda: model_instance.generate_content_async(contents), tokens=estimate_request_tokens(contents), label=label,
+                        stage=stage, hedge=True)
+
+    def stream_content(self, stage: str, contents: Union[str, List], sink, idle_timeout: float,
+                       generation_config: Optional[Dict] = None, label: str = "llm"):
+        """Streams a generate_content request into `sink` (reset() before each attempt, write() per chunk).
+
+        A gap longer than `idle_timeout` between chunks aborts the attempt with a TimeoutError, which is retried
+        like any other failure; a long but steady stream is only bounded by the page deadline, not by call_timeout.
+        The sink's file I/O runs in order on a writer thread of its own, never on the event loop. Returns the
+        response object once the stream is exhausted.
+        """
+        model_instance = gemini_models.get_model(stage, generation_config)
+        sink_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-stream-sink")
+
+        async def request():
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(sink_writer, sink.reset)
+            response = await asyncio.wait_for(model_instance.generate_content_async(contents, stream=True), idle_timeout)
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), idle_timeout)
+                except StopAsyncIteration:
+                    return response
+                if chunk.candidates and chunk.candidates[0].content.parts: # Blocked or final chunks carry no text
+                    await loop.run_in_executor(sink_writer, sink.write, chunk.text)
+
+        try:
+            return self.run(request, tokens=estimate_request_tokens(contents), label=label, stage=f"{stage}-stream", # Not hedged: one sink
+                            bound_attempts=False)
+        finally:
+            sink_writer.shutdown(wait=True) # A write from a cancelled attempt must land before the caller closes the sink
+
+    def snapshot(self) -> Dict:
+        with self.stats_lock:
+            return dict(self.stats)
+
+# --- LLM Backends ---
+# A backend creates model handles exposing the SDK's `async generate_content_async(contents, stream=False)`;
+# responses need `.text`, `.candidates`, `.prompt_feedback` and optionally `.usage_metadata`.
+class GeminiBackend:
+    name = "gemini"
+
+    @property
+    def model_id(self) -> str:
+        return model_name
+
+    def configuration_error(self) -> Optional[str]:
+        return None if GEMINI_API_KEY else "GEMINI_API_KEY not configured."
+
+    def create_model(self, stage: str, generation_config: Optional[Dict] = None):
+        config = genai.types.GenerationConfig(**generation_config) if generation_config else None
+        return genai.GenerativeModel(model_name, generation_config=config)
+
+LOCAL_LLM_LATENCY_MEDIAN_SEC = {"json": float(os.getenv('LOCAL_LLM_JSON_LATENCY_SEC', '0.8')),
+                                "html": float(os.getenv('LOCAL_LLM_HTML_LATENCY_SEC', '8'))}
+LOCAL_LLM_LATENCY_SIGMA = float(os.getenv('LOCAL_LLM_LATENCY_SIGMA', '0.5')) # Log-normal spread; 0 gives a constant latency
+LOCAL_LLM_ERROR_RATE = float(os.getenv('LOCAL_LLM_ERROR_RATE', '0')) # Share of attempts failing with a simulated 429
+LOCAL_LLM_TABLE_RATE = float(os.getenv('LOCAL_LLM_TABLE_RATE', '0.3')) # Share of pages answered as tables
+LOCAL_LLM_HTML_CHARS = int(os.getenv('LOCAL_LLM_HTML_CHARS', '6000')) # Approximate size of generated pages
+LOCAL_LLM_STREAM_CHUNKS = int(os.getenv('LOCAL_LLM_STREAM_CHUNKS', '8'))
+LOCAL_LLM_SEED = os.getenv('LOCAL_LLM_SEED') # Fixes the latency/error sequence for reproducible runs
+BATCH_PAGE_HEADER_RE = re.compile(r"### PAGE (\d+) ###\n")
+
+class LocalLLMResponse:
+    """Just enough of the SDK response surface for the pipeline: text, candidates, prompt_feedback, usage."""
+
+    def __init__(self, text: str, prompt_tokens: int):
+        self.text = text
+        self.candidates = [types.SimpleNamespace(content=types.SimpleNamespace(parts=[text]))] if text else []
+        self.prompt_feedback = None
+        output_tokens = estimate_tokens(text) if text else 0
+        self.usage_metadata = types.SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+                                                    total_token_count=prompt_tokens + output_tokens)
+
+class LocalLLMStream(LocalLLMResponse):
+    """Async iterator replaying a canned response as chunks spread over the sampled latency."""
+
+    def __init__(self, text: str, prompt_tokens: int, latency: float, chunks: int):
+        super().__init__(text, prompt_tokens)
+        size = max(1, -(-len(text) // chunks))
+        self.pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        self.delays = [latency * 0.2] + [latency * 0.8 / max(1, len(self.pieces) - 1)] * (len(self.pieces) - 1)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.pieces:
+            raise StopAsyncIteration
+        await asyncio.sleep(self.delays.pop(0))
+        return LocalLLMResponse(self.pieces.pop(0), 0)
+
+class LocalLLMModel:
+    def __init__(self, backend: "LocalLLMBackend", stage: str):
+        self.backend = backend
+        self.stage = stage
+
+    async def generate_content_async(self, contents: Union[str, List], stream: bool = False, **kwargs):
+        latency, fail = self.backend.sample(self.stage)
+        prompt = "\n".join(part for part in (contents if isinstance(contents, list) else [contents]) if isinstance(part, str))
+        text = self.backend.canned_response(self.stage, prompt)
+        if stream:
+            if fail: raise RuntimeError("429 Resource has been exhausted (simulated). Please retry in 1s.")
+            return LocalLLMStream(text, estimate_request_tokens(contents), latency, self.backend.stream_chunks)
+        await asyncio.sleep(latency)
+        if fail: raise RuntimeError("429 Resource has been exhausted (simulated). Please retry in 1s.")
+        return LocalLLMResponse(text, estimate_request_tokens(contents))
+
+class LocalLLMBackend:
+    """Offline backend with deterministic, templated answers and configurable latency and error rate.
+
+    The answer to a prompt only depends on its text, so runs are comparable; latencies are log-normal around
+    a per-stage median and simulated 429s exercise the client's retry path.
+    """
+    name = "local"
+    model_id = "local-canned-v1"
+
+    def __init__(self, latency_median: Optional[Dict[str, float]] = None, latency_sigma: float = LOCAL_LLM_LATENCY_SIGMA,
+                 error_rate: float = LOCAL_LLM_ERROR_RATE, table_rate: float = LOCAL_LLM_TABLE_RATE,
+                 html_chars: int = LOCAL_LLM_HTML_CHARS, stream_chunks: int = LOCAL_LLM_STREAM_CHUNKS, seed: Optional[str] = LOCAL_LLM_SEED):
+        self.latency_median = {**LOCAL_LLM_LATENCY_MEDIAN_SEC, **(latency_median or {})}
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.table_rate = table_rate
+        self.html_chars = html_chars
+        self.stream_chunks = stream_chunks
+        self.rng = random.Random(seed)
+
+    def configuration_error(self) -> Optional[str]:
+        return None
+
+    def create_model(self, stage: str, generation_config: Optional[Dict] = None) -> LocalLLMModel:
+        return LocalLLMModel(self, stage)
+
+    def sample(self, stage: str) -> Tuple[float, bool]:
+        """Latency and whether this attempt fails; called on the loop thread only."""
+        median = self.latency_median.get(stage, self.latency_median["json"])
+        latency = median * math.exp(self.rng.gauss(0, self.latency_sigma)) if self.latency_sigma > 0 else median
+        return latency, self.rng.random() < self.error_rate
+
+    def is_table(self, text: str) -> bool:
+        return int(hashlib.blake2b(text.encode(), digest_size=4).hexdigest(), 16) % 1000 < self.table_rate * 1000
+
+    def canned_html(self, prompt: str) -> str:
+        digest = hashlib.blake2b(prompt.encode(), digest_size=8).hexdigest()
+        rows, row_count = [], 0
+        while sum(len(row) for row in rows) < self.html_chars:
+            row_count += 1
+            rows.append(f"<tr><td>Ligne {row_count}</td><td>{digest}</td><td>{row_count * 100} €</td></tr>")
+        return ("<!DOCTYPE html><html><head><style>body{font-family:Arial,sans-serif}table{border-collapse:collapse;width:100%}"
+                "td{border:1px solid #000;padding:4px}</style></head><body><h1>Local backend page</h1><table>"
+                + "".join(rows) + "</table></body></html>")
+
+    def canned_response(self, stage: str, prompt: str) -> str:
+        if stage == "html":
+            return self.canned_html(prompt)
+        page_sections = BATCH_PAGE_HEADER_RE.split(prompt)[1:]
+        if page_sections: # Batched detection: one verdict per "### PAGE n ###" section
+            return json.dumps([{"page": int(page), "tableDetected": self.is_table(text), "confidenceScore": 0.9}
+                               for page, text in zip(page_sections[::2], page_sections[1::2])])
+        detected = self.is_table(prompt)
+        if '"html":' in prompt: # Combined detect-and-render prompt
+            return json.dumps({"tableDetected": detected, "confidenceScore": 0.9, "html": self.canned_html(prompt) if detected else ""})
+        return json.dumps({"tableDetected": detected, "confidenceScore": 0.9})
+
+LLM_BACKENDS = {"gemini": GeminiBackend, "local": LocalLLMBackend}
+if LLM_BACKEND not in LLM_BACKENDS:
+    app.logger.error(f"Unknown LLM_BACKEND '{LLM_BACKEND}', falling back to 'gemini'. Expected one of {sorted(LLM_BACKENDS)}.")
+llm_backend = LLM_BACKENDS.get(LLM_BACKEND, GeminiBackend)()
+
+class GeminiModelRegistry:
+    """Long-lived model handles from the active LLM backend, one per (stage, model, generation config).
+
+    This only saves re-creating model objects (and re-validating their generation config) for every page. The
+    SDK already shares one async client, and its connections, across all models of the process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}
+        self.counts = {}
+
+    def get_model(self, stage: str, generation_config: Optional[Dict] = None):
+        key = (stage, llm_backend.name, llm_backend.model_id, json.dumps(generation_config or {}, sort_keys=True))
+        with self.lock:
+            counts = self.counts.setdefault(stage, {"created": 0, "reused": 0})
+            if key in self.models:
+                counts["reused"] += 1
+                return self.models[key]
+            self.models[key] = llm_backend.create_model(stage, generation_config)
+            counts["created"] += 1
+            return self.models[key]
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {"models": len(self.models), "by_stage": {stage: dict(counts) for stage, counts in self.counts.items()}}
+
+gemini_models = GeminiModelRegistry()
+llm_client = None
+llm_client_lock = threading.Lock()
+
+def get_llm_client() -> AsyncLLMClient:
+    """Returns the process-wide LLM client, starting its event loop thread on first use."""
+    global llm_client
+    with llm_client_lock:
+        if llm_client is None:
+            llm_client = AsyncLLMClient()
+            app.logger.info(f"Started LLM client loop: {LLM_MAX_CONCURRENCY} concurrent requests, {LLM_RPM_LIMIT:g} RPM, {LLM_TPM_LIMIT:g} TPM")
+        return llm_client
+
+
+# --- LLM Usage Accounting ---
+LLM_USAGE_FIELDS = ("prompt_token_count", "candidates_token_count", "total_token_count")
+# The page being processed on the current thread; record_llm_usage adds to it when set
+llm_usage_scope = contextvars.ContextVar("llm_usage_scope", default=None)
+
+def extract_usage(response) -> Optional[Dict]:
+    """Token counts from a Gemini response, or None when the SDK/model does not report usage_metadata."""
+    usage_metadata = getattr(response, "usage_metadata", None)
+    if usage_metadata is None:
+        return None
+    return {field: int(getattr(usage_metadata, field, 0) or 0) for field in LLM_USAGE_FIELDS}
+
+def merge_usage(into: Dict, usage_by_stage: Dict) -> Dict:
+    """Adds a {stage: {"calls", "unreported_calls", <token fields>}} breakdown into `into`."""
+    for stage, usage in usage_by_stage.items():
+        totals = into.setdefault(stage, {"calls": 0, "unreported_calls": 0, **{field: 0 for field in LLM_USAGE_FIELDS}})
+        for key, value in usage.items():
+            totals[key] = totals.get(key, 0) + value
+    return into
+
+def record_llm_usage(stage: str, response) -> Optional[Dict]:
+    usage = extract_usage(response)
+    scope = llm_usage_scope.get()
+    if scope is not None:
+        merge_usage(scope, {stage: {"calls": 1, "unreported_calls": 0 if usage else 1, **(usage or {})}})
+    return usage
+
+def record_user_llm_usage(user_id: int, usage_by_stage: Dict) -> Dict:
+    """Adds a job's usage to the user's totals in the llm_usage table and returns those totals.
+
+    Increments happen in SQL, so jobs finishing at the same time in different processes all count.
+    """
+    ensure_job_table()
+    counters = ("calls", "unreported_calls") + LLM_USAGE_FIELDS
+    for stage, usage in usage_by_stage.items():
+        increments = {key: usage.get(key, 0) for key in counters}
+        for _ in range(2): # A concurrent job may insert the row between our update and insert
+            updated = LLMUsage.query.filter_by(user_id=user_id, stage=stage).update(
+                {getattr(LLMUsage, key): getattr(LLMUsage, key) + value for key, value in increments.items()}, synchronize_session=False)
+            if not updated:
+                db.session.add(LLMUsage(user_id=user_id, stage=stage, **increments))
+            try:
+                db.session.commit()
+                break
+            except IntegrityError:
+                db.session.rollback()
+    return {row.stage: {key: getattr(row, key) for key in counters} for row in LLMUsage.query.filter_by(user_id=user_id)}
+
+
 # --- Gemini Call Function for JSON ---
-def call_gemini_for_json(prompt: str, max_retries: int = 3, delay: int = 5) -> Dict:
-    if not GEMINI_API_KEY:
-         log_error("Gemini Call", ValueError("GEMINI_API_KEY not configured."), {})
-         return {"error": "GEMINI_API_KEY not configured."}
-
-    model_instance = genai.GenerativeModel(model_name)
-    generation_config = genai.types.GenerationConfig(
-        temperature=0.1, # Lower temperature for more deterministic JSON
-        response_mime_type="application/json" # Request JSON directly
-    )
+JSON_GENERATION_CONFIG = {
+    "temperature": 0.1, # Lower temperature for more deterministic JSON
+    "response_mime_type": "application/json", # Request JSON directly
+}
+
+def call_gemini_for_json(prompt: str, expect_list: bool = False, images: Optional[List[Union[Image.Image, Dict]]] = None,
+                         usage_stage: str = "detectTable") -> Union[Dict, List]:
+    configuration_error = llm_backend.configuration_error()
+    if configuration_error:
+         log_error("Gemini Call", ValueError(configuration_error), {})
+         return {"error": configuration_error}
+
     response_text_for_logging = "" # Initialize for logging in case of error before assignment
-    for attempt in range(max_retries):
-        try:
-            app.logger.info(f"[API Call Attempt {attempt + 1}/{max_retries}] Calling Gemini for JSON...")
-            response = model_instance.generate_content(
-                prompt,
-                generation_config=generation_config,
-                stream=False
-            )
-            if not response.candidates or not response.candidates[0].content.parts:
-                finish_reason = response.prompt_feedback.block_reason if response.prompt_feedback else 'Unknown'
-                safety_ratings = response.prompt_feedback.safety_ratings if response.prompt_feedback else 'N/A'
-                error_msg = f"Gemini response empty or blocked. Finish Reason: {finish_reason}, Safety: {safety_ratings}"
-                log_error("Gemini Call Error", ValueError(error_msg), {"attempt": attempt + 1, "prompt_prefix": prompt[:100]})
-                if finish_reason != 'STOP': # Non-retryable block
-                    return {"error": error_msg}
-                raise ValueError(error_msg) # Force retry or failure if STOP but no content
-
-            response_text_for_logging = response.text
-            app.logger.info(f"[API Call Success] Gemini returned text (attempt {attempt + 1}). Length: {len(response_text_for_logging)}")
-            parsed_json = json.loads(response_text_for_logging)
-            if not isinstance(parsed_json, dict):
-                raise TypeError(f"Parsed response is not a dictionary (type: {type(parsed_json)})")
-            return parsed_json # Success
-        except (json.JSONDecodeError, TypeError) as json_err:
-             log_error("Gemini JSON Parsing Error", json_err, {"attempt": attempt + 1, "response_text_prefix": response_text_for_logging[:500]})
-             return {"error": f"Failed to parse Gemini response as JSON: {json_err}", "raw_text": response_text_for_logging}
-        except Exception as e:
-            log_error("Gemini API Call/Processing Error", e, {"attempt": attempt + 1, "prompt_prefix": prompt[:100]})
-            if attempt < max_retries - 1:
-                current_delay = delay * (2 ** attempt)
-                app.logger.warning(f"Gemini call failed. Retrying in {current_delay} seconds...")
-                time.sleep(current_delay)
-            else:
-                app.logger.error(f"Gemini API call failed after {max_retries} attempts.")
-                return {"error": f"Gemini API call failed after {max_retries} attempts: {str(e)}"}
-    return {"error": f"Gemini API call failed unexpectedly after {max_retries} attempts."}
+    try:
+        app.logger.info("[API Call] Calling Gemini for JSON...")
+        # Retries, backoff and rate limiting happen on the shared LLM client loop
+        response = get_llm_client().generate_content("json", [prompt, *images] if images else prompt, JSON_GENERATION_CONFIG, label="Gemini JSON")
+        record_llm_usage(usage_stage, response)
+        if not response.candidates or not response.candidates[0].content.parts:
+            finish_reason = response.prompt_feedback.block_reason if response.prompt_feedback else 'Unknown'
+            safety_ratings = response.prompt_feedback.safety_ratings if response.prompt_feedback else 'N/A'
+            error_msg = f"Gemini response empty or blocked. Finish Reason: {finish_reason}, Safety: {safety_ratings}"
+            log_error("Gemini Call Error", ValueError(error_msg), {"prompt_prefix": prompt[:100]})
+            return {"error": error_msg}
+
+        response_text_for_logging = response.text
+        app.logger.info(f"[API Call Success] Gemini returned text. Length: {len(response_text_for_logging)}")
+        parsed_json = json.loads(response_text_for_logging)
+        expected_type = list if expect_list else dict
+        if not isinstance(parsed_json, expected_type):
+            raise TypeError(f"Parsed response is not a {expected_type.__name__} (type: {type(parsed_json)})")
+        return parsed_json # Success
+    except (json.JSONDecodeError, TypeError) as json_err:
+         log_error("Gemini JSON Parsing Error", json_err, {"response_text_prefix": response_text_for_logging[:500]})
+         return {"error": f"Failed to parse Gemini response as JSON: {json_err}", "raw_text": response_text_for_logging}
+    except LLMDeadlineExceeded as e: # Not a failed call: the page ran out of time, possibly before any attempt
+        app.logger.warning(f"Gemini JSON call abandoned: {e}")
+        return {"error": f"Page deadline exceeded: {e}", "deadline_exceeded": True}
+    except Exception as e:
+        app.logger.error(f"Gemini API call failed after {LLM_MAX_RETRIES} attempts.")
+        return {"error": f"Gemini API call failed after {LLM_MAX_RETRIES} attempts: {str(e)}"}
+
+
+# --- LLM Response Cache ---
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+LLM_CACHE_DIR = os.getenv('LLM_CACHE_DIR', 'cache/llm')
+LLM_CACHE_MAX_MB = int(os.getenv('LLM_CACHE_MAX_MB', '256'))
+LLM_CACHE_TTL_HOURS = float(os.getenv('LLM_CACHE_TTL_HOURS', '168'))
+llm_cache = None
+if LLM_CACHE_ENABLED:
+    try:
+        llm_cache = DiskCache(Path(LLM_CACHE_DIR), LLM_CACHE_MAX_MB * 1024 * 1024, "llm", ttl_seconds=LLM_CACHE_TTL_HOURS * 3600)
+    except OSError as e:
+        app.logger.error(f"Failed to initialize LLM response cache at '{LLM_CACHE_DIR}': {e}")
+
+def llm_cache_key(stage: str, prompt_template: str, generation_config: Dict, *inputs: Union[str, bytes]) -> str:
+    """Keys a response by model, prompt template (its hash acts as the template version), generation config and inputs."""
+    digest = hashlib.blake2b(digest_size=20)
+    template_version = hashlib.blake2b(prompt_template.encode(), digest_size=8).hexdigest()
+    digest.update(f"{stage}|{llm_backend.name}:{llm_backend.model_id}|{template_version}|{json.dumps(generation_config, sort_keys=True)}".encode())
+    for item in inputs:
+        digest.update(b"|")
+        digest.update(item.encode() if isinstance(item, str) else item)
+    return digest.hexdigest()
+
+def image_fingerprint(image: Image.Image) -> bytes:
+    return f"{image.mode}|{image.size}|".encode() + hashlib.blake2b(image.tobytes(), digest_size=20).digest()
+
+
+# --- Local Table Pre-classifier ---
+# "on" settles clear pages locally, "shadow" only logs agreement with Gemini, "off" disables it
+LOCAL_TABLE_CLASSIFIER = os.getenv('LOCAL_TABLE_CLASSIFIER', 'shadow').lower()
+LOCAL_TABLE_YES_THRESHOLD = float(os.getenv('LOCAL_TABLE_YES_THRESHOLD', '0.55'))
+LOCAL_TABLE_NO_THRESHOLD = float(os.getenv('LOCAL_TABLE_NO_THRESHOLD', '0.15'))
+LOCAL_TABLE_MIN_LINES = int(os.getenv('LOCAL_TABLE_MIN_LINES', '5'))
+
+AMOUNT_TOKEN_RE = re.compile(r"\d[\d\u00a0\u202f .,]*\s?(?:€|EUR|%)|[€$£]\s?\d")
+COLUMN_GAP_RE = re.compile(r"\S(?: {3,}|\t)\S")
+
+local_classifier_stats = {"decisive": 0, "ambiguous": 0, "agree": 0, "disagree": 0}
+local_classifier_stats_lock = threading.Lock()
+
+def column_alignment_ratio(words: List[Dict]) -> float:
+    """Share of OCR lines with a word starting after a wide gap at an x position shared by many other lines."""
+    lines = {}
+    for word in words:
+        lines.setdefault(word["line"], []).append(word)
+    if not lines:
+        return 0.0
+    page_width = max(word["left"] + word["width"] for word in words) or 1
+    line_gap_bins = []
+    for line_words in lines.values():
+        line_words.sort(key=lambda w: w["left"])
+        line_height = max(w["height"] for w in line_words) or 1
+        line_gap_bins.append({int(50 * cur["left"] / page_width) for prev, cur in zip(line_words, line_words[1:])
+                              if cur["left"] - (prev["left"] + prev["width"]) > 2 * line_height})
+    bin_counts = {}
+    for bins in line_gap_bins:
+        for x_bin in bins:
+            bin_counts[x_bin] = bin_counts.get(x_bin, 0) + 1
+    column_bins = {x_bin for x_bin, count in bin_counts.items() if count >= max(3, 0.2 * len(lines))}
+    return sum(1 for bins in line_gap_bins if bins & column_bins) / len(lines)
+
+def classify_table_locally(page_text: str, words: Optional[List[Dict]] = None, yes_threshold: float = LOCAL_TABLE_YES_THRESHOLD,
+                           no_threshold: float = LOCAL_TABLE_NO_THRESHOLD) -> Dict:
+    """CPU-only table guess from line structure: amount/currency tokens, short cell-like lines and column gaps.
+
+    When OCR word boxes are available, column alignment across lines is used as well.
+    Returns a decision of "table", "no_table" or "ambiguous"; only the ambiguous pages need Gemini.
+    """
+    lines = [line for line in page_text.splitlines() if line.strip()]
+    if len(lines) < LOCAL_TABLE_MIN_LINES:
+        return {"decision": "ambiguous", "score": None, "features": {"lines": len(lines)}}
+    features = {
+        "lines": len(lines),
+        "amount_line_ratio": round(sum(1 for line in lines if AMOUNT_TOKEN_RE.search(line)) / len(lines), 3),
+        "short_line_ratio": round(sum(1 for line in lines if len(line.split()) <= 6) / len(lines), 3),
+        "column_gap_line_ratio": round(sum(1 for line in lines if COLUMN_GAP_RE.search(line)) / len(lines), 3),
+    }
+    if words:
+        features["column_alignment_ratio"] = round(column_alignment_ratio(words), 3)
+    score = (0.6 * min(1.0, 2 * features["amount_line_ratio"]) + 0.4 * features["short_line_ratio"]
+             + 0.3 * features["column_gap_line_ratio"] + 0.4 * features.get("column_alignment_ratio", 0.0))
+    score = round(min(1.0, score), 3)
+    decision = "table" if score >= yes_threshold else "no_table" if score <= no_threshold else "ambiguous"
+    return {"decision": decision, "score": score, "features": features}
+
+def record_local_classifier_outcome(local_result: Dict, gemini_detected: Optional[bool]):
+    """Updates the process-wide shadow-mode agreement counters and returns a snapshot of them."""
+    with local_classifier_stats_lock:
+        if local_result["decision"] == "ambiguous":
+            local_classifier_stats["ambiguous"] += 1
+        else:
+            local_classifier_stats["decisive"] += 1
+            if gemini_detected is not None:
+                agrees = (local_result["decision"] == "table") == gemini_detected
+                local_classifier_stats["agree" if agrees else "disagree"] += 1
+        return dict(local_classifier_stats)
+
+
+# --- Detection Prompt Compaction ---
+DETECTION_COMPACTION = os.getenv('DETECTION_COMPACTION', 'true').lower() == 'true'
+DETECTION_MAX_TOKENS = int(os.getenv('DETECTION_MAX_TOKENS', '1500')) # 0 disables truncation
+BOILERPLATE_EDGE_LINES = int(os.getenv('BOILERPLATE_EDGE_LINES', '3')) # Lines at the top/bottom of a page checked for headers/footers
+BOILERPLATE_MIN_PAGES = int(os.getenv('BOILERPLATE_MIN_PAGES', '3')) # Pages an edge line must appear on to count as boilerplate
+HORIZONTAL_WHITESPACE_RUN_RE = re.compile(r"[ \t\u00a0\u202f]{2,}")
+
+def normalize_boilerplate_line(line: str) -> str:
+    return re.sub(r"\d+", "#", " ".join(line.split()).lower()) # "Page 3 / 32" and "Page 4 / 32" match
+
+def find_boilerplate_lines(page_texts: Iterable[str], edge_lines: int = BOILERPLATE_EDGE_LINES,
+                           min_pages: int = BOILERPLATE_MIN_PAGES) -> FrozenSet[str]:
+    """A document's running headers and footers: normalized edge lines found on at least `min_pages` pages.
+
+    Computed once per document before any page is compacted, so a page's compacted text (and with it the
+    detection cache key) does not depend on which pages happened to finish first.
+    """
+    page_counts = collections.Counter()
+    for page_text in page_texts:
+        lines = [line for line in page_text.splitlines() if line.strip()]
+        page_counts.update({normalize_boilerplate_line(line) for line in lines[:edge_lines] + lines[-edge_lines:]})
+    return frozenset(line for line, count in page_counts.items() if count >= min_pages)
+
+def compact_detection_text(page_text: str, boilerplate: FrozenSet[str] = frozenset(),
+                           max_tokens: int = DETECTION_MAX_TOKENS, edge_lines: int = BOILERPLATE_EDGE_LINES) -> Tuple[str, Dict]:
+    """Shrinks page text for the detection prompt while keeping its line structure.
+
+    Whitespace runs inside a line become a single tab, so column boundaries survive as one character; blank
+    lines are collapsed; edge lines listed in `boilerplate` (see find_boilerplate_lines) are dropped; and whole
+    lines are kept until `max_tokens` is reached.
+    """
+    lines = [HORIZONTAL_WHITESPACE_RUN_RE.sub("\t", line.strip()) for line in page_text.splitlines()]
+    lines = [line for i, line in enumerate(lines) if line or (i > 0 and lines[i - 1])] # At most one blank line in a row
+    while lines and not lines[-1]: lines.pop()
+    removed_boilerplate = 0
+    if boilerplate:
+        content_indexes = [i for i, line in enumerate(lines) if line]
+        edge_indexes = set(content_indexes[:edge_lines] + content_indexes[-edge_lines:])
+        kept = []
+        for i, line in enumerate(lines):
+            if i in edge_indexes and normalize_boilerplate_line(line) in boilerplate:
+                removed_boilerplate += 1
+                continue
+            kept.append(line)
+        lines = kept
+    truncated_lines = 0
+    if max_tokens > 0:
+        budget = max_tokens
+        for i, line in enumerate(lines):
+            budget -= estimate_tokens(line)
+            if budget < 0:
+                truncated_lines = len(lines) - i
+                lines = lines[:i] + [f"[... {truncated_lines} more lines truncated]"]
+                break
+    compacted = "\n".join(lines).strip()
+    return compacted, {"tokens_before": estimate_tokens(page_text), "tokens_after": estimate_tokens(compacted),
+                       "removed_boilerplate_lines": removed_boilerplate, "truncated_lines": truncated_lines}
 
 
 # --- Core Processing Functions ---
-def detect_table(page_text: str) -> Dict:
+def detect_table(page_text: str, bypass_cache: bool = False) -> Dict:
     start_time = time.time()
-    result = {"response": {}, "response_time": 0, "error": None}
+    result = {"response": {}, "response_time": 0, "error": None, "cache_hit": False}
     if not page_text or not page_text.strip():
         app.logger.warning("[WARN] detect_table called with empty page_text.")
         result["error"] = "Input page text was empty."
@@ -570,6 +1392,11 @@ def detect_table(page_text: str) -> Dict:
 
     try:
         prompt = wrap_prompt(TABLE_DETECTION_PROMPT_TEMPLATE, {"pdf_page_text": page_text})
+        cache_key = llm_cache_key("detectTable", TABLE_DETECTION_PROMPT_TEMPLATE, JSON_GENERATION_CONFIG, page_text) if llm_cache else None
+        cached = llm_cache.get(cache_key) if llm_cache and not bypass_cache else None
+        if cached is not None:
+            result.update({"response": cached, "cache_hit": True, "response_time": round(time.time() - start_time, 2)})
+            return result
         parsed_data = call_gemini_for_json(prompt)
         result["response_time"] = round(time.time() - start_time, 2)
         if "error" in parsed_data:
@@ -583,6 +1410,7 @@ def detect_table(page_text: str) -> Dict:
              result["response"] = parsed_data # Include invalid data
              return result
         result["response"] = parsed_data
+        if llm_cache: llm_cache.put(cache_key, parsed_data) # Only validated responses are cached
         return result
     except Exception as e:
         log_error("Table Detection Pipeline Error", e, {"page_text_snippet": page_text[:100]})
@@ -590,42 +1418,379 @@ def detect_table(page_text: str) -> Dict:
         result["response_time"] = round(time.time() - start_time, 2)
         return result
 
-def extract_full_page_html_from_image(image_path: str, ocr_text: str) -> Dict:
+DETECTION_BATCHING = os.getenv('DETECTION_BATCHING', 'false').lower() == 'true'
+DETECTION_BATCH_MAX_PAGES = int(os.getenv('DETECTION_BATCH_MAX_PAGES', '8'))
+DETECTION_BATCH_TOKEN_BUDGET = int(os.getenv('DETECTION_BATCH_TOKEN_BUDGET', '6000'))
+DETECTION_BATCH_LINGER_SEC = float(os.getenv('DETECTION_BATCH_LINGER_SEC', '0.5')) # How long a batch waits for more pages
+
+def detect_tables_batch(pages: List[Tuple[int, str]]) -> Optional[Dict[int, Dict]]:
+    """Classifies several pages in one Gemini request; returns None when the batched response is unusable."""
     start_time = time.time()
-    result = {"html": "", "response_time": 0, "error": None}
+    page_numbers = [page_num for page_num, _ in pages]
+    pages_text = "\n".join(f"### PAGE {page_num} ###\n{page_text}" for page_num, page_text in pages)
+    parsed_data = call_gemini_for_json(wrap_prompt(TABLE_DETECTION_BATCH_PROMPT_TEMPLATE, {"pdf_pages_text": pages_text}), expect_list=True,
+                                       usage_stage="detectTablesBatch")
+    response_time = round(time.time() - start_time, 2)
+    if isinstance(parsed_data, dict) or not validate_table_detection_response(parsed_data, expected_pages=page_numbers):
+        log_error("Batched Table Detection Error", ValueError("Malformed batched detection response"), {"pages": page_numbers, "response": parsed_data})
+        return None
+    log_component("detectTablesBatch", {"pages": page_numbers, "response_time": response_time})
+    return {item["page"]: {"response": {"tableDetected": item["tableDetected"], "confidenceScore": item["confidenceScore"]},
+                           "response_time": response_time, "error": None, "cache_hit": False, "batch_size": len(pages)}
+            for item in parsed_data}
+
+class TableDetectionBatcher:
+    """Packs the OCR text of concurrently processed pages into shared detection requests.
+
+    Page threads call detect() and block until their batch is answered. A batch is sent when it reaches
+    DETECTION_BATCH_MAX_PAGES, when the next page would overflow the token budget, or when it has lingered
+    long enough. If the batched answer is malformed, each page falls back to its own detect_table call.
+    A page never waits past its page deadline for a batch; it raises LLMDeadlineExceeded instead.
+    """
+
+    def __init__(self, max_pages: int = DETECTION_BATCH_MAX_PAGES, token_budget: int = DETECTION_BATCH_TOKEN_BUDGET,
+                 linger_sec: float = DETECTION_BATCH_LINGER_SEC, bypass_cache: bool = False):
+        self.max_pages = max_pages
+        self.token_budget = token_budget
+        self.linger_sec = linger_sec
+        self.bypass_cache = bypass_cache
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_tokens = 0
+
+    def _take_pending(self) -> List[Dict]:
+        batch, self.pending, self.pending_tokens = self.pending, [], 0
+        return batch
+
+    def _send(self, batch: List[Dict]):
+        results = None
+        try:
+            if len(batch) > 1:
+                results = detect_tables_batch([(entry["page"], entry["text"]) for entry in batch])
+        except Exception as e:
+            log_error("Batched Table Detection Pipeline Error", e, {"pages": [entry["page"] for entry in batch]})
+        finally:
+            for entry in batch: # Always release the waiting page threads
+                entry["result"] = results.get(entry["page"]) if results else None
+                if entry["result"] and llm_cache:
+                    llm_cache.put(llm_cache_key("detectTable", TABLE_DETECTION_PROMPT_TEMPLATE, JSON_GENERATION_CONFIG, entry["text"]), entry["result"]["response"])
+                entry["done"].set()
+
+    def detect(self, page_num: int, page_text: str) -> Dict:
+        if not page_text or not page_text.strip() or estimate_tokens(page_text) >= self.token_budget:
+            return detect_table(page_text, bypass_cache=self.bypass_cache)
+        if llm_cache and not self.bypass_cache:
+            cached = llm_cache.get(llm_cache_key("detectTable", TABLE_DETECTION_PROMPT_TEMPLATE, JSON_GENERATION_CONFIG, page_text))
+            if cached is not None:
+                return {"response": cached, "response_time": 0, "error": None, "cache_hit": True}
+        entry = {"page": page_num, "text": page_text, "done": threading.Event(), "result": None}
+        tokens = estimate_tokens(page_text)
+        ready_batches = []
+        with self.lock:
+            if self.pending and self.pending_tokens + tokens > self.token_budget:
+                ready_batches.append(self._take_pending())
+            self.pending.append(entry); self.pending_tokens += tokens
+            if len(self.pending) >= self.max_pages:
+                ready_batches.append(self._take_pending())
+        for batch in ready_batches:
+            self._send(batch)
+        deadline = page_deadline.get() # Waiting for a batch counts against this page's own deadline
+        linger = self.linger_sec if deadline is None else max(0.0, min(self.linger_sec, deadline - time.monotonic()))
+        if not entry["done"].wait(linger):
+            expired = deadline is not None and time.monotonic() >= deadline
+            with self.lock:
+                queued = any(pending is entry for pending in self.pending)
+                if queued and expired: # Leave the other pages queued for a thread with time left
+                    self.pending.remove(entry); self.pending_tokens -= tokens
+                batch = self._take_pending() if queued and not expired else None
+            if batch: self._send(batch)
+            if expired and queued:
+                raise page_deadline_exceeded(f"Page deadline expired before the detection batch for page {page_num} was sent")
+            if not entry["done"].wait(None if deadline is None else max(0.0, deadline - time.monotonic())):
+                raise page_deadline_exceeded(f"Page deadline expired waiting for the detection batch of page {page_num}")
+        if entry["result"] is None: # Single-page batch or malformed batched answer
+            return detect_table(page_text, bypass_cache=self.bypass_cache)
+        return entry["result"]
+
+
+# Gemini downsamples large images anyway, so the full 300 DPI page mostly costs upload time
+LLM_IMAGE_MAX_EDGE = int(os.getenv('LLM_IMAGE_MAX_EDGE', '2048')) # Long edge in pixels; 0 keeps the rendered size
+LLM_IMAGE_FORMAT = os.getenv('LLM_IMAGE_FORMAT', 'jpeg').lower() # jpeg, webp or png
+LLM_IMAGE_QUALITY = int(os.getenv('LLM_IMAGE_QUALITY', '85')) # Ignored for png
+LLM_IMAGE_CROP = os.getenv('LLM_IMAGE_CROP', 'false').lower() == 'true' # Crop to the inked area before resizing
+LLM_IMAGE_CROP_MARGIN = float(os.getenv('LLM_IMAGE_CROP_MARGIN', '0.02')) # Fraction of the page kept around the content
+IMAGE_PAYLOAD_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp"), "png": ("PNG", "image/png")}
+
+def content_bbox(image: Image.Image, margin: float = LLM_IMAGE_CROP_MARGIN, ink_threshold: int = 200) -> Optional[Tuple[int, int, int, int]]:
+    """Bounding box of the non-background pixels, padded by `margin` of the page size; None for a blank page."""
+    ink = to_grayscale(image) < ink_threshold
+    rows, cols = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+    if rows.size == 0:
+        return None
+    pad_x, pad_y = int(image.width * margin), int(image.height * margin)
+    return (max(0, cols[0] - pad_x), max(0, rows[0] - pad_y), min(image.width, cols[-1] + 1 + pad_x), min(image.height, rows[-1] + 1 + pad_y))
+
+def optimize_image_payload(image: Image.Image, max_edge: int = LLM_IMAGE_MAX_EDGE, image_format: str = LLM_IMAGE_FORMAT,
+                           quality: int = LLM_IMAGE_QUALITY, crop: bool = LLM_IMAGE_CROP) -> Tuple[Dict, Dict]:
+    """Encodes a page image for upload; returns the inline blob ({"mime_type", "data"}) and what was done to it."""
+    start_time = time.time()
+    if image_format not in IMAGE_PAYLOAD_FORMATS:
+        raise ValueError(f"Unsupported image payload format '{image_format}' (expected one of {sorted(IMAGE_PAYLOAD_FORMATS)})")
+    pil_format, mime_type = IMAGE_PAYLOAD_FORMATS[image_format]
+    payload_image = image if image.mode == 'RGB' else image.convert('RGB')
+    info = {"format": image_format, "quality": quality if image_format != "png" else None, "max_edge": max_edge, "crop": crop,
+            "original_size": list(image.size), "crop_box": None}
+    if crop:
+        bbox = content_bbox(payload_image)
+        if bbox and bbox != (0, 0, *payload_image.size):
+            payload_image = payload_image.crop(bbox)
+            info["crop_box"] = list(bbox)
+    if max_edge > 0 and max(payload_image.size) > max_edge:
+        scale = max_edge / max(payload_image.size)
+        payload_image = payload_image.resize((max(1, round(payload_image.width * scale)), max(1, round(payload_image.height * scale))), Image.LANCZOS)
+    buffer = io.BytesIO()
+    save_kwargs = {"optimize": True} if image_format == "png" else {"quality": quality}
+    payload_image.save(buffer, format=pil_format, **save_kwargs)
+    info.update({"sent_size": list(payload_image.size), "bytes": buffer.tell(), "encode_sec": round(time.time() - start_time, 3)})
+    if payload_image is not image: payload_image.close()
+    return {"mime_type": mime_type, "data": buffer.getvalue()}, info
+
+def image_payload_signature(payload_options: Dict) -> str:
+    """Cache-key input for the payload settings, since they change what the model sees."""
+    return json.dumps({key: payload_options[key] for key in ("max_edge", "image_format", "quality", "crop")}, sort_keys=True)
+
+HTML_STREAMING = os.getenv('HTML_STREAMING', 'true').lower() == 'true'
+HTML_STREAM_IDLE_TIMEOUT_SEC = float(os.getenv('HTML_STREAM_IDLE_TIMEOUT_SEC', '60')) # Max silence between streamed chunks
+
+def clean_ai_html_response(response: str) -> str:
+    """Removes markdown code block syntax from AI-generated HTML responses."""
+    if response.startswith("```html"):
+        response = response.replace("```html", "", 1)
+    if response.endswith("```"):
+        response = response[:-3]
+    return response.strip()
+
+class HTMLStreamWriter:
+    """Writes streamed HTML chunks to a file, applying clean_ai_html_response's fence stripping on the fly.
+
+    The start of the stream is buffered until a leading ```html fence can be ruled out, and trailing whitespace
+    and backticks are held back until close() since they may turn out to be the closing fence.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = None
+        self.reset()
+
+    def reset(self):
+        if self.file: self.file.close()
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.head = ""; self.tail = ""; self.head_done = False
+        self.parts = []
+        self.started_at = time.time(); self.first_byte_sec = None
+
+    def _emit(self, text: str):
+        if text:
+            self.file.write(text); self.file.flush()
+            self.parts.append(text)
+
+    def write(self, text: str):
+        if self.first_byte_sec is None and text:
+            self.first_byte_sec = round(time.time() - self.started_at, 2)
+        if not self.head_done:
+            self.head = (self.head + text).lstrip()
+            if len(self.head) < len("```html") and "```html".startswith(self.head):
+                return # Could still be the opening fence
+            text = self.head[len("```html"):].lstrip() if self.head.startswith("```html") else self.head
+            self.head_done = bool(text) # Whitespace after the fence is dropped like the final strip() would
+            if not self.head_done:
+                self.head = "```html" # Fence seen, keep skipping leading whitespace
+                return
+        pending = self.tail + text
+        body = pending.rstrip(" \t\r\n`")
+        self._emit(body)
+        self.tail = pending[len(body):]
+
+    def close(self) -> str:
+        """Flushes the held-back tail and returns the cleaned HTML that was written."""
+        if not self.head_done and self.head != "```html":
+            self._emit(self.head.strip())
+        tail = self.tail.rstrip()
+        if tail.endswith("```"): tail = tail[:-3]
+        self._emit(tail.rstrip())
+        self.file.close()
+        return "".join(self.parts)
+
+    def discard(self):
+        if self.file: self.file.close()
+        self.path.unlink(missing_ok=True)
+
+HTML_POSTPROCESS = os.getenv('HTML_POSTPROCESS', 'true').lower() == 'true' # Shared stylesheets and minified markup before conversion
+STYLE_BLOCK_RE = re.compile(r"<style\b([^>]*)>(.*?)</style\s*>", re.IGNORECASE | re.DOTALL)
+MEDIA_ATTRIBUTE_RE = re.compile(r"""\bmedia\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.IGNORECASE)
+HTML_COMMENT_RE = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL) # Conditional comments are kept
+WHITESPACE_SENSITIVE_RE = re.compile(r"<(?:pre|textarea|script)\b", re.IGNORECASE)
+# Whitespace next to these tags never renders, so it can go; between inline elements it is collapsed to one space
+BLOCK_TAG_RE = re.compile(r"</?(?:html|head|body|meta|link|title|style|div|p|table|thead|tbody|tfoot|tr|td|th|caption|colgroup|col|"
+                          r"ul|ol|li|h[1-6]|br|hr|section|header|footer)\b", re.IGNORECASE)
+
+def minify_css(css: str) -> str:
+    """Drops comments and redundant whitespace, so equivalent style blocks normalize to the same text."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+def minify_html(html: str) -> str:
+    """Removes comments and whitespace that does not render; documents with pre/textarea/script keep their whitespace."""
+    html = HTML_COMMENT_RE.sub("", html)
+    if WHITESPACE_SENSITIVE_RE.search(html):
+        return html.strip()
+    parts = re.split(r"(<[^>]+>)", html)
+    for index in range(0, len(parts), 2): # Even indexes are the text between tags
+        text = re.sub(r"\s+", " ", parts[index])
+        if text == " " and (index == 0 or index == len(parts) - 1 or BLOCK_TAG_RE.match(parts[index - 1]) or BLOCK_TAG_RE.match(parts[index + 1])):
+            text = ""
+        parts[index] = text
+    return "".join(parts).strip()
+
+class SharedStylesheets:
+    """Moves each generated page's <style> blocks into a per-job stylesheet file shared by every page with the same CSS.
+
+    The HTML prompt asks for self-contained pages, so every page repeats a near-identical style block. Blocks are
+    minified and hashed, pages with the same normalized CSS link one file (written next to the pages, which
+    wkhtmltopdf may read with enable-local-file-access), and the markup itself is minified.
+    """
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.stylesheets = set()
+        self.stats = {"pages": 0, "bytes_before": 0, "bytes_after": 0}
+
+    @staticmethod
+    def block_css(attributes: str, css: str) -> str:
+        """A style block's minified rules; a media attribute becomes an @media rule so it still applies from the shared file."""
+        css = minify_css(css)
+        media_match = MEDIA_ATTRIBUTE_RE.search(attributes)
+        media = " ".join(next((group for group in media_match.groups() if group is not None), "").split()) if media_match else ""
+        if css and media and media.lower() != "all":
+            return f"@media {media}{{{css}}}"
+        return css
+
+    def process(self, html: str) -> str:
+        """Returns the page with its CSS linked from the shared stylesheet and its markup minified."""
+        css = "".join(self.block_css(attributes, block) for attributes, block in STYLE_BLOCK_RE.findall(html))
+        if css:
+            stylesheet_name = f"styles_{hashlib.sha256(css.encode('utf-8')).hexdigest()[:16]}.css"
+            with self.lock:
+                if stylesheet_name not in self.stylesheets:
+                    (self.folder / stylesheet_name).write_text(css, encoding="utf-8")
+                    self.stylesheets.add(stylesheet_name)
+            link = f'<link rel="stylesheet" href="{stylesheet_name}">'
+            first_block = STYLE_BLOCK_RE.search(html)
+            html_without_styles = STYLE_BLOCK_RE.sub("", html[first_block.end():])
+            html = html[:first_block.start()] + link + html_without_styles
+        return minify_html(html)
+
+    def process_file(self, html_path: Path) -> Dict:
+        """Rewrites a saved page in place; returns its size before and after."""
+        html = html_path.read_text(encoding="utf-8")
+        processed = self.process(html)
+        html_path.write_text(processed, encoding="utf-8")
+        sizes = {"bytes_before": len(html.encode("utf-8")), "bytes_after": len(processed.encode("utf-8"))}
+        with self.lock:
+            self.stats["pages"] += 1
+            for key, size in sizes.items(): self.stats[key] += size
+        return sizes
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {**self.stats, "stylesheets": len(self.stylesheets)}
+
+def extract_full_page_html_from_image(image: Union[str, Image.Image], ocr_text: str, image_name: Optional[str] = None,
+                                      bypass_cache: bool = False, output_path: Optional[Path] = None,
+                                      payload_options: Optional[Dict] = None) -> Dict:
+    """Generates full-page HTML from a page image, given either as a file path or as an in-memory PIL image.
+
+    With `output_path` the response is streamed and written there, already cleaned, as chunks arrive; the file
+    is removed again if generation fails or yields nothing. `payload_options` overrides the optimize_image_payload
+    settings used to encode the image.
+    """
+    start_time = time.time()
+    result = {"html": "", "response_time": 0, "error": None, "cache_hit": False, "output_path": None, "ttfb_sec": None, "payload": None}
+    payload_options = {"max_edge": LLM_IMAGE_MAX_EDGE, "image_format": LLM_IMAGE_FORMAT, "quality": LLM_IMAGE_QUALITY,
+                       "crop": LLM_IMAGE_CROP, **(payload_options or {})}
     img_pil = None # Initialize for finally block
-    if not GEMINI_API_KEY:
-        result["error"] = "GEMINI_API_KEY not configured."
+    image_path = str(image) if isinstance(image, (str, Path)) else None
+    image_name = image_name or (Path(image_path).name if image_path else "in-memory page image")
+    result["error"] = llm_backend.configuration_error()
+    if result["error"]:
         log_error("Full Page HTML Gen", ValueError(result["error"]), {})
         return result
-    app.logger.info(f"Generating full-page HTML for image: {Path(image_path).name} using '{model_name}'")
+    app.logger.info(f"Generating full-page HTML for image: {image_name} using '{llm_backend.model_id}' ({llm_backend.name} backend)")
     try:
         try:
-            img_pil = Image.open(image_path)
+            img_pil = Image.open(image_path) if image_path else image
             if img_pil.mode != 'RGB': img_pil = img_pil.convert('RGB') # Gemini prefers RGB
         except FileNotFoundError:
              result["error"] = f"Image file not found at path: {image_path}"
              log_error("Full Page HTML Image Load Error", FileNotFoundError(result["error"]), {"image_path": image_path})
              return result
         except Exception as img_err:
-             result["error"] = f"Error opening/converting image file {image_path}: {img_err}"
-             log_error("Full Page HTML Image Load Error", img_err, {"image_path": image_path})
+             result["error"] = f"Error opening/converting image {image_name}: {img_err}"
+             log_error("Full Page HTML Image Load Error", img_err, {"image_name": image_name})
              return result
 
         prompt_text = HTML_FROM_IMAGE_PROMPT_TEMPLATE.format(
-            image_reference=f"the provided image ({Path(image_path).name})",
+            image_reference=f"the provided image ({image_name})",
             ocr_page_text=ocr_text
         )
-        model_instance = genai.GenerativeModel(model_name)
-        app.logger.info(f"Sending image ({img_pil.width}x{img_pil.height}) and text ({len(prompt_text)} chars) to Gemini...")
-        response = model_instance.generate_content([prompt_text, img_pil], stream=False)
+        cache_key = llm_cache_key("extractFullPageHTML", HTML_FROM_IMAGE_PROMPT_TEMPLATE, {}, ocr_text, image_fingerprint(img_pil),
+                                  image_payload_signature(payload_options)) if llm_cache else None
+        cached = llm_cache.get(cache_key) if llm_cache and not bypass_cache else None
+        if cached is not None:
+            result.update({"html": cached["html"], "cache_hit": True, "response_time": round(time.time() - start_time, 2)})
+            app.logger.info(f"Using cached HTML ({len(result['html'])} chars) for {image_name}.")
+            return result
+        image_blob, result["payload"] = optimize_image_payload(img_pil, **payload_options)
+        log_component("llmImagePayload", {"image_name": image_name, "stage": "extractFullPageHTML", **result["payload"]})
+        app.logger.info(f"Sending image ({result['payload']['sent_size'][0]}x{result['payload']['sent_size'][1]}, {result['payload']['bytes']} bytes) and text ({len(prompt_text)} chars) to Gemini...")
+        if output_path:
+            writer = HTMLStreamWriter(output_path)
+            try:
+                response = get_llm_client().stream_content("html", [prompt_text, image_blob], writer, HTML_STREAM_IDLE_TIMEOUT_SEC,
+                                                           label=f"Gemini HTML stream {image_name}")
+                record_llm_usage("extractFullPageHTML", response)
+                html_code = writer.close()
+            except BaseException:
+                writer.discard()
+                raise
+            result.update({"response_time": round(time.time() - start_time, 2), "ttfb_sec": writer.first_byte_sec})
+            if not html_code:
+                writer.discard()
+                finish_reason = response.prompt_feedback.block_reason if response.prompt_feedback else 'Unknown'
+                if finish_reason: # Blocked prompt rather than an empty page
+                    result["error"] = f"Gemini response empty/blocked. Finish Reason: {finish_reason}"
+                    log_error("Full Page HTML Generation Error", ValueError(result["error"]), {"image_name": image_name, "finish_reason": finish_reason})
+                    return result
+                app.logger.warning(f"Full page HTML generation resulted in empty content for {image_name}.")
+                log_component("extractFullPageHTML_EmptyResult", {"image_name": image_name})
+                return result
+            result.update({"html": html_code, "output_path": str(output_path)})
+            app.logger.info(f"Streamed {len(html_code)} chars of HTML for {image_name} (TTFB: {writer.first_byte_sec}s).")
+            if llm_cache: llm_cache.put(cache_key, {"html": html_code})
+            return result
+        response = get_llm_client().generate_content("html", [prompt_text, image_blob], label=f"Gemini HTML {image_name}")
+        record_llm_usage("extractFullPageHTML", response)
         result["response_time"] = round(time.time() - start_time, 2)
 
         if not response.candidates or not response.candidates[0].content.parts:
              finish_reason = response.prompt_feedback.block_reason if response.prompt_feedback else 'Unknown'
              safety_ratings = response.prompt_feedback.safety_ratings if response.prompt_feedback else 'N/A'
              error_msg = f"Gemini response empty/blocked. Finish Reason: {finish_reason}, Safety: {safety_ratings}"
-             log_error("Full Page HTML Generation Error", ValueError(error_msg), {"image_path": image_path, "finish_reason": finish_reason})
+             log_error("Full Page HTML Generation Error", ValueError(error_msg), {"image_name": image_name, "finish_reason": finish_reason})
              result["error"] = error_msg
              try: result["html"] = response.text # Store partial if available
              except ValueError: pass
@@ -634,13 +1799,14 @@ def extract_full_page_html_from_image(image_path: str, ocr_text: str) -> Dict:
         html_code = response.text.strip()
         result["html"] = html_code
         if not html_code:
-            app.logger.warning(f"Full page HTML generation resulted in empty content for {Path(image_path).name}.")
-            log_component("extractFullPageHTML_EmptyResult", {"image_path": image_path})
+            app.logger.warning(f"Full page HTML generation resulted in empty content for {image_name}.")
+            log_component("extractFullPageHTML_EmptyResult", {"image_name": image_name})
         else:
-            app.logger.info(f"Successfully generated {len(html_code)} chars of HTML for {Path(image_path).name}.")
+            app.logger.info(f"Successfully generated {len(html_code)} chars of HTML for {image_name}.")
+            if llm_cache: llm_cache.put(cache_key, {"html": html_code})
         return result
     except Exception as e:
-        log_error("Full Page HTML Generation Pipeline Error", e, {"image_path": image_path})
+        log_error("Full Page HTML Generation Pipeline Error", e, {"image_name": image_name})
         result["error"] = str(e)
         result["response_time"] = round(time.time() - start_time, 2)
         if 'response' in locals() and hasattr(response, 'text'): # Check if response object exists
@@ -648,11 +1814,56 @@ def extract_full_page_html_from_image(image_path: str, ocr_text: str) -> Dict:
              except ValueError: pass
         return result
     finally:
-        if img_pil:
+        if img_pil and img_pil is not image: # Only close images opened or converted here; callers own theirs
             try: img_pil.close()
             except Exception as close_err: app.logger.warning(f"Error closing PIL image: {close_err}")
 
 
+DETECTION_MODE = os.getenv('DETECTION_MODE', 'two_step').lower() # "two_step" or "combined"
+DETECTION_MODES = ("two_step", "combined")
+
+def detect_table_and_extract_html(image: Image.Image, ocr_text: str, image_name: str = "in-memory page image",
+                                  bypass_cache: bool = False, payload_options: Optional[Dict] = None) -> Dict:
+    """Single-call detection and HTML generation from the page image and its OCR text.
+
+    Returns a detect_table-style result whose "html" holds the generated page when a table was found.
+    """
+    start_time = time.time()
+    result = {"response": {}, "html": "", "response_time": 0, "error": None, "cache_hit": False, "payload": None}
+    payload_options = {"max_edge": LLM_IMAGE_MAX_EDGE, "image_format": LLM_IMAGE_FORMAT, "quality": LLM_IMAGE_QUALITY,
+                       "crop": LLM_IMAGE_CROP, **(payload_options or {})}
+    try:
+        prompt = wrap_prompt(DETECT_AND_RENDER_PROMPT_TEMPLATE, {"image_reference": f"the provided image ({image_name})", "ocr_page_text": ocr_text})
+        cache_key = llm_cache_key("detectAndRender", DETECT_AND_RENDER_PROMPT_TEMPLATE, JSON_GENERATION_CONFIG, ocr_text, image_fingerprint(image),
+                                  image_payload_signature(payload_options)) if llm_cache else None
+        parsed_data = llm_cache.get(cache_key) if llm_cache and not bypass_cache else None
+        result["cache_hit"] = parsed_data is not None
+        if parsed_data is None:
+            image_blob, result["payload"] = optimize_image_payload(image, **payload_options)
+            log_component("llmImagePayload", {"image_name": image_name, "stage": "detectAndRender", **result["payload"]})
+            parsed_data = call_gemini_for_json(prompt, images=[image_blob], usage_stage="detectAndRender")
+        result["response_time"] = round(time.time() - start_time, 2)
+        if "error" in parsed_data:
+            result["error"] = parsed_data["error"]
+            result["response"] = parsed_data
+            return result
+        html_code = parsed_data.get("html")
+        if not validate_table_detection_response(parsed_data) or not isinstance(html_code, str):
+            validation_error_msg = "Parsed detect-and-render response has invalid format or values."
+            log_error("Detect And Render Validation", ValueError(validation_error_msg), {"keys": list(parsed_data), "image_name": image_name})
+            result["error"] = validation_error_msg
+            return result
+        result["response"] = {"tableDetected": parsed_data["tableDetected"], "confidenceScore": parsed_data["confidenceScore"]}
+        result["html"] = html_code.strip() if parsed_data["tableDetected"] else ""
+        if llm_cache and not result["cache_hit"]: llm_cache.put(cache_key, parsed_data)
+        return result
+    except Exception as e:
+        log_error("Detect And Render Pipeline Error", e, {"image_name": image_name})
+        result["error"] = str(e)
+        result["response_time"] = round(time.time() - start_time, 2)
+        return result
+
+
 # --- System Dependency Check ---
 def check_system_dependencies():
     dependencies_ok = True
@@ -704,26 +1915,362 @@ def check_system_dependencies():
 
 
 # --- PDF/Image Handling ---
-def save_pdf_page(reader, page_num: int, output_path: Path):
-    """Saves individual PDF page to file using PyPDF2."""
-    writer = PdfWriter()
-    num_pages_total = len(reader.pages)
-    if not (0 <= page_num < num_pages_total):
-        raise IndexError(f"Page number {page_num} is out of range for PDF with {num_pages_total} pages.")
+RENDER_DPI_OCR = int(os.getenv('RENDER_DPI_OCR', '200')) # Tier used for Tesseract and table detection
+RENDER_DPI_HTML = int(os.getenv('RENDER_DPI_HTML', '300')) # Tier sent to Gemini for HTML generation
+TIERED_RENDERING = os.getenv('TIERED_RENDERING', 'true').lower() == 'true'
+RENDER_BATCH_SIZE = int(os.getenv('RENDER_BATCH_SIZE', '8')) # 0 renders the whole document in one poppler pass
+RENDER_THREAD_COUNT = int(os.getenv('RENDER_THREAD_COUNT', '2'))
+KEEP_ARTIFACTS = os.getenv('KEEP_ARTIFACTS', 'false').lower() == 'true' # Write page PNGs to the temp dir for debugging
+
+def save_page_artifact(image: Image.Image, artifact_folder: Optional[Path], file_name: str):
+    """Writes a rendered page image to disk when keep-artifacts is on; a no-op otherwise."""
+    if artifact_folder is None:
+        return
     try:
-        writer.add_page(reader.pages[page_num])
-        with open(output_path, 'wb') as output_file:
-            writer.write(output_file)
+        image.save(artifact_folder / file_name)
     except Exception as e:
-         log_error("Save PDF Page Error", e, {"page_index": page_num, "output_path": str(output_path)})
-         raise RuntimeError(f"Failed to save page {page_num+1} to {output_path}") from e
+        log_error("Save Page Artifact Error", e, {"file_name": file_name})
+
+def render_pdf_pages(pdf_path: Path, page_numbers: List[int], dpi: int = RENDER_DPI_OCR, batch_size: int = RENDER_BATCH_SIZE,
+                     artifact_folder: Optional[Path] = None) -> Iterator[Tuple[int, Optional[Image.Image], Optional[str]]]:
+    """Rasterizes the given pages of the original PDF in page-range batches, yielding (page_num, image, error) as each batch lands.
+
+    Consecutive page numbers are grouped into one pdftoppm range. Pages are read from its PPM output
+    straight into memory; nothing touches disk unless an artifact folder is given.
+    """
+    batch_size = batch_size if batch_size > 0 else len(page_numbers)
+    page_ranges = []
+    for page_num in sorted(page_numbers):
+        if page_ranges and page_num == page_ranges[-1][1] + 1 and page_num - page_ranges[-1][0] < batch_size:
+            page_ranges[-1][1] = page_num
+        else:
+            page_ranges.append([page_num, page_num])
+    for first_page, last_page in page_ranges:
+        start_time = time.time()
+        try:
+            images = convert_from_path(
+                str(pdf_path), dpi=dpi, first_page=first_page, last_page=last_page, thread_count=RENDER_THREAD_COUNT
+            )
+            if len(images) != last_page - first_page + 1:
+                raise RuntimeError(f"pdftoppm produced {len(images)} images for pages {first_page}-{last_page}")
+        except Exception as render_err:
+            log_error("Render Batch Error", render_err, {"pdf_path": str(pdf_path), "first_page": first_page, "last_page": last_page})
+            for page_num in range(first_page, last_page + 1):
+                yield page_num, None, f"Failed to convert page {page_num} to image: {render_err}"
+            continue
+        log_component("RenderBatch", {"first_page": first_page, "last_page": last_page, "dpi": dpi,
+                                      "duration_sec": round(time.time() - start_time, 2)})
+        for page_num, image in zip(range(first_page, last_page + 1), images):
+            save_page_artifact(image, artifact_folder, f"page_{page_num}.png")
+            yield page_num, image, None
+
+def render_pdf_page(pdf_path: Path, page_num: int, dpi: int, artifact_folder: Optional[Path] = None) -> Image.Image:
+    """Renders a single page of the original PDF, used to produce the high-resolution tier on demand."""
+    start_time = time.time()
+    images = convert_from_path(str(pdf_path), dpi=dpi, first_page=page_num, last_page=page_num, thread_count=1)
+    if not images:
+        raise RuntimeError(f"pdftoppm produced no image for page {page_num} at {dpi} DPI")
+    log_component("RenderPage", {"page": page_num, "dpi": dpi, "duration_sec": round(time.time() - start_time, 2)})
+    save_page_artifact(images[0], artifact_folder, f"page_{page_num}_dpi{dpi}.png")
+    return images[0]
+
+
+# --- Image Preprocessing ---
+PREPROCESS_STEPS = tuple(step.strip() for step in os.getenv('PREPROCESS_STEPS', 'grayscale,deskew,downscale').split(',') if step.strip())
+PREPROCESS_TARGET_XHEIGHT = int(os.getenv('PREPROCESS_TARGET_XHEIGHT', '20')) # Pixels; Tesseract is most accurate around 20-30
+PREPROCESS_MAX_SKEW_DEG = float(os.getenv('PREPROCESS_MAX_SKEW_DEG', '5'))
+PREPROCESS_THRESHOLD_WINDOW = int(os.getenv('PREPROCESS_THRESHOLD_WINDOW', '31'))
+PREPROCESS_THRESHOLD_OFFSET = int(os.getenv('PREPROCESS_THRESHOLD_OFFSET', '10'))
+PREPROCESS_STEP_NAMES = ("grayscale", "deskew", "downscale", "threshold")
+
+def to_grayscale(image: Image.Image) -> np.ndarray:
+    if image.mode == 'L':
+        return np.asarray(image)
+    rgb = np.asarray(image.convert('RGB'), dtype=np.uint32)
+    return ((rgb[..., 0] * 299 + rgb[..., 1] * 587 + rgb[..., 2] * 114) // 1000).astype(np.uint8)
+
+def estimate_skew_angle(gray: np.ndarray, max_angle: float = PREPROCESS_MAX_SKEW_DEG, step: float = 0.25) -> float:
+    """Finds the shear angle that makes the horizontal ink profile sharpest (text lines line up with pixel rows)."""
+    stride = max(1, gray.shape[1] // 800) # A ~800px wide sample is plenty for the angle
+    ys, xs = np.nonzero(gray[::stride, ::stride] < 128)
+    if len(ys) < 100:
+        return 0.0
+    angles = np.arange(-max_angle, max_angle + step / 2, step)
+    best_angle, best_score = 0.0, -1.0
+    for angle in angles:
+        rows = np.round(ys - xs * np.tan(np.radians(angle))).astype(np.int64)
+        profile = np.bincount(rows - rows.min())
+        score = float(np.var(profile))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+def estimate_x_height(gray: np.ndarray) -> Optional[float]:
+    """Approximates the x-height from the median text-line height in the horizontal ink profile."""
+    ink_rows = (gray < 128).sum(axis=1) > max(2, gray.shape[1] // 200)
+    edges = np.diff(np.concatenate(([0], ink_rows.astype(np.int8), [0])))
+    starts, ends = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+    heights = ends - starts
+    heights = heights[heights >= 4]
+    if len(heights) < 3:
+        return None
+    # A text line's ink band spans ascenders to descenders, roughly twice the x-height
+    return float(np.median(heights)) / 2
+
+def adaptive_threshold(gray: np.ndarray, window: int = PREPROCESS_THRESHOLD_WINDOW, offset: int = PREPROCESS_THRESHOLD_OFFSET) -> np.ndarray:
+    """Local-mean binarization using an integral image, so the cost does not depend on the window size."""
+    half = window // 2
+    padded = np.pad(gray.astype(np.int64), half + 1, mode='edge')
+    integral = padded.cumsum(axis=0).cumsum(axis=1)
+    h, w = gray.shape
+    window_sums = (integral[window:window + h, window:window + w] - integral[:h, window:window + w]
+                   - integral[window:window + h, :w] + integral[:h, :w])
+    local_mean = window_sums / (window * window)
+    return np.where(gray.astype(np.int64) > local_mean - offset, 255, 0).astype(np.uint8)
+
+def preprocess_for_ocr(image: Image.Image, steps: Tuple[str, ...] = PREPROCESS_STEPS,
+                       target_x_height: int = PREPROCESS_TARGET_XHEIGHT) -> Tuple[Image.Image, Dict]:
+    """Applies the enabled preprocessing steps in a fixed order and returns the image with per-step timings.
+
+    The returned info carries the scale factor so word boxes can be mapped back to the rendered page.
+    """
+    info = {"timings": {}, "scale": 1.0, "skew_deg": 0.0}
+    if not steps:
+        return image, info
+    start_time = time.time()
+    gray = to_grayscale(image) # Every later step works on the luminance array
+    processed = Image.fromarray(gray) if "grayscale" in steps else image
+    if "grayscale" in steps: info["timings"]["grayscale"] = round(time.time() - start_time, 3)
+    if "deskew" in steps:
+        start_time = time.time()
+        angle = estimate_skew_angle(gray)
+        if abs(angle) >= 0.25:
+            fill = 255 if processed.mode == 'L' else (255, 255, 255)
+            processed = processed.rotate(angle, resample=Image.BILINEAR, fillcolor=fill)
+            gray = to_grayscale(processed)
+        info["skew_deg"] = angle
+        info["timings"]["deskew"] = round(time.time() - start_time, 3)
+    if "downscale" in steps:
+        start_time = time.time()
+        x_height = estimate_x_height(gray)
+        if x_height and x_height > target_x_height * 1.2: # Only shrink; upscaling adds no detail
+            info["scale"] = round(target_x_height / x_height, 3)
+            new_size = (max(1, int(processed.width * info["scale"])), max(1, int(processed.height * info["scale"])))
+            processed = processed.resize(new_size, resample=Image.LANCZOS, reducing_gap=2.0)
+            gray = to_grayscale(processed)
+        info["x_height_px"] = x_height
+        info["timings"]["downscale"] = round(time.time() - start_time, 3)
+    if "threshold" in steps:
+        start_time = time.time()
+        processed = Image.fromarray(adaptive_threshold(gray))
+        info["timings"]["threshold"] = round(time.time() - start_time, 3)
+    return processed, info
+
+
+# --- OCR Stage ---
+try:
+    import tesserocr # Optional: lets each worker keep the Tesseract engine loaded between pages
+except ImportError:
+    tesserocr = None
+
+OCR_LANG = os.getenv('OCR_LANG', 'eng')
+OCR_PSM = int(os.getenv('OCR_PSM', '3'))
+OCR_OEM = int(os.getenv('OCR_OEM', '3'))
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', str(min(4, os.cpu_count() or 1))))
+OCR_THREADS_PER_WORKER = int(os.getenv('OCR_THREADS_PER_WORKER', '1')) # Pinned so concurrent pages don't oversubscribe cores
+OCR_TIMEOUT = int(os.getenv('OCR_TIMEOUT', '60')) # Per page, enforced by the worker on its own run so queueing behind other pages doesn't count
+OCR_TIMEOUT_GRACE_SEC = 30 # Extra wait in the caller before giving up on a worker that stopped answering
+
+ocr_pool = None
+ocr_pool_lock = threading.Lock()
+ocr_worker_apis = {} # Per worker process: (lang, oem) -> loaded tesserocr API
+
+def init_ocr_worker(threads_per_worker: int):
+    # Read by Tesseract's OpenMP runtime, both in-process (tesserocr) and in CLI subprocesses (pytesseract)
+    os.environ['OMP_THREAD_LIMIT'] = str(threads_per_worker)
+
+def words_to_text(words: List[Dict]) -> str:
+    """Rebuilds plain text from word-level OCR output, one line per OCR text line."""
+    lines = {}
+    for word in words:
+        lines.setdefault(word["line"], []).append(word["text"])
+    return "\n".join(" ".join(line_words) for line_words in lines.values())
+
+def ocr_worker_run(image: Image.Image, lang: str, psm: int, oem: int, preprocess_steps: Tuple[str, ...] = PREPROCESS_STEPS,
+                   target_x_height: int = PREPROCESS_TARGET_XHEIGHT, timeout: float = OCR_TIMEOUT) -> Dict:
+    """Preprocesses the page and runs one recognition pass in an OCR worker, returning both the plain text and the word boxes."""
+    deadline = time.monotonic() + timeout # Starts when a worker picks the page up, not when it was submitted
+    try:
+        processed, preprocess_info = preprocess_for_ocr(image, preprocess_steps, target_x_height)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: raise TimeoutError(f"OCR timed out after {timeout}s (during preprocessing)")
+        result = ocr_worker_recognize(processed, lang, psm, oem, remaining)
+    except TimeoutError:
+        raise
+    except Exception as e:
+        # Some pytesseract exceptions cannot be unpickled in the parent, which would break the whole pool
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    if preprocess_info["scale"] != 1.0: # Map word boxes back onto the rendered page
+        for word in result["words"]:
+            for key in ("left", "top", "width", "height"):
+                word[key] = int(round(word[key] / preprocess_info["scale"]))
+    result["image_size"] = image.size
+    result["preprocess"] = preprocess_info
+    return result
+
+def ocr_worker_recognize(image: Image.Image, lang: str, psm: int, oem: int, timeout: float = OCR_TIMEOUT) -> Dict:
+    start_time = time.time()
+    words = []
+    if tesserocr is not None:
+        api = ocr_worker_apis.get((lang, oem))
+        if api is None:
+            api = ocr_worker_apis[(lang, oem)] = tesserocr.PyTessBaseAPI(lang=lang, oem=oem)
+        api.SetPageSegMode(psm)
+        api.SetImage(image)
+        if not api.Recognize(timeout=max(1, int(timeout * 1000))): # Milliseconds; False when Tesseract gave up
+            raise TimeoutError(f"OCR timed out after {timeout:.0f}s")
+        line_index = -1
+        iterator = api.GetIterator()
+        for word in tesserocr.iterate_level(iterator, tesserocr.RIL.WORD):
+            text = word.GetUTF8Text(tesserocr.RIL.WORD)
+            if not text: continue
+            if word.IsAtBeginningOf(tesserocr.RIL.TEXTLINE): line_index += 1
+            left, top, right, bottom = word.BoundingBox(tesserocr.RIL.WORD)
+            words.append({"text": text, "left": left, "top": top, "width": right - left, "height": bottom - top,
+                          "conf": round(word.Confidence(tesserocr.RIL.WORD), 1), "line": max(line_index, 0)})
+        text = api.GetUTF8Text()
+    else:
+        try:
+            data = pytesseract.image_to_data(image, lang=lang, config=f"--psm {psm} --oem {oem}",
+                                             output_type=pytesseract.Output.DICT, timeout=timeout)
+        except RuntimeError as e: # pytesseract kills the CLI and reports the timeout as a RuntimeError
+            if "timeout" in str(e).lower(): raise TimeoutError(f"OCR timed out after {timeout:.0f}s") from None
+            raise
+        for i, word_text in enumerate(data["text"]):
+            if not word_text.strip(): continue
+            words.append({"text": word_text, "left": data["left"][i], "top": data["top"][i], "width": data["width"][i],
+                          "height": data["height"][i], "conf": float(data["conf"][i]),
+                          "line": f"{data['block_num'][i]}.{data['par_num'][i]}.{data['line_num'][i]}"})
+        text = words_to_text(words)
+    return {"text": text.strip(), "words": words, "duration_sec": round(time.time() - start_time, 2)}
+
+def get_ocr_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Returns the process-wide OCR worker pool, starting it on first use."""
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is None:
+            # forkserver avoids forking the threaded web process; workers outlive individual jobs
+            ocr_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=OCR_WORKERS, mp_context=multiprocessing.get_context('forkserver'),
+                initializer=init_ocr_worker, initargs=(OCR_THREADS_PER_WORKER,)
+            )
+            app.logger.info(f"Started OCR pool: {OCR_WORKERS} workers x {OCR_THREADS_PER_WORKER} thread(s), engine: {'tesserocr' if tesserocr else 'tesseract CLI'}")
+        return ocr_pool
+
+OCR_CACHE_ENABLED = os.getenv('OCR_CACHE_ENABLED', 'true').lower() == 'true'
+OCR_CACHE_DIR = os.getenv('OCR_CACHE_DIR', 'cache/ocr')
+OCR_CACHE_MAX_MB = int(os.getenv('OCR_CACHE_MAX_MB', '512'))
+ocr_cache = None
+if OCR_CACHE_ENABLED:
+    try:
+        ocr_cache = DiskCache(Path(OCR_CACHE_DIR), OCR_CACHE_MAX_MB * 1024 * 1024, "ocr")
+    except OSError as e:
+        app.logger.error(f"Failed to initialize OCR cache at '{OCR_CACHE_DIR}': {e}")
+
+def ocr_cache_key(image: Image.Image, lang: str, psm: int, oem: int, preprocess_steps: Tuple[str, ...] = PREPROCESS_STEPS,
+                  target_x_height: int = PREPROCESS_TARGET_XHEIGHT) -> str:
+    """Hashes the rendered pixels together with every setting that changes the OCR output."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"ocr-v1|{image.mode}|{image.size}|{lang}|{psm}|{oem}|{'tesserocr' if tesserocr else 'cli'}".encode())
+    digest.update(f"|{','.join(preprocess_steps)}|{target_x_height}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def run_ocr(image: Image.Image, lang: str = OCR_LANG, psm: int = OCR_PSM, oem: int = OCR_OEM,
+            preprocess_steps: Tuple[str, ...] = PREPROCESS_STEPS, target_x_height: int = PREPROCESS_TARGET_XHEIGHT) -> Dict:
+    """OCRs a page image on the worker pool; returns {"text", "words", "image_size", "duration_sec"}."""
+    future = get_ocr_pool().submit(ocr_worker_run, image, lang, psm, oem, preprocess_steps, target_x_height, OCR_TIMEOUT)
+    # The worker enforces OCR_TIMEOUT itself; this wait only guards against a worker that stopped answering,
+    # and its clock starts once the page leaves the queue
+    running_since = None
+    while True:
+        try:
+            return future.result(timeout=1)
+        except concurrent.futures.TimeoutError:
+            if running_since is None:
+                if future.running(): running_since = time.monotonic()
+            elif time.monotonic() - running_since > OCR_TIMEOUT + OCR_TIMEOUT_GRACE_SEC:
+                future.cancel()
+                raise TimeoutError(f"OCR worker did not answer within {OCR_TIMEOUT + OCR_TIMEOUT_GRACE_SEC}s")
+
+
+# --- Text Layer Fast Path ---
+TEXT_LAYER_FAST_PATH = os.getenv('TEXT_LAYER_FAST_PATH', 'true').lower() == 'true'
+TEXT_LAYER_MIN_CHARS = int(os.getenv('TEXT_LAYER_MIN_CHARS', '200'))
+TEXT_LAYER_MIN_PRINTABLE_RATIO = float(os.getenv('TEXT_LAYER_MIN_PRINTABLE_RATIO', '0.97'))
+TEXT_LAYER_MIN_ALNUM_RATIO = float(os.getenv('TEXT_LAYER_MIN_ALNUM_RATIO', '0.4')) # Catches fonts without a usable ToUnicode map
+
+def assess_text_layer(text: str, min_chars: int = TEXT_LAYER_MIN_CHARS, min_printable_ratio: float = TEXT_LAYER_MIN_PRINTABLE_RATIO,
+                      min_alnum_ratio: float = TEXT_LAYER_MIN_ALNUM_RATIO) -> Dict:
+    """Decides whether an embedded text layer is good enough to stand in for OCR."""
+    visible_chars = [c for c in text if not c.isspace()]
+    num_visible = len(visible_chars)
+    printable_ratio = sum(1 for c in visible_chars if c.isprintable() and c != '\ufffd') / num_visible if num_visible else 0.0
+    alnum_ratio = sum(1 for c in visible_chars if c.isalnum()) / num_visible if num_visible else 0.0
+    usable = num_visible >= min_chars and printable_ratio >= min_printable_ratio and alnum_ratio >= min_alnum_ratio
+    return {"usable": usable, "chars": num_visible, "printable_ratio": round(printable_ratio, 3), "alnum_ratio": round(alnum_ratio, 3)}
+
+
+# --- Pipeline Options ---
+# Page threads mostly wait on the OCR pool and Gemini, so this can exceed the core count
+PAGE_WORKERS = int(os.getenv('PAGE_WORKERS', str(min(4, os.cpu_count() or 1))))
+PIPELINED_MERGE = os.getenv('PIPELINED_MERGE', 'true').lower() == 'true' # Convert and merge pages while later pages are still processing
+PAGE_DEADLINE_SEC = float(os.getenv('PAGE_DEADLINE_SEC', '300')) # LLM time budget per page; 0 disables
+PIPELINE_WINDOW_SIZE = int(os.getenv('PIPELINE_WINDOW_SIZE', '16')) # Max pages in flight; 0 submits every page at once
+# Defaults for a processing job; callers override any of them per job via the `options` argument.
+PIPELINE_DEFAULTS = {
+    "tiered_rendering": TIERED_RENDERING,
+    "ocr_dpi": RENDER_DPI_OCR,
+    "html_dpi": RENDER_DPI_HTML,
+    "keep_artifacts": KEEP_ARTIFACTS,
+    "text_layer_fast_path": TEXT_LAYER_FAST_PATH,
+    "local_table_classifier": LOCAL_TABLE_CLASSIFIER,
+    "window_size": PIPELINE_WINDOW_SIZE,
+    "ocr_lang": OCR_LANG,
+    "ocr_psm": OCR_PSM,
+    "ocr_oem": OCR_OEM,
+    "preprocess_steps": PREPROCESS_STEPS,
+    "preprocess_target_x_height": PREPROCESS_TARGET_XHEIGHT,
+    "llm_cache_bypass": False,
+    "detection_batching": DETECTION_BATCHING,
+    "html_streaming": HTML_STREAMING,
+    "llm_image_max_edge": LLM_IMAGE_MAX_EDGE,
+    "llm_image_format": LLM_IMAGE_FORMAT,
+    "llm_image_quality": LLM_IMAGE_QUALITY,
+    "llm_image_crop": LLM_IMAGE_CROP,
+    "detection_mode": DETECTION_MODE, # "combined" suits table-heavy documents: one LLM round trip per page
+    "detection_compaction": DETECTION_COMPACTION,
+    "detection_max_tokens": DETECTION_MAX_TOKENS,
+    "pipelined_merge": PIPELINED_MERGE,
+    "page_deadline_sec": PAGE_DEADLINE_SEC, # Pages past their deadline keep the original page in the merged PDF
+    "user_id": None, # Attributes the job's LLM token usage to a user
+    "html_postprocess": HTML_POSTPROCESS,
+}
 
 
 # --- Main Processing Logic ---
-def process_pdf_in_tempdir(input_pdf_path: Path, temp_dir_path: Path) -> Tuple[bool, Optional[str]]:
+def process_pdf_in_tempdir(input_pdf_path: Path, temp_dir_path: Path, options: Optional[Dict] = None,
+                           report: Optional[Dict] = None) -> Tuple[bool, Optional[str]]:
+    """Runs the page pipeline over a PDF. If a `report` dict is given it is filled with per-page results as pages finish."""
     start_time_total = time.time()
+    job_options = {**PIPELINE_DEFAULTS, **(options or {})}
+    report = report if report is not None else {}
+    report.update({"pdf_name": input_pdf_path.name, "pages": {}})
+    # Without tiering every page is rendered once at the HTML resolution, as before
+    render_dpi = job_options["ocr_dpi"] if job_options["tiered_rendering"] else job_options["html_dpi"]
+    artifact_folder = temp_dir_path / "pdfImages" if job_options["keep_artifacts"] else None
     # Define subdirectories within the temporary directory
-    folders = {name: temp_dir_path / name for name in ["splitter", "pdfImages", "tableContainerHTML"]}
+    folders = {name: temp_dir_path / name for name in ["pdfImages", "tableContainerHTML"]}
     try:
         for folder_path in folders.values():
             folder_path.mkdir(parents=True, exist_ok=True)
@@ -733,6 +2280,7 @@ def process_pdf_in_tempdir(input_pdf_path: Path, temp_dir_path: Path) -> Tuple[b
     try:
         reader = PdfReader(str(input_pdf_path))
         num_pages = len(reader.pages)
+        report["num_pages"] = num_pages
         if num_pages == 0:
              app.logger.warning(f"PDF file '{input_pdf_path.name}' contains 0 pages.")
              return True, None # Treat as success with no output pages
@@ -744,49 +2292,122 @@ def process_pdf_in_tempdir(input_pdf_path: Path, temp_dir_path: Path) -> Tuple[b
         return False, f"Unexpected error reading PDF: {e}"
 
     app.logger.info(f"Processing {num_pages} pages from '{input_pdf_path.name}' in temp dir: {temp_dir_path}")
-    log_component("PipelineStart", {"pdf_name": input_pdf_path.name, "num_pages": num_pages, "temp_dir": str(temp_dir_path)})
+    log_component("PipelineStart", {"pdf_name": input_pdf_path.name, "num_pages": num_pages, "temp_dir": str(temp_dir_path), "options": job_options})
     failed_pages_processing_count = 0
     overall_processing_error_message = None
-
-    def process_single_page(page_index: int):
+    payload_options = {"max_edge": job_options["llm_image_max_edge"], "image_format": job_options["llm_image_format"],
+                       "quality": job_options["llm_image_quality"], "crop": job_options["llm_image_crop"]}
+    assembler = None; reader_lock = threading.Lock() # The assembler copies original pages from this reader on other threads
+    if job_options["pipelined_merge"]:
+        try: assembler = PDFAssembler(input_pdf_path, temp_dir_path, reader=reader, reader_lock=reader_lock)
+        except Exception as e: log_error("PDF Assembler Init Error", e, {"pdf_name": input_pdf_path.name}) # finalize_pdf merges afterwards instead
+    # Text layers are read once up front: the fast path checks them per page, and compaction learns the document's
+    # headers and footers from all of them before the first page is compacted
+    text_layers = [None] * num_pages
+    if job_options["text_layer_fast_path"] or job_options["detection_compaction"]:
+        for page_index in range(num_pages):
+            try:
+                with reader_lock:
+                    text_layers[page_index] = (reader.pages[page_index].extract_text() or "").strip()
+            except Exception as extract_err:
+                log_error("Text Layer Extraction Error", extract_err, {"page": page_index + 1, "pdf_name": input_pdf_path.name})
+    boilerplate_lines = find_boilerplate_lines(text for text in text_layers if text) if job_options["detection_compaction"] else frozenset()
+    stylesheets = SharedStylesheets(folders["tableContainerHTML"]) if job_options["html_postprocess"] else None
+    detection_batcher = TableDetectionBatcher(bypass_cache=job_options["llm_cache_bypass"]) if job_options["detection_batching"] else None
+
+    def iter_page_inputs() -> Iterator[Tuple[int, Optional[Image.Image], Optional[str], Optional[str]]]:
+        """Yields (page_num, image, text_layer, render_error); only pages without a usable text layer are rendered."""
+        pending_render = []
+        for page_index in range(num_pages):
+            page_num = page_index + 1
+            if job_options["text_layer_fast_path"]:
+                text_layer = text_layers[page_index]
+                quality = assess_text_layer(text_layer) if text_layer is not None else {"usable": False}
+                report["pages"][page_num] = {"text_layer": quality}
+                if quality["usable"]:
+                    yield page_num, None, text_layer, None
+                    continue
+            pending_render.append(page_num)
+            if RENDER_BATCH_SIZE > 0 and len(pending_render) >= RENDER_BATCH_SIZE:
+                for rendered_page_num, page_image, render_error in render_pdf_pages(input_pdf_path, pending_render, dpi=render_dpi, artifact_folder=artifact_folder):
+                    yield rendered_page_num, page_image, None, render_error
+                pending_render = []
+        if pending_render:
+            for rendered_page_num, page_image, render_error in render_pdf_pages(input_pdf_path, pending_render, dpi=render_dpi, artifact_folder=artifact_folder):
+                yield rendered_page_num, page_image, None, render_error
+
+    def process_single_page(page_index: int, page_image: Optional[Image.Image], text_layer: Optional[str], render_error: Optional[str]):
         page_num = page_index + 1 # 1-based index
         page_is_successful = True; page_specific_error_msg = None
         start_time_page = time.time()
-        page_pdf_path = folders["splitter"] / f"page_{page_num}.pdf"
-        page_image_path = folders["pdfImages"] / f"page_{page_num}.png" # Expected output path
         page_log_context = {"page": page_num, "pdf_name": input_pdf_path.name, "temp_dir": str(temp_dir_path)}
+        page_report = report["pages"].setdefault(page_num, {})
+        page_report["path"] = "text_layer" if text_layer is not None else "ocr"
+        html_image = None; page_words = None; html_result = None
+        page_usage = {}; usage_scope_token = llm_usage_scope.set(page_usage)
+        deadline = time.monotonic() + job_options["page_deadline_sec"] if job_options["page_deadline_sec"] > 0 else None
+        deadline_token = page_deadline.set(deadline); deadline_report_token = page_deadline_report.set(page_report)
         try:
-            save_pdf_page(reader, page_index, page_pdf_path) # Uses 0-based index
-            app.logger.info(f"[Page {page_num}] Converting PDF page to image...")
-            try:
-                # pdf2image saves files directly, so we'll use output_file to name it
-                convert_from_path(
-                    str(page_pdf_path), dpi=300, output_folder=folders["pdfImages"],
-                    output_file=f"page_{page_num}", fmt='png', thread_count=1
-                )
-                # After conversion, check if the specifically named file exists
-                if not page_image_path.exists():
-                    # Fallback: Check if a slightly different name was generated (e.g., with sequence like -001)
-                    found_images = list(folders["pdfImages"].glob(f"page_{page_num}*.png"))
-                    if found_images:
-                        page_image_path = found_images[0] # Take the first match
-                        app.logger.warning(f"[Page {page_num}] Adjusted image path to {page_image_path.name}")
-                    else:
-                        raise FileNotFoundError(f"Output image file {page_image_path.name} (or similar) not found after conversion.")
-                app.logger.info(f"[Page {page_num}] Image saved: {page_image_path.name}")
-            except Exception as convert_err: raise RuntimeError(f"Failed to convert page {page_num} to image: {convert_err}")
+            if text_layer is not None:
+                page_text = text_layer
+                app.logger.info(f"[Page {page_num}] Using embedded text layer ({len(page_text)} chars), skipping render and OCR.")
+            else:
+                if render_error: raise RuntimeError(render_error)
+                app.logger.info(f"[Page {page_num}] Image rendered: {page_image.width}x{page_image.height}")
 
-            app.logger.info(f"[Page {page_num}] Extracting text via OCR...")
-            page_text = ""
-            try:
-                 with Image.open(page_image_path) as img_for_ocr:
-                      page_text = pytesseract.image_to_string(img_for_ocr, timeout=60).strip()
-                 app.logger.info(f"[Page {page_num}] OCR Success: Extracted {len(page_text)} chars.")
-                 if not page_text: app.logger.warning(f"[Page {page_num}] WARN: OCR resulted in empty text.")
-            except Exception as ocr_err: raise RuntimeError(f"OCR failed for page {page_num}: {ocr_err}")
-
-            app.logger.info(f"[Page {page_num}] Detecting tables via Gemini...")
-            detection_result = detect_table(page_text)
+                app.logger.info(f"[Page {page_num}] Extracting text via OCR...")
+                page_text = ""
+                start_time_ocr = time.time()
+                try:
+                     ocr_settings = (job_options["ocr_lang"], job_options["ocr_psm"], job_options["ocr_oem"],
+                                     tuple(job_options["preprocess_steps"]), job_options["preprocess_target_x_height"])
+                     cache_key = ocr_cache_key(page_image, *ocr_settings) if ocr_cache else None
+                     ocr_result = ocr_cache.get(cache_key) if ocr_cache else None
+                     page_report["ocr_cache_hit"] = ocr_result is not None
+                     if ocr_result is None:
+                         ocr_result = run_ocr(page_image, *ocr_settings)
+                         if ocr_cache: ocr_cache.put(cache_key, ocr_result)
+                     page_text, page_words = ocr_result["text"], ocr_result["words"]
+                     page_report["preprocess"] = ocr_result.get("preprocess")
+                     app.logger.info(f"[Page {page_num}] OCR Success: Extracted {len(page_text)} chars.")
+                     if not page_text: app.logger.warning(f"[Page {page_num}] WARN: OCR resulted in empty text.")
+                except Exception as ocr_err: raise RuntimeError(f"OCR failed for page {page_num}: {ocr_err}")
+                finally: page_report["ocr_sec"] = round(time.time() - start_time_ocr, 2)
+
+            local_result = None
+            if job_options["local_table_classifier"] in ("on", "shadow") and page_text:
+                local_result = classify_table_locally(page_text, page_words)
+                page_report["local_classifier"] = local_result
+            if job_options["local_table_classifier"] == "on" and local_result is not None and local_result["decision"] != "ambiguous":
+                app.logger.info(f"[Page {page_num}] Local pre-classifier settled the page: {local_result['decision']}")
+                is_table = local_result["decision"] == "table"
+                detection_result = {"response": {"tableDetected": is_table, "confidenceScore": local_result["score"] if is_table else round(1 - local_result["score"], 3)},
+                                    "response_time": 0, "error": None, "source": "local"}
+                record_local_classifier_outcome(local_result, None)
+            elif job_options["detection_mode"] == "combined":
+                app.logger.info(f"[Page {page_num}] Detecting tables and generating HTML in a single Gemini call...")
+                html_image = page_image
+                if html_image is None or render_dpi != job_options["html_dpi"]:
+                    try: html_image = render_pdf_page(input_pdf_path, page_num, job_options["html_dpi"], artifact_folder)
+                    except Exception as convert_err: raise RuntimeError(f"Failed to render page {page_num} at {job_options['html_dpi']} DPI: {convert_err}")
+                combined_result = detect_table_and_extract_html(html_image, page_text, image_name=f"page_{page_num}",
+                                                                bypass_cache=job_options["llm_cache_bypass"], payload_options=payload_options)
+                html_result = {"html": combined_result.pop("html"), "response_time": combined_result["response_time"],
+                               "error": None, "cache_hit": combined_result["cache_hit"]}
+                detection_result = {**combined_result, "source": "gemini_combined"}
+            else:
+                app.logger.info(f"[Page {page_num}] Detecting tables via Gemini...")
+                detection_text = page_text
+                if job_options["detection_compaction"] and page_text:
+                    detection_text, page_report["detection_compaction"] = compact_detection_text(page_text, boilerplate_lines, job_options["detection_max_tokens"])
+                if detection_batcher: detection_result = {**detection_batcher.detect(page_num, detection_text), "source": "gemini"}
+                else: detection_result = {**detect_table(detection_text, bypass_cache=job_options["llm_cache_bypass"]), "source": "gemini"}
+                if local_result:
+                    gemini_detected = detection_result.get("response", {}).get("tableDetected")
+                    stats = record_local_classifier_outcome(local_result, gemini_detected if isinstance(gemini_detected, bool) else None)
+                    if job_options["local_table_classifier"] == "shadow":
+                        log_component("localTableClassifierShadow", {**page_log_context, "local": local_result, "gemini_table_detected": gemini_detected, "stats": stats})
+            page_report["detection_source"] = detection_result["source"]
             log_component("detectTableResult", {**page_log_context, **detection_result})
             if detection_result.get("error"):
                 err_msg = detection_result["error"]
@@ -800,8 +2421,17 @@ def process_pdf_in_tempdir(input_pdf_path: Path, temp_dir_path: Path) -> Tuple[b
                      app.logger.error(f"[Page {page_num}] {err_msg}")
                      page_is_successful = False; page_specific_error_msg = err_msg
                 elif parsed_detection.get("tableDetected") is True:
-                    app.logger.info(f"[Page {page_num}] Table detected, generating full page HTML...")
-                    html_result = extract_full_page_html_from_image(str(page_image_path), page_text)
+                    if html_result is None: # Combined mode already returned the HTML with the detection
+                        app.logger.info(f"[Page {page_num}] Table detected, generating full page HTML...")
+                        html_image = page_image
+                        if html_image is None or render_dpi != job_options["html_dpi"]:
+                            try: html_image = render_pdf_page(input_pdf_path, page_num, job_options["html_dpi"], artifact_folder)
+                            except Exception as convert_err: raise RuntimeError(f"Failed to render page {page_num} at {job_options['html_dpi']} DPI: {convert_err}")
+                        html_result = extract_full_page_html_from_image(html_image, page_text, image_name=f"page_{page_num}",
+                                                                        bypass_cache=job_options["llm_cache_bypass"],
+                                                                        output_path=folders["tableContainerHTML"] / f"page_{page_num}_full.html" if job_options["html_streaming"] else None,
+                                                                        payload_options=payload_options)
+                        page_report["html_ttfb_sec"] = html_result.get("ttfb_sec")
                     log_component("extractFullPageHTMLResult", {**page_log_context, **html_result})
                     if html_result.get("error"):
                          err_msg = html_result['error']
@@ -810,7 +2440,8 @@ def process_pdf_in_tempdir(input_pdf_path: Path, temp_dir_path: Path) -> Tuple[b
                     else:
                         html_code = html_result.get("html", "")
                         app.logger.info(f"[Page {page_num}] Generate Full Page HTML: {len(html_code)} chars (Time: {html_result.get('response_time')}s)")
-                        if html_code:
+                        if html_result.get("output_path"): app.logger.info(f"[Page {page_num}] Full Page HTML streamed to: {Path(html_result['output_path']).name}")
+                        elif html_code:
                             html_code = clean_ai_html_response(html_code)  # Clean the response
                             html_path = folders["tableContainerHTML"] / f"page_{page_num}_full.html"
                             try:
@@ -822,38 +2453,114 @@ def process_pdf_in_tempdir(input_pdf_path: Path, temp_dir_path: Path) -> Tuple[b
                                  app.logger.error(f"[ERROR] {err_msg} for page {page_num}")
                                  page_is_successful = False; page_specific_error_msg = err_msg
                         else: app.logger.warning(f"[Page {page_num}] Full Page HTML generation resulted in empty content.")
+                        html_path = folders["tableContainerHTML"] / f"page_{page_num}_full.html"
+                        if stylesheets and page_is_successful and html_path.exists():
+                            try: page_report["html_postprocess"] = stylesheets.process_file(html_path)
+                            except Exception as postprocess_err: # The page is converted as generated
+                                log_error("HTML Post-processing Error", postprocess_err, page_log_context)
                 else: app.logger.info(f"[Page {page_num}] No table detected by Gemini. Skipping HTML generation.")
         except Exception as page_err:
              log_error("Process Single Page Unhandled Error", page_err, page_log_context)
              page_is_successful = False; page_specific_error_msg = f"Unhandled Page Error: {page_err}"
         finally:
-            if page_pdf_path.exists():
-                try: page_pdf_path.unlink()
-                except Exception as unlink_err: app.logger.warning(f"[WARN] Error deleting temp PDF {page_pdf_path.name}: {unlink_err}")
+            for image in (page_image, html_image):
+                if image is not None:
+                    try: image.close()
+                    except Exception as close_err: app.logger.warning(f"[Page {page_num}] Error closing page image: {close_err}")
+            llm_usage_scope.reset(usage_scope_token)
+            page_deadline.reset(deadline_token); page_deadline_report.reset(deadline_report_token)
+            page_report["llm_usage"] = page_usage
+            if not page_is_successful and page_report.get("llm_deadline_exceeded"):
+                # Only a page whose LLM call ran out of time falls back; any other failure stays a failure.
+                # The merge keeps the original page as long as no HTML is left behind
+                (folders["tableContainerHTML"] / f"page_{page_num}_full.html").unlink(missing_ok=True)
+                app.logger.warning(f"[Page {page_num}] Page deadline of {job_options['page_deadline_sec']}s exceeded ({page_specific_error_msg}); keeping the original page.")
+                page_report["deadline_fallback"] = True
+                page_is_successful = True; page_specific_error_msg = None
             page_duration = round(time.time() - start_time_page, 2)
             app.logger.info(f"--- Finished Page {page_num} in {page_duration}s (Success: {page_is_successful}) ---")
-            log_component("PageProcessEnd", {**page_log_context, "duration_sec": page_duration, "success": page_is_successful, "error": page_specific_error_msg})
+            page_report.update({"duration_sec": page_duration, "success": page_is_successful, "error": page_specific_error_msg})
+            log_component("PageProcessEnd", {**page_log_context, "path": page_report["path"], "duration_sec": page_duration, "success": page_is_successful, "error": page_specific_error_msg})
             return page_is_successful, page_specific_error_msg
 
-    max_workers = min(4, os.cpu_count() or 1)
-    app.logger.info(f"Starting concurrent page processing with up to {max_workers} workers...")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(process_single_page, i): i for i in range(num_pages)}
-        for future in concurrent.futures.as_completed(futures):
-            page_index = futures[future]
-            try:
-                page_success, page_err_msg_future = future.result()
-                if not page_success:
-                    failed_pages_processing_count += 1
-                    if not overall_processing_error_message: # Capture first page error summary
-                         overall_processing_error_message = f"Page {page_index + 1} error: {page_err_msg_future}"
-            except Exception as e:
+    def collect_page_result(future):
+        nonlocal failed_pages_processing_count, overall_processing_error_message
+        page_index = futures.pop(future)
+        try:
+            page_success, page_err_msg_future = future.result()
+            if not page_success:
                 failed_pages_processing_count += 1
-                overall_processing_error_message = f"Critical failure in task for Page {page_index + 1}: {e}"
-                log_error("Concurrent Execution Error", e, {"page_index": page_index, "pdf_name": input_pdf_path.name})
-
+                if not overall_processing_error_message: # Capture first page error summary
+                     overall_processing_error_message = f"Page {page_index + 1} error: {page_err_msg_future}"
+        except Exception as e:
+            failed_pages_processing_count += 1
+            overall_processing_error_message = f"Critical failure in task for Page {page_index + 1}: {e}"
+            log_error("Concurrent Execution Error", e, {"page_index": page_index, "pdf_name": input_pdf_path.name})
+        if assembler: assembler.page_ready(page_index + 1) # HTML-to-PDF conversion starts while other pages are still processing
+
+    max_workers = PAGE_WORKERS
+    window_size = job_options["window_size"]
+    app.logger.info(f"Starting concurrent page processing with up to {max_workers} workers (window: {window_size or 'unbounded'})...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        # Text-layer pages are submitted right away; rendered pages as soon as their render batch lands.
+        # Pulling the next page blocks while the window is full, which also pauses rendering.
+        for page_num, page_image, text_layer, render_error in iter_page_inputs():
+            if window_size > 0 and len(futures) >= window_size:
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done: collect_page_result(future)
+            futures[executor.submit(process_single_page, page_num - 1, page_image, text_layer, render_error)] = page_num - 1
+        for future in concurrent.futures.as_completed(list(futures)):
+            collect_page_result(future)
+
+    merge_tail_sec = None
+    if assembler:
+        start_time_merge_tail = time.time()
+        merge_success, merged_pdf_path, merge_error = assembler.finish()
+        merge_tail_sec = round(time.time() - start_time_merge_tail, 2)
+        report["merge"] = assembler.report_entry(merge_success, merged_pdf_path, merge_error)
     total_duration = round(time.time() - start_time_total, 2)
+    ocr_pages = sum(1 for page in report["pages"].values() if page.get("path") == "ocr")
+    # Cache hits are excluded so the saved-time estimate reflects real Tesseract runs
+    ocr_times = [page["ocr_sec"] for page in report["pages"].values() if "ocr_sec" in page and not page.get("ocr_cache_hit")]
+    text_layer_pages = sum(1 for page in report["pages"].values() if page.get("path") == "text_layer")
+    job_usage = {}
+    for page in report["pages"].values(): merge_usage(job_usage, page.get("llm_usage") or {})
+    html_ttfbs = [page["html_ttfb_sec"] for page in report["pages"].values() if page.get("html_ttfb_sec") is not None]
+    report["summary"] = {
+        "num_pages": num_pages, "text_layer_pages": text_layer_pages, "ocr_pages": ocr_pages,
+        "ocr_sec_total": round(sum(ocr_times), 2),
+        # Estimated from the mean OCR time of the pages that did need it
+        "ocr_sec_saved_estimate": round(text_layer_pages * sum(ocr_times) / len(ocr_times), 2) if ocr_times else None,
+        "preprocess_sec_by_step": {step: round(sum((page.get("preprocess") or {}).get("timings", {}).get(step, 0) for page in report["pages"].values()
+                                                   if not page.get("ocr_cache_hit")), 3) for step in PREPROCESS_STEP_NAMES},
+        "ocr_cache_hits": sum(1 for page in report["pages"].values() if page.get("ocr_cache_hit")),
+        "deadline_fallback_pages": sum(1 for page in report["pages"].values() if page.get("deadline_fallback")),
+        "llm_usage": job_usage,
+        "llm_tokens_total": sum(usage["total_token_count"] for usage in job_usage.values()),
+        "detection_tokens_saved_estimate": sum(page["detection_compaction"]["tokens_before"] - page["detection_compaction"]["tokens_after"]
+                                               for page in report["pages"].values() if page.get("detection_compaction")),
+        "html_ttfb_sec_avg": round(sum(html_ttfbs) / len(html_ttfbs), 2) if html_ttfbs else None,
+        "html_ttfb_sec_max": max(html_ttfbs) if html_ttfbs else None,
+        "html_postprocess": stylesheets.snapshot() if stylesheets else None,
+        "ocr_cache": ocr_cache.snapshot() if ocr_cache else None,
+        "llm_cache": llm_cache.snapshot() if llm_cache else None,
+        "llm_client": llm_client.snapshot() if llm_client else None, # Process-wide counters, shared with concurrent jobs
+        "html_renderer": html_renderer.snapshot(), # Process-wide too
+        "llm_models": gemini_models.snapshot(), # Process-wide; "reused" should dominate once the service is warm
+        # Time spent merging after the last page finished; the rest of the merge overlapped with processing
+        "merge_tail_sec": merge_tail_sec,
+        "total_duration_sec": total_duration, "failed_pages": failed_pages_processing_count,
+    }
+    if job_options["user_id"] is not None:
+        report["summary"]["user_id"] = job_options["user_id"]
+        try:
+            report["summary"]["user_llm_usage"] = record_user_llm_usage(job_options["user_id"], job_usage)
+        except Exception as e: # The job's own usage is still in the report
+            db.session.rollback()
+            log_error("User LLM Usage Error", e, {"user_id": job_options["user_id"]})
     log_component("PipelineEnd", {"pdf_name": input_pdf_path.name, "total_duration_sec": total_duration, "failed_pages": failed_pages_processing_count})
+    log_component("JobReport", report)
     app.logger.info(f"Finished processing {input_pdf_path.name}. Total Time: {total_duration}s. Pages with critical errors: {failed_pages_processing_count}")
     # Overall success is if no critical executor errors AND no pages had critical processing failures.
     final_success = overall_processing_error_message is None and failed_pages_processing_count == 0
@@ -861,92 +2568,477 @@ def process_pdf_in_tempdir(input_pdf_path: Path, temp_dir_path: Path) -> Tuple[b
     return final_success, final_error_summary
 
 
+# --- HTML Rendering Service ---
+HTML_PDF_WORKERS = int(os.getenv('HTML_PDF_WORKERS', str(min(4, os.cpu_count() or 1)))) # Concurrent wkhtmltopdf conversions
+HTML_RENDERER_WORKERS = int(os.getenv('HTML_RENDERER_WORKERS', str(HTML_PDF_WORKERS))) # Long-lived wkhtmltopdf processes; 0 starts one per conversion
+HTML_RENDERER_MAX_JOBS = int(os.getenv('HTML_RENDERER_MAX_JOBS', '50')) # Conversions before a process is replaced, bounding its memory growth
+HTML_RENDERER_JOB_TIMEOUT_SEC = float(os.getenv('HTML_RENDERER_JOB_TIMEOUT_SEC', '120'))
+HTML_PDF_PAGE_SIZE = os.getenv('HTML_PDF_PAGE_SIZE', 'A4')
+HTML_PDF_MARGIN = os.getenv('HTML_PDF_MARGIN', '10mm') # All four sides; A4 and 10mm are wkhtmltopdf's own defaults
+# Options for pdfkit, 'enable-local-file-access' is often needed for local CSS/images in HTML
+PDFKIT_OPTIONS = {'enable-local-file-access': None, 'quiet': '', 'page-size': HTML_PDF_PAGE_SIZE,
+                  **{f'margin-{side}': HTML_PDF_MARGIN for side in ('top', 'right', 'bottom', 'left')}}
+
+def find_wkhtmltopdf() -> Optional[str]:
+    """Returns the wkhtmltopdf executable pdfkit would use, or None when it is not installed."""
+    try:
+        configured = pdfkit.configuration().wkhtmltopdf
+        configured = configured.decode("utf-8") if isinstance(configured, bytes) else configured
+        if configured and Path(configured).exists():
+            return configured
+    except Exception: pass # pdfkit raises OSError when it cannot locate the binary
+    return shutil.which("wkhtmltopdf")
+
+def wkhtmltopdf_args(options: Dict) -> List[str]:
+    """Turns pdfkit-style options ({'page-size': 'A4', 'enable-local-file-access': None}) into command-line arguments."""
+    args = []
+    for key, value in options.items():
+        args.append(key if key.startswith("-") else f"--{key}")
+        if value not in (None, ""): args.append(str(value))
+    return args
+
+class RendererProcess:
+    """One wkhtmltopdf process started with --read-args-from-stdin; every line written to it is one conversion.
+
+    wkhtmltopdf reports progress on stderr and ends each successful conversion with a "Done" line, while a failed
+    conversion makes it exit. A reader thread forwards stderr lines so render() can wait on them with a timeout.
+    """
+
+    def __init__(self, executable: str):
+        self.process = subprocess.Popen([executable, "--read-args-from-stdin"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE, text=True, bufsize=1)
+        self.lines = queue.Queue(); self.jobs = 0
+        threading.Thread(target=self._read_stderr, daemon=True, name="wkhtmltopdf-stderr").start()
+
+    def _read_stderr(self):
+        for line in self.process.stderr: # Universal newlines also split the "\r" progress bar updates
+            self.lines.put(line.strip())
+        self.lines.put(None) # The process exited
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def render(self, args: List[str], timeout: float):
+        """Runs one conversion; raises TimeoutError or RuntimeError (after which the process is gone) on failure."""
+        self.jobs += 1
+        quoted = ['"' + arg.replace("\\", "\\\\").replace('"', '\\"') + '"' for arg in args]
+        try:
+            self.process.stdin.write(" ".join(quoted) + "\n"); self.process.stdin.flush()
+        except OSError as e:
+            raise RuntimeError(f"wkhtmltopdf process is not accepting jobs: {e}") from e
+        messages = []; deadline = time.monotonic() + timeout
+        while True:
+            try: line = self.lines.get(timeout=max(0.01, deadline - time.monotonic()))
+            except queue.Empty:
+                self.stop()
+                raise TimeoutError(f"wkhtmltopdf did not finish within {timeout:g}s")
+            if line is None:
+                raise RuntimeError(f"wkhtmltopdf exited with code {self.process.wait()}: {'; '.join(messages[-3:]) or 'no error output'}")
+            if line == "Done":
+                return
+            if line.startswith(("Error", "Exit with code")): messages.append(line)
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+
+class HTMLRenderer:
+    """Turns HTML files into one PDF per call on a pool of long-lived wkhtmltopdf processes.
+
+    A fresh wkhtmltopdf pays WebKit start-up, font loading and option parsing on every run. The pool keeps up
+    to `workers` processes alive, hands each conversion to an idle one (callers queue when all are busy) and
+    replaces a process after `max_jobs` conversions or any failure. With workers=0, or when wkhtmltopdf cannot
+    be found, each call is a one-shot pdfkit run with the same options.
+    """
+
+    def __init__(self, workers: int = HTML_RENDERER_WORKERS, max_jobs: int = HTML_RENDERER_MAX_JOBS,
+                 job_timeout: float = HTML_RENDERER_JOB_TIMEOUT_SEC, options: Optional[Dict] = None, executable: Optional[str] = None):
+        self.options = dict(PDFKIT_OPTIONS if options is None else options)
+        self.workers = max(0, workers); self.max_jobs = max(1, max_jobs); self.job_timeout = job_timeout
+        self.executable = executable; self.executable_checked = executable is not None
+        self.idle = queue.LifoQueue() # LIFO keeps the warmest processes busy
+        for _ in range(self.workers): self.idle.put(None) # Free slot; its process starts on first use
+        self.lock = threading.Lock()
+        self.stats = {"renders": 0, "pooled": 0, "one_shot": 0, "failures": 0, "timeouts": 0, "processes_started": 0,
+                      "processes_recycled": 0, "queue_depth": 0, "max_queue_depth": 0, "busy": 0, "render_sec_total": 0.0, "render_sec_max": 0.0}
+
+    def pooled(self) -> bool:
+        if self.workers == 0:
+            return False
+        with self.lock:
+            if not self.executable_checked:
+                self.executable = find_wkhtmltopdf(); self.executable_checked = True
+                if not self.executable: app.logger.warning("wkhtmltopdf not found; HTML pages are converted with one-shot pdfkit runs.")
+        return self.executable is not None
+
+    def render(self, html_paths: List[Path], output_path: Path):
+        """Converts html_paths, in order, into the PDF at output_path; raises on failure."""
+        start_time = time.time()
+        try:
+            if self.pooled():
+                self._render_pooled(html_paths, output_path)
+            else:
+                with self.lock: self.stats["one_shot"] += 1
+                source = [str(path) for path in html_paths] if len(html_paths) > 1 else str(html_paths[0])
+                pdfkit.from_file(source, str(output_path), options=self.options)
+        except Exception:
+            with self.lock: self.stats["failures"] += 1
+            raise
+        finally:
+            elapsed = time.time() - start_time
+            with self.lock:
+                self.stats["renders"] += 1; self.stats["render_sec_total"] += elapsed
+                self.stats["render_sec_max"] = max(self.stats["render_sec_max"], elapsed)
+
+    def _render_pooled(self, html_paths: List[Path], output_path: Path):
+        with self.lock:
+            self.stats["queue_depth"] += 1
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.stats["queue_depth"])
+        process = self.idle.get()
+        with self.lock: self.stats["queue_depth"] -= 1; self.stats["busy"] += 1
+        try:
+            if process is not None and process.alive() and process.jobs >= self.max_jobs:
+                process.stop(); process = None
+                with self.lock: self.stats["processes_recycled"] += 1
+            if process is None or not process.alive():
+                process = RendererProcess(self.executable)
+                with self.lock: self.stats["processes_started"] += 1
+            output_path.unlink(missing_ok=True)
+            # The quiet option would also silence the "Done" line each job is waited on with
+            args = wkhtmltopdf_args({key: value for key, value in self.options.items() if key not in ("quiet", "q")})
+            try:
+                process.render(args + [str(path) for path in html_paths] + [str(output_path)], self.job_timeout)
+            except TimeoutError:
+                with self.lock: self.stats["timeouts"] += 1
+                raise
+            if not output_path.exists() or output_path.stat().st_size == 0:
+                raise RuntimeError(f"wkhtmltopdf reported success but wrote no PDF to {output_path.name}")
+            with self.lock: self.stats["pooled"] += 1
+        finally:
+            with self.lock: self.stats["busy"] -= 1
+            self.idle.put(process)
+
+    def snapshot(self) -> Dict:
+        """Current queue depth, busy processes and render timings, for job reports."""
+        with self.lock:
+            stats = dict(self.stats)
+        stats["render_sec_avg"] = round(stats["render_sec_total"] / stats["renders"], 3) if stats["renders"] else None
+        stats["render_sec_total"] = round(stats["render_sec_total"], 3); stats["render_sec_max"] = round(stats["render_sec_max"], 3)
+        stats["workers"] = self.workers if self.pooled() else 0
+        return stats
+
+    def close(self):
+        """Stops the idle processes; conversions still running keep theirs until they finish."""
+        while True:
+            try: process = self.idle.get_nowait()
+            except queue.Empty: return
+            if process is not None: process.stop()
+
+html_renderer = HTMLRenderer()
+
+
 # --- Final PDF Merging ---
-def merge_final_pdf(original_pdf_path: Path, temp_dir_path: Path) -> Tuple[bool, Optional[Path], Optional[str]]:
+MERGE_PART_SIZE = int(os.getenv('MERGE_PART_SIZE', '50')) # Pages per merged part file written to disk
+HTML_PDF_BATCH_SIZE = int(os.getenv('HTML_PDF_BATCH_SIZE', '8')) # HTML pages per wkhtmltopdf invocation; 1 converts each file alone
+
+def convert_html_batch(page_numbers: List[int], html_paths: List[Path], output_folder: Path) -> Dict[int, Tuple[Optional[Path], int, Optional[str]]]:
+    """Converts HTML pages with one wkhtmltopdf run; returns {page_num: (pdf_path, page_index, error)}.
+
+    A batch is only trusted when its PDF has exactly one page per input. Otherwise (some page overflowed, or
+    the run failed) every file is converted on its own, which also isolates the page that broke the batch.
+    """
+    if len(page_numbers) > 1:
+        batch_pdf_path = output_folder / f"pages_{page_numbers[0]}-{page_numbers[-1]}_converted.pdf"
+        try:
+            html_renderer.render(html_paths, batch_pdf_path)
+            converted_page_count = len(PdfReader(str(batch_pdf_path)).pages)
+            if converted_page_count == len(page_numbers):
+                app.logger.info(f"[Merge] Converted HTML pages {page_numbers} in one batch: {batch_pdf_path.name}")
+                return {page_num: (batch_pdf_path, index, None) for index, page_num in enumerate(page_numbers)}
+            app.logger.warning(f"[Merge] Batch for pages {page_numbers} produced {converted_page_count} PDF pages; converting them one by one.")
+        except Exception as e:
+            app.logger.warning(f"[Merge] Batched HTML conversion for pages {page_numbers} failed ({e}); converting them one by one.")
+        batch_pdf_path.unlink(missing_ok=True)
+    results = {}
+    for page_num, html_path in zip(page_numbers, html_paths):
+        converted_pdf_path = output_folder / f"page_{page_num}_converted.pdf"
+        try:
+            html_renderer.render([html_path], converted_pdf_path)
+            app.logger.info(f"[Merge Page {page_num}] Converted HTML to PDF: {converted_pdf_path.name}")
+            results[page_num] = (converted_pdf_path, 0, None)
+        except Exception as e:
+            log_error("HTML to PDF Conversion Error", e, {"page": page_num, "html_path": str(html_path)})
+            results[page_num] = (None, 0, f"Page {page_num} HTML conversion failed: {e}")
+    return results
+
+def convert_html_pages(html_files: Dict[int, Path], output_folder: Path, workers: int = HTML_PDF_WORKERS,
+                       batch_size: int = HTML_PDF_BATCH_SIZE) -> Dict[int, Tuple[Optional[Path], int, Optional[str]]]:
+    """Converts every page's HTML on a bounded thread pool; the batches share html_renderer's wkhtmltopdf processes."""
+    page_numbers = sorted(html_files)
+    batches = [page_numbers[i:i + max(1, batch_size)] for i in range(0, len(page_numbers), max(1, batch_size))]
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for batch_results in executor.map(lambda batch: convert_html_batch(batch, [html_files[page_num] for page_num in batch], output_folder), batches):
+            results.update(batch_results)
+    return results
+
+def deduplicate_pdf_streams(writer: PdfWriter) -> int:
+    """Points every reference to a byte-identical stream (font file, image, ...) at its first copy; returns the number dropped.
+
+    Pages cloned from one reader already share their resources, but each converted HTML page comes from its own
+    file, so the same embedded font or image would otherwise be written once per page. Dropped objects are left as
+    null so the writer's object numbering stays valid.
+    """
+    first_by_digest = {}; replacements = {}
+    for object_index, pdf_object in enumerate(writer._objects):
+        if not isinstance(pdf_object, StreamObject):
+            continue
+        digest = hashlib.sha256(repr(sorted((key, repr(value)) for key, value in pdf_object.items() if key != "/Length")).encode("utf-8"))
+        digest.update(pdf_object._data or b"")
+        digest = digest.digest()
+        if digest in first_by_digest:
+            replacements[object_index + 1] = first_by_digest[digest]
+        else:
+            first_by_digest[digest] = object_index + 1
+    if not replacements:
+        return 0
+
+    def relink(value):
+        if isinstance(value, IndirectObject) and value.idnum in replacements:
+            return IndirectObject(replacements[value.idnum], 0, writer)
+        if isinstance(value, DictionaryObject):
+            for key, item in list(value.items()):
+                value[key] = relink(item)
+        elif isinstance(value, ArrayObject):
+            for item_index, item in enumerate(value):
+                value[item_index] = relink(item)
+        return value
+
+    for object_index, pdf_object in enumerate(writer._objects):
+        if object_index + 1 in replacements:
+            writer._objects[object_index] = NullObject()
+        elif pdf_object is not None:
+            relink(pdf_object)
+    return len(replacements)
+
+def concatenate_pdf_parts(part_paths: List[Path], output_path: Path) -> int:
+    """Joins merged part files into the final PDF, preferring poppler's pdfunite so the parts never sit in Python memory.
+
+    Returns the number of duplicate streams dropped across parts (only the PyPDF2 fallback deduplicates).
+    """
+    if len(part_paths) == 1:
+        shutil.move(str(part_paths[0]), str(output_path))
+        return 0
+    pdfunite_path = shutil.which("pdfunite")
+    if pdfunite_path:
+        subprocess.run([pdfunite_path, *[str(part) for part in part_paths], str(output_path)], check=True, capture_output=True, timeout=600)
+        return 0
+    app.logger.warning("pdfunite not found; concatenating merged parts with PyPDF2.")
+    joined = PdfWriter()
+    for part_path in part_paths:
+        joined.append(str(part_path))
+    deduplicated_objects = deduplicate_pdf_streams(joined)
+    with open(output_path, "wb") as f_out:
+        joined.write(f_out)
+    return deduplicated_objects
+
+class PDFAssembler:
+    """Builds the final PDF page by page, in order, as page results become available.
+
+    Each page is reported once, either with its HTML-to-PDF conversion result or with None to keep the
+    original page. Original pages are copied straight from one reader of the source PDF, so their shared fonts
+    and images are written once per part. Pages are appended to the output as soon as every earlier page is in,
+    and written out in parts of MERGE_PART_SIZE so memory stays flat regardless of document length. page_ready()
+    converts a page's HTML on the assembler's own pool, which lets conversion overlap with pages still being
+    processed. Pass the job's own reader (and the lock guarding it) to avoid parsing the source a second time.
+    """
+
+    def __init__(self, original_pdf_path: Path, temp_dir_path: Path, conversion_workers: int = HTML_PDF_WORKERS,
+                 reader: Optional[PdfReader] = None, reader_lock: Optional[threading.Lock] = None):
+        self.original_pdf_path = original_pdf_path
+        self.folders = {name: temp_dir_path / name for name in ["pdfImages", "tableContainerHTML", "mergedParts"]}
+        for folder_path in self.folders.values():
+            folder_path.mkdir(parents=True, exist_ok=True)
+        self.final_output_pdf_path = temp_dir_path / "final_merged.pdf"
+        self.input_pdf_reader = reader if reader is not None else PdfReader(str(original_pdf_path))
+        self.reader_lock = reader_lock or threading.Lock() # PdfReader reads its file lazily and is not thread-safe
+        self.total_pages = len(self.input_pdf_reader.pages)
+        self.merge_sec = 0.0; self.deduplicated_objects = 0; self.stats = {}
+        self.conversion_workers = conversion_workers
+        self.executor = None # Started by the first page_ready() that needs a conversion
+        self.conversion_futures = []
+        self.lock = threading.RLock()
+        self.ready = {}; self.next_page = 1
+        self.pending_uses = collections.Counter(); self.open_readers = {}
+        self.merger = PdfWriter(); self.part_paths = []; self.merged_page_count = 0
+        self.merge_is_successful = True; self.overall_merge_error_message = None
+
+    def _record_error(self, err_msg: str):
+        self.merge_is_successful = False # Mark potential issue but continue
+        if not self.overall_merge_error_message: self.overall_merge_error_message = err_msg
+
+    def _flush_part(self):
+        if len(self.merger.pages) == 0:
+            return
+        part_path = self.folders["mergedParts"] / f"part_{len(self.part_paths) + 1:05d}.pdf"
+        self.deduplicated_objects += deduplicate_pdf_streams(self.merger)
+        with open(part_path, "wb") as f_out:
+            self.merger.write(f_out)
+        self.part_paths.append(part_path)
+        app.logger.info(f"Wrote merged part {part_path.name} ({len(self.merger.pages)} pages)")
+        self.merger = PdfWriter()
+
+    def page_ready(self, page_num: int):
+        """Reports a processed page; its HTML, if any, is converted in the background before it is merged."""
+        html_file = self.folders["tableContainerHTML"] / f"page_{page_num}_full.html"
+        if not html_file.exists():
+            self.add_results({page_num: None})
+            return
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.conversion_workers), thread_name_prefix="html-pdf")
+            future = self.executor.submit(convert_html_batch, [page_num], [html_file], self.folders["tableContainerHTML"])
+            self.conversion_futures.append(future)
+        future.add_done_callback(lambda done: self.add_results(done.result() if not done.exception() else
+                                                               {page_num: (None, 0, f"Page {page_num} HTML conversion failed: {done.exception()}")}))
+
+    def add_results(self, conversions: Dict[int, Optional[Tuple[Optional[Path], int, Optional[str]]]]):
+        """Registers {page_num: (pdf_path, page_index, error) or None} and merges every page that is now next in line."""
+        with self.lock:
+            for page_num, conversion in conversions.items():
+                self.ready[page_num] = conversion
+                if conversion and conversion[0]: self.pending_uses[conversion[0]] += 1
+            start_time_merge = time.time()
+            while self.next_page in self.ready:
+                self._merge_page(self.next_page, self.ready.pop(self.next_page))
+                self.next_page += 1
+            self.merge_sec += time.time() - start_time_merge
+
+    def _merge_page(self, page_num: int, conversion: Optional[Tuple[Optional[Path], int, Optional[str]]]):
+        page_to_add_path = None; page_to_add_index = 0; source_description = ""
+        if conversion:
+            converted_pdf_path, converted_index, conversion_error = conversion
+            if conversion_error:
+                app.logger.error(f"[Merge Page {page_num}] Converting HTML to PDF failed: {conversion_error}. Using fallback.")
+                self._record_error(conversion_error)
+            else:
+                page_to_add_path, page_to_add_index = converted_pdf_path, converted_index
+                source_description = "HTML conversion"
+        # Fallback: If HTML conversion failed or no HTML existed, add original page
+        if page_to_add_path is None:
+             try:
+                 with self.reader_lock:
+                     self.merger.add_page(self.input_pdf_reader.pages[page_num - 1])
+                 self.merged_page_count += 1
+                 app.logger.debug(f"[Merge Page {page_num}] Added original page.")
+                 if len(self.merger.pages) >= MERGE_PART_SIZE: self._flush_part()
+             except Exception as e:
+                  err_msg = f"Page {page_num} could not be extracted/added from original: {e}"
+                  log_error("Add Original Page Error", e, {"page": page_num})
+                  app.logger.error(f"[Merge Page {page_num}] {err_msg}")
+                  self._record_error(err_msg)
+             return
+
+        if page_to_add_path in self.open_readers or page_to_add_path.exists():
+             try:
+                 if page_to_add_path not in self.open_readers: # Reads the file into memory, so it can go once fully used
+                     self.open_readers[page_to_add_path] = PdfReader(str(page_to_add_path))
+                 reader_for_page_to_add = self.open_readers[page_to_add_path]
+                 self.pending_uses[page_to_add_path] -= 1
+                 if self.pending_uses[page_to_add_path] <= 0:
+                     del self.open_readers[page_to_add_path]
+                     page_to_add_path.unlink()
+                 if len(reader_for_page_to_add.pages) > page_to_add_index:
+                      self.merger.add_page(reader_for_page_to_add.pages[page_to_add_index])
+                      self.merged_page_count += 1
+                      app.logger.debug(f"[Merge Page {page_num}] Successfully merged page from {source_description}.")
+                      if len(self.merger.pages) >= MERGE_PART_SIZE: self._flush_part()
+                 else:
+                      app.logger.warning(f"[Merge Page {page_num}] PDF from {source_description} ({page_to_add_path.name}) was empty.")
+                      self._record_error(f"Page {page_num} from {source_description} was empty.")
+             except Exception as merge_err:
+                 err_msg = f"Page {page_num} merging failed from source {page_to_add_path.name}: {merge_err}"
+                 log_error("PDF Page Merge Error", merge_err, {"page": page_num, "source_path": str(page_to_add_path)})
+                 app.logger.error(f"[Merge Page {page_num}] {err_msg}")
+                 self._record_error(err_msg)
+        else: # Path was set but file doesn't exist
+             app.logger.error(f"[Merge Page {page_num}] Source PDF path {page_to_add_path} not found for merging.")
+             self._record_error(f"Page {page_num} source PDF missing.")
+
+    def finish(self) -> Tuple[bool, Optional[Path], Optional[str]]:
+        """Waits for pending conversions, keeps the original for any page never reported, and writes the final PDF."""
+        final_output_pdf_path = self.final_output_pdf_path
+        try:
+            if self.executor:
+                self.executor.shutdown(wait=True)
+            self.add_results({page_num: None for page_num in range(self.next_page, self.total_pages + 1) if page_num not in self.ready})
+            start_time_write = time.time()
+            self._flush_part()
+            if self.merged_page_count > 0:
+                self.deduplicated_objects += concatenate_pdf_parts(self.part_paths, final_output_pdf_path)
+                self.merge_sec += time.time() - start_time_write
+                app.logger.info(f"Final merged PDF created with {self.merged_page_count} pages from {len(self.part_paths)} parts: {final_output_pdf_path}")
+            else:
+                app.logger.error("No pages were successfully merged into the final PDF.")
+                self._record_error("No pages could be merged.")
+                final_output_pdf_path = None # No output file generated
+        except Exception as e:
+            log_error("Final PDF Merge Unhandled Error", e, {"pdf_name": self.original_pdf_path.name})
+            app.logger.error(f"Unhandled error during final merge: {e}")
+            self.merge_is_successful = False
+            self.overall_merge_error_message = f"Unhandled merge error: {e}"
+            final_output_pdf_path = None
+        finally:
+            for part_path in self.part_paths:
+                if part_path.exists():
+                    try: part_path.unlink()
+                    except Exception as unlink_err: app.logger.warning(f"[WARN] Error deleting merged part {part_path.name}: {unlink_err}")
+        self.stats = {"pages": self.merged_page_count, "parts": len(self.part_paths), "merge_sec": round(self.merge_sec, 2),
+                      "deduplicated_objects": self.deduplicated_objects,
+                      "source_bytes": self.original_pdf_path.stat().st_size if self.original_pdf_path.exists() else None,
+                      "output_bytes": final_output_pdf_path.stat().st_size if final_output_pdf_path and final_output_pdf_path.exists() else None}
+        log_component("PDFMerge", {"pdf_name": self.original_pdf_path.name, **self.stats})
+        return self.merge_is_successful, final_output_pdf_path, self.overall_merge_error_message
+
+    def report_entry(self, merge_success: bool, merged_pdf_path: Optional[Path], merge_error: Optional[str]) -> Dict:
+        """The report["merge"] entry for a finished merge: its outcome plus the stats gathered by finish()."""
+        return {"success": merge_success, "path": str(merged_pdf_path) if merged_pdf_path else None, "error": merge_error, **self.stats}
+
+def merge_final_pdf(original_pdf_path: Path, temp_dir_path: Path, reader: Optional[PdfReader] = None,
+                    report: Optional[Dict] = None) -> Tuple[bool, Optional[Path], Optional[str]]:
+    """Converts every page's HTML (batched, in parallel) and assembles the final PDF once processing is over.
+
+    An already-parsed reader of the original can be passed in; the merge outcome and stats go to report["merge"].
+    """
     app.logger.info(f"Starting final PDF merge for '{original_pdf_path.name}'")
-    final_output_pdf_path = temp_dir_path / "final_merged.pdf"
-    merger = PdfWriter()
-    merge_is_successful = True; overall_merge_error_message = None
-    folders = {name: temp_dir_path / name for name in ["splitter", "pdfImages", "tableContainerHTML"]}
     try:
-        input_pdf_reader = PdfReader(str(original_pdf_path))
-        total_pages = len(input_pdf_reader.pages)
-        for i in range(total_pages):
-            page_num = i + 1
-            html_file = folders["tableContainerHTML"] / f"page_{page_num}_full.html"
-            page_to_add_path = None; source_description = ""
-            if html_file.exists():
-                converted_pdf_path = folders["tableContainerHTML"] / f"page_{page_num}_converted.pdf"
-                try:
-                    # Options for pdfkit, 'enable-local-file-access' is often needed for local CSS/images in HTML
-                    pdfkit_options = {'enable-local-file-access': None, 'quiet': ''}
-                    pdfkit.from_file(str(html_file), str(converted_pdf_path), options=pdfkit_options)
-                    app.logger.info(f"[Merge Page {page_num}] Converted HTML to PDF: {converted_pdf_path.name}")
-                    page_to_add_path = converted_pdf_path
-                    source_description = "HTML conversion"
-                except Exception as e:
-                    err_msg = f"Page {page_num} HTML conversion failed: {e}"
-                    log_error("HTML to PDF Conversion Error", e, {"page": page_num, "html_path": str(html_file)})
-                    app.logger.error(f"[Merge Page {page_num}] Converting HTML to PDF failed: {e}. Using fallback.")
-                    merge_is_successful = False # Mark potential issue but continue
-                    if not overall_merge_error_message: overall_merge_error_message = err_msg
-            # Fallback: If HTML conversion failed or no HTML existed, add original page
-            if page_to_add_path is None:
-                 try:
-                     page_writer_for_original = PdfWriter()
-                     page_writer_for_original.add_page(input_pdf_reader.pages[i])
-                     # Save original page temporarily to merge it, ensures clean operation
-                     fallback_pdf_path = folders["splitter"] / f"page_{page_num}_original_for_merge.pdf"
-                     with open(fallback_pdf_path, "wb") as f_out:
-                         page_writer_for_original.write(f_out)
-                     page_to_add_path = fallback_pdf_path
-                     source_description = "Original PDF"
-                     app.logger.info(f"[Merge Page {page_num}] Added original page via temp file: {fallback_pdf_path.name}")
-                 except Exception as e:
-                      err_msg = f"Page {page_num} could not be extracted/added from original: {e}"
-                      log_error("Add Original Page Error", e, {"page": page_num})
-                      app.logger.error(f"[Merge Page {page_num}] {err_msg}")
-                      merge_is_successful = False
-                      if not overall_merge_error_message: overall_merge_error_message = err_msg
-                      continue # Skip adding this page if extraction fails
-
-            if page_to_add_path and page_to_add_path.exists():
-                 try:
-                     reader_for_page_to_add = PdfReader(str(page_to_add_path))
-                     if len(reader_for_page_to_add.pages) > 0:
-                          merger.add_page(reader_for_page_to_add.pages[0])
-                          app.logger.debug(f"[Merge Page {page_num}] Successfully merged page from {source_description}.")
-                     else:
-                          app.logger.warning(f"[Merge Page {page_num}] PDF from {source_description} ({page_to_add_path.name}) was empty.")
-                          merge_is_successful = False # Indicate potential issue
-                          if not overall_merge_error_message: overall_merge_error_message = f"Page {page_num} from {source_description} was empty."
-                 except Exception as merge_err:
-                     err_msg = f"Page {page_num} merging failed from source {page_to_add_path.name}: {merge_err}"
-                     log_error("PDF Page Merge Error", merge_err, {"page": page_num, "source_path": str(page_to_add_path)})
-                     app.logger.error(f"[Merge Page {page_num}] {err_msg}")
-                     merge_is_successful = False
-                     if not overall_merge_error_message: overall_merge_error_message = err_msg
-            elif page_to_add_path: # Path was set but file doesn't exist
-                 app.logger.error(f"[Merge Page {page_num}] Source PDF path {page_to_add_path} not found for merging.")
-                 merge_is_successful = False
-                 if not overall_merge_error_message: overall_merge_error_message = f"Page {page_num} source PDF missing."
-
-        if len(merger.pages) > 0:
-            with open(final_output_pdf_path, "wb") as f_out:
-                merger.write(f_out)
-            app.logger.info(f"Final merged PDF created with {len(merger.pages)} pages: {final_output_pdf_path}")
-        else:
-            app.logger.error("No pages were successfully merged into the final PDF.")
-            merge_is_successful = False
-            if not overall_merge_error_message: overall_merge_error_message = "No pages could be merged."
-            final_output_pdf_path = None # No output file generated
+        assembler = PDFAssembler(original_pdf_path, temp_dir_path, reader=reader)
     except Exception as e:
         log_error("Final PDF Merge Unhandled Error", e, {"pdf_name": original_pdf_path.name})
-        app.logger.error(f"Unhandled error during final merge: {e}")
-        merge_is_successful = False
-        overall_merge_error_message = f"Unhandled merge error: {e}"
-        final_output_pdf_path = None
-    return merge_is_successful, final_output_pdf_path, overall_merge_error_message
+        return False, None, f"Unhandled merge error: {e}"
+    html_files = {page_num: assembler.folders["tableContainerHTML"] / f"page_{page_num}_full.html" for page_num in range(1, assembler.total_pages + 1)}
+    html_files = {page_num: html_file for page_num, html_file in html_files.items() if html_file.exists()}
+    start_time_convert = time.time()
+    try:
+        converted_pages = convert_html_pages(html_files, assembler.folders["tableContainerHTML"])
+        if html_files: app.logger.info(f"Converted {len(html_files)} HTML pages in {round(time.time() - start_time_convert, 2)}s")
+        assembler.add_results(converted_pages) # Pages without HTML are filled in with their originals by finish()
+    except Exception as e:
+        log_error("Final PDF Merge Unhandled Error", e, {"pdf_name": original_pdf_path.name})
+        assembler._record_error(f"Unhandled merge error: {e}")
+    merge_success, merged_pdf_path, merge_error = assembler.finish()
+    if report is not None: report["merge"] = assembler.report_entry(merge_success, merged_pdf_path, merge_error)
+    return merge_success, merged_pdf_path, merge_error
+
+def finalize_pdf(original_pdf_path: Path, temp_dir_path: Path, report: Dict) -> Tuple[bool, Optional[Path], Optional[str]]:
+    """Returns the merge already done by the pipelined assembler for this job, or runs merge_final_pdf now."""
+    if report.get("merge"):
+        merge = report["merge"]
+        return merge["success"], Path(merge["path"]) if merge["path"] else None, merge["error"]
+    return merge_final_pdf(original_pdf_path, temp_dir_path, report=report)
 
 
 # --- Output Handling Functions ---
@@ -1050,6 +3142,236 @@ def send_to_remote_url(file_path: Path, original_filename: str) -> Tuple[bool, O
         return False, f"Unhandled error sending file: {e}"
 
 
+# --- Background Jobs ---
+JOB_WORKER_MODE = os.getenv('JOB_WORKER_MODE', 'embedded').lower() # "embedded": web processes start their own workers; "external": run `python app.py worker`
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '1')) # Worker processes per web process in embedded mode; in external mode, the number of `python app.py worker` processes (sizes the LLM share)
+JOB_POLL_INTERVAL_SEC = float(os.getenv('JOB_POLL_INTERVAL_SEC', '2')) # Idle workers check for queued jobs this often
+JOB_PROGRESS_INTERVAL_SEC = float(os.getenv('JOB_PROGRESS_INTERVAL_SEC', '2')) # Running jobs publish page progress this often
+JOB_UPLOAD_DIR = os.getenv('JOB_UPLOAD_DIR', 'job_uploads') # Uploaded PDFs wait here until their job has run
+JOB_LEASE_SEC = float(os.getenv('JOB_LEASE_SEC', '300')) # A running job without a heartbeat for this long is requeued or failed
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '2')) # Claims before an abandoned job is failed instead of requeued
+JOB_STATUS_WRITE_ATTEMPTS = int(os.getenv('JOB_STATUS_WRITE_ATTEMPTS', '5')) # Tries for a job's final status (e.g. SQLite "database is locked")
+job_table_ready = False
+job_workers = []
+job_workers_stop = None # multiprocessing Event telling the embedded workers to exit
+job_workers_lock = threading.Lock()
+
+def ensure_job_table():
+    """Creates the jobs and llm_usage tables on first use, leaving existing tables alone, and adds columns jobs is missing."""
+    global job_table_ready
+    if not job_table_ready:
+        Job.__table__.create(db.engine, checkfirst=True)
+        LLMUsage.__table__.create(db.engine, checkfirst=True)
+        existing_columns = {column["name"] for column in sqlalchemy_inspect(db.engine).get_columns(Job.__tablename__)}
+        with db.engine.begin() as connection:
+            for column in Job.__table__.columns:
+                if column.name not in existing_columns:
+                    connection.execute(sqlalchemy_text(f"ALTER TABLE {Job.__tablename__} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}"))
+        job_table_ready = True
+
+def page_progress(report: Dict) -> Dict:
+    """Finished pages of a running pipeline's report, keyed by page number."""
+    return {str(page_num): {key: page.get(key) for key in ("path", "success", "error", "duration_sec")}
+            for page_num, page in list(report.get("pages", {}).items()) if "success" in page}
+
+def job_to_dict(job: Job) -> Dict:
+    return {
+        "job_id": job.id, "status": job.status, "filename": job.filename,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "progress": {"pages_total": job.pages_total, "pages_done": job.pages_done, "pages": json.loads(job.progress) if job.progress else {}},
+        "result_location": job.result_location, "error": job.error,
+        "summary": json.loads(job.summary) if job.summary else None,
+    }
+
+def update_job(job_id: str, owner: Optional[str] = None, **fields) -> int:
+    """Updates a job; with owner, only while that worker still holds it. Returns the number of rows updated."""
+    query = Job.query.filter_by(id=job_id)
+    if owner is not None:
+        query = query.filter_by(status='running', worker=owner)
+    updated = query.update(fields)
+    db.session.commit()
+    return updated
+
+def write_job_status(job_id: str, owner: str, **fields) -> bool:
+    """update_job for a job's final status, retried since losing it would leave the job running until its lease ends."""
+    for attempt in range(max(1, JOB_STATUS_WRITE_ATTEMPTS)):
+        try:
+            if not update_job(job_id, owner=owner, **fields):
+                app.logger.warning(f"[Job {job_id}] No longer held by {owner}; its final status was not written.")
+                return False
+            return True
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f"[Job {job_id}] Writing the final status failed (attempt {attempt + 1}): {e}")
+            time.sleep(min(5.0, 0.5 * 2 ** attempt))
+    log_error("Job Status Write Error", RuntimeError("final status not written"), {"job_id": job_id, "fields": list(fields)})
+    return False
+
+def recover_stale_jobs() -> int:
+    """Requeues running jobs whose worker stopped sending heartbeats (crashed, killed, redeployed), or fails them after JOB_MAX_ATTEMPTS."""
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(seconds=JOB_LEASE_SEC)
+    stale_jobs = Job.query.filter(Job.status == 'running', db.or_(Job.heartbeat_at < cutoff, db.and_(Job.heartbeat_at.is_(None), Job.started_at < cutoff))).all()
+    recovered = 0
+    for job in stale_jobs:
+        if (job.attempts or 0) < JOB_MAX_ATTEMPTS:
+            fields = {"status": "queued", "worker": None, "heartbeat_at": None}
+        else:
+            fields = {"status": "failed", "finished_at": now, "error": f"Worker {job.worker} stopped responding after {job.attempts} attempt(s)."}
+        # Conditional on the stale heartbeat, so a worker that just came back keeps its job
+        heartbeat_unchanged = Job.heartbeat_at.is_(None) if job.heartbeat_at is None else Job.heartbeat_at == job.heartbeat_at
+        if Job.query.filter(Job.id == job.id, Job.status == 'running', Job.worker == job.worker, heartbeat_unchanged).update(fields, synchronize_session=False):
+            recovered += 1
+            log_component("JobRecovered", {"job_id": job.id, "worker": job.worker, "attempts": job.attempts, "status": fields["status"]})
+    db.session.commit()
+    return recovered
+
+def claim_next_job(worker_name: str) -> Optional[Job]:
+    """Marks the oldest queued job as running for this worker; the conditional update keeps two workers off one job."""
+    while True:
+        job = Job.query.filter_by(status='queued').order_by(Job.created_at).first()
+        if job is None:
+            return None
+        now = datetime.now(timezone.utc)
+        claimed = Job.query.filter_by(id=job.id, status='queued').update(
+            {"status": "running", "worker": worker_name, "started_at": now, "heartbeat_at": now,
+             "attempts": db.func.coalesce(Job.attempts, 0) + 1}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            db.session.refresh(job)
+            return job
+
+def store_job_result(merged_pdf_path: Path, job: Job) -> Tuple[bool, Optional[str]]:
+    """Saves the merged PDF to S3 when configured, otherwise under LOCAL_OUTPUT_DIR/<user_id>."""
+    if s3_client and S3_BUCKET_NAME:
+        return upload_to_s3(merged_pdf_path, job.filename, str(job.user_id))
+    return save_to_local_directory(merged_pdf_path, job.filename, str(job.user_id), LOCAL_OUTPUT_DIR)
+
+def run_job(job_id: str):
+    """Runs the pipeline for a claimed job, publishing page progress (and its heartbeat) while it runs and the result location at the end."""
+    job = db.session.get(Job, job_id)
+    owner = job.worker
+    input_pdf_path = Path(job.input_path)
+    report = {}
+    stop_progress = threading.Event()
+
+    def publish_progress():
+        with app.app_context():
+            while not stop_progress.wait(JOB_PROGRESS_INTERVAL_SEC):
+                try:
+                    progress = page_progress(report)
+                    update_job(job_id, owner=owner, heartbeat_at=datetime.now(timezone.utc),
+                               pages_total=report.get("num_pages"), pages_done=len(progress), progress=json.dumps(progress))
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.warning(f"[Job {job_id}] Could not publish progress: {e}")
+
+    progress_thread = threading.Thread(target=publish_progress, daemon=True, name=f"job-progress-{job_id[:8]}")
+    progress_thread.start()
+    status = "failed"; result_location = None; error = None
+    try:
+        with tempfile.TemporaryDirectory(prefix=f"job_{job_id}_") as temp_dir:
+            processing_success, processing_error = process_pdf_in_tempdir(input_pdf_path, Path(temp_dir), options={"user_id": job.user_id}, report=report)
+            if "summary" not in report: # The PDF could not be read, or had no pages
+                error = processing_error or "The PDF has no pages."
+            else:
+                merge_success, merged_pdf_path, merge_error = finalize_pdf(input_pdf_path, Path(temp_dir), report)
+                if merged_pdf_path is None:
+                    error = merge_error or processing_error or "No merged PDF was produced."
+                else:
+                    stored, location = store_job_result(merged_pdf_path, job)
+                    if stored:
+                        status = "succeeded"; result_location = location
+                        error = processing_error or merge_error # Pages that kept their original are reported, not fatal
+                    else:
+                        error = f"Saving the result failed: {location}"
+    except Exception as e:
+        log_error("Job Unhandled Error", e, {"job_id": job_id, "pdf_name": input_pdf_path.name})
+        error = f"Unhandled job error: {e}"
+    finally:
+        stop_progress.set(); progress_thread.join()
+        progress = page_progress(report)
+        written = write_job_status(job_id, owner, status=status, result_location=result_location, error=error, finished_at=datetime.now(timezone.utc),
+                                   pages_total=report.get("num_pages"), pages_done=len(progress), progress=json.dumps(progress),
+                                   summary=json.dumps(report["summary"], default=str) if "summary" in report else None)
+        # Unless the status is recorded, the upload is kept so the job can run again once its lease expires
+        if written and input_pdf_path.parent.parent.resolve() == Path(JOB_UPLOAD_DIR).resolve(): # The job's own upload folder
+            shutil.rmtree(input_pdf_path.parent, ignore_errors=True)
+    log_component("JobEnd", {"job_id": job_id, "status": status, "result_location": result_location, "error": error})
+
+def job_worker_loop(worker_name: str, poll_interval: float = JOB_POLL_INTERVAL_SEC, stop_event=None):
+    """Runs queued jobs one at a time until stop_event is set; an embedded worker also stops if its web process dies."""
+    app.logger.info(f"Job worker {worker_name} started (pid {os.getpid()})")
+    parent = multiprocessing.parent_process() if stop_event is not None else None # The web process, not the forkserver
+    next_recovery = 0.0 # The first pass recovers jobs abandoned before this worker started
+    with app.app_context():
+        ensure_job_table()
+        while (stop_event is None or not stop_event.is_set()) and (parent is None or parent.is_alive()):
+            try:
+                if time.monotonic() >= next_recovery:
+                    recover_stale_jobs()
+                    next_recovery = time.monotonic() + min(60.0, JOB_LEASE_SEC / 2)
+                job = claim_next_job(worker_name)
+            except Exception as e:
+                db.session.rollback()
+                log_error("Job Claim Error", e, {"worker": worker_name})
+                job = None
+            if job is None:
+                if stop_event is not None: stop_event.wait(poll_interval)
+                else: time.sleep(poll_interval)
+                continue
+            app.logger.info(f"Job worker {worker_name} running job {job.id} ({job.filename})")
+            try: run_job(job.id)
+            except Exception as e: # Keep the worker alive; the job is requeued once its lease expires
+                db.session.rollback()
+                log_error("Job Worker Error", e, {"job_id": job.id, "worker": worker_name})
+            db.session.remove() # Start each job with a fresh session
+
+def start_job_workers():
+    """Starts this web process's embedded job workers on first use, and replaces any that have died since.
+
+    They run outside the web workers' request threads; the job a dead worker held is requeued once its lease expires.
+    """
+    global job_workers_stop
+    if JOB_WORKER_MODE != 'embedded':
+        return
+    with job_workers_lock:
+        if job_workers_stop is not None and job_workers_stop.is_set(): # Shutting down
+            return
+        # Same start method as the OCR pool (see get_ocr_pool); not daemonic, as each job worker starts an OCR pool of its own
+        context = multiprocessing.get_context('forkserver')
+        if job_workers_stop is None:
+            job_workers_stop = context.Event()
+            atexit.register(stop_job_workers) # Runs before multiprocessing joins its non-daemonic children at exit
+        started = 0
+        for worker_index in range(max(1, JOB_WORKERS)):
+            previous = job_workers[worker_index] if worker_index < len(job_workers) else None
+            if previous is not None and previous.is_alive():
+                continue
+            if previous is not None:
+                app.logger.warning(f"Job worker {previous.name} exited (code {previous.exitcode}); starting a replacement")
+            process = context.Process(target=job_worker_loop, name=f"job-worker-{worker_index}",
+                                      args=(f"{socket.gethostname()}-{os.getpid()}-{worker_index}", JOB_POLL_INTERVAL_SEC, job_workers_stop))
+            process.start()
+            if previous is not None: job_workers[worker_index] = process
+            else: job_workers.append(process)
+            started += 1
+        if started: app.logger.info(f"Started {started} embedded job worker(s)")
+
+def stop_job_workers():
+    """Asks the embedded workers to exit once their current job, if any, is done."""
+    if job_workers_stop is not None:
+        job_workers_stop.set()
+
+@app.before_request
+def ensure_job_workers():
+    """Starts the embedded workers with the first request a web process serves, so jobs queued before a restart resume."""
+    if not app.testing:
+        start_job_workers()
+
+
 # --- API Endpoint ---
 @app.route('/', methods=['GET'])
 def index():
@@ -1242,8 +3564,40 @@ def api_delete_file(filename):
         return jsonify({'message': 'Fichier supprimé'})
     return jsonify({'error': 'Fichier introuvable'}), 404
 
+@app.route('/api/jobs', methods=['POST'])
+@login_required
+def api_create_job():
+    """Stores the uploaded PDF and queues it; processing happens in a background worker."""
+    if 'file' not in request.files:
+        return jsonify({'error': 'Aucun fichier'}), 400
+    file = request.files['file']
+    if not file or file.filename == '' or not file.filename.lower().endswith('.pdf'):
+        return jsonify({'error': 'Seuls les fichiers PDF sont acceptés'}), 400
+    ensure_job_table()
+    job_id = str(uuid.uuid4())
+    filename = secure_filename(file.filename) or "document.pdf"
+    job_folder = Path(JOB_UPLOAD_DIR) / job_id
+    job_folder.mkdir(parents=True, exist_ok=True)
+    file.save(job_folder / filename)
+    job = Job(id=job_id, user_id=current_user.id, filename=filename, input_path=str(job_folder / filename))
+    db.session.add(job)
+    db.session.commit()
+    return jsonify({'job_id': job_id, 'status': job.status, 'status_url': url_for('api_get_job', job_id=job_id)}), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def api_get_job(job_id):
+    ensure_job_table()
+    job = db.session.get(Job, job_id)
+    if job is None or job.user_id != current_user.id:
+        return jsonify({'error': 'Tâche introuvable'}), 404
+    return jsonify(job_to_dict(job))
+
 # --- Main Execution ---
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['worker']: # Standalone job worker, for JOB_WORKER_MODE=external
+        job_worker_loop(f"{socket.gethostname()}-{os.getpid()}")
+        sys.exit(0)
     # Perform initial dependency check at startup for early warning
     startup_dependencies_ok = check_system_dependencies()
     if not startup_dependencies_ok:
@@ -1257,11 +3611,3 @@ if __name__ == '__main__':
     # This app.run() is for convenience when running `python app.py` locally.
     app.logger.info(f"Starting Flask development server on http://0.0.0.0:{port}")
     app.run(host='0.0.0.0', port=port, debug=True) # Set debug=True ONLY for active development
-
-def clean_ai_html_response(response: str) -> str:
-    """Removes markdown code block syntax from AI-generated HTML responses."""
-    if response.startswith("```html"):
-        response = response.replace("```html", "", 1)
-    if response.endswith("```"):
-        response = response[:-3]
-    return response.strip()
\ No newline at end of file
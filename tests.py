@@ -2,8 +2,13 @@
 import requests
 import os
 import pytest
+os.environ["DATABASE_URL"] = "sqlite://" # Base en mémoire pour les tests, jamais instance/users.db
 from app import app
 import io
+import json
+from pathlib import Path
+import time
+import threading
 
 # --- Configuration ---
 API_URL = "http://localhost:5050/upload_pdf"
@@ -160,4 +165,873 @@ def test_upload_valid_image(client):
     
     response = client.post('/upload', data=data)
     assert response.status_code == 500  # 500 car nous n'avons pas de vrai client Supabase
-    assert 'error' in response.json
\ No newline at end of file
+    assert 'error' in response.json
+
+
+def test_render_pdf_pages_batches(monkeypatch):
+    """Test du rendu par lots de pages en mémoire depuis le PDF original."""
+    import app as app_module
+    from PIL import Image
+    calls = []
+    def fake_convert(pdf_path, first_page, last_page, **kwargs):
+        calls.append((first_page, last_page))
+        assert 'output_folder' not in kwargs
+        return [Image.new('RGB', (10, 10)) for _ in range(first_page, last_page + 1)]
+    monkeypatch.setattr(app_module, 'convert_from_path', fake_convert)
+    pages = list(app_module.render_pdf_pages('doc.pdf', [1, 2, 3, 5, 6], batch_size=2))
+    assert calls == [(1, 2), (3, 3), (5, 6)]
+    assert [page_num for page_num, _, _ in pages] == [1, 2, 3, 5, 6]
+    assert all(image is not None and error is None for _, image, error in pages)
+
+def test_assess_text_layer():
+    """Test du contrôle qualité de la couche texte native."""
+    from app import assess_text_layer
+    prose = "Les garanties de votre contrat sont régies par le Code des assurances. " * 5
+    assert assess_text_layer(prose)["usable"] is True
+    assert assess_text_layer("Page 1")["usable"] is False
+    assert assess_text_layer("\ufffd" * 300)["usable"] is False
+    assert assess_text_layer("!#$%&*+" * 50)["usable"] is False
+
+def test_classify_table_locally():
+    """Test du pré-classifieur local de tableaux."""
+    from app import classify_table_locally
+    prose = "\n".join(["Les garanties de votre contrat sont régies par le Code des assurances français en vigueur."] * 20)
+    assert classify_table_locally(prose)["decision"] == "no_table"
+    table = "\n".join(["Bagages", "• 1 000 € / personne", "Franchise", "• 50 € / dossier"] * 5)
+    assert classify_table_locally(table)["decision"] == "table"
+    assert classify_table_locally("Page | 1")["decision"] == "ambiguous"
+
+def test_ocr_worker_run_single_pass(monkeypatch):
+    """Test de l'OCR en une seule passe : texte brut et boîtes de mots."""
+    import app as app_module
+    from PIL import Image
+    calls = []
+    def fake_image_to_data(image, **kwargs):
+        calls.append(kwargs)
+        return {"text": ["Bagages", "", "1 000 €", "Franchise"], "left": [10, 0, 400, 10], "top": [10, 0, 10, 40],
+                "width": [80, 0, 60, 90], "height": [12, 0, 12, 12], "conf": [96, -1, 90, 95],
+                "block_num": [1, 1, 1, 1], "par_num": [1, 1, 1, 1], "line_num": [1, 1, 1, 2]}
+    monkeypatch.setattr(app_module, 'tesserocr', None)
+    monkeypatch.setattr(app_module.pytesseract, 'image_to_data', fake_image_to_data)
+    result = app_module.ocr_worker_run(Image.new('RGB', (500, 100)), 'fra', 6, 1)
+    assert len(calls) == 1 and calls[0]["config"] == "--psm 6 --oem 1" and calls[0]["lang"] == "fra"
+    assert result["text"] == "Bagages 1 000 €\nFranchise"
+    assert [word["text"] for word in result["words"]] == ["Bagages", "1 000 €", "Franchise"]
+
+def test_run_ocr_timeout_excludes_queue_time(monkeypatch):
+    """Test du délai OCR : l'attente dans la file ne compte pas, un worker bloqué est abandonné."""
+    import concurrent.futures
+    import app as app_module
+    from PIL import Image
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(app_module, 'get_ocr_pool', lambda: pool)
+    monkeypatch.setattr(app_module, 'OCR_TIMEOUT', 1)
+    monkeypatch.setattr(app_module, 'OCR_TIMEOUT_GRACE_SEC', 0)
+    timeouts = []
+    def fake_worker_run(image, *args):
+        timeouts.append(args[-1])
+        time.sleep(image.width / 10)
+        return {"text": "ok", "words": []}
+    monkeypatch.setattr(app_module, 'ocr_worker_run', fake_worker_run)
+    pool.submit(time.sleep, 1.5) # Occupe le seul worker plus longtemps que OCR_TIMEOUT
+    assert app_module.run_ocr(Image.new('L', (1, 1)))["text"] == "ok"
+    assert timeouts == [1]
+    with pytest.raises(TimeoutError):
+        app_module.run_ocr(Image.new('L', (40, 1))) # Le worker ne répond pas dans le délai
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def test_ocr_worker_run_timeout(monkeypatch):
+    """Test du délai appliqué dans le worker OCR lui-même."""
+    import app as app_module
+    from PIL import Image
+    def fake_image_to_data(image, **kwargs):
+        assert 0 < kwargs["timeout"] <= 5
+        raise RuntimeError("Tesseract process timeout")
+    monkeypatch.setattr(app_module, 'tesserocr', None)
+    monkeypatch.setattr(app_module.pytesseract, 'image_to_data', fake_image_to_data)
+    with pytest.raises(TimeoutError):
+        app_module.ocr_worker_run(Image.new('RGB', (500, 100)), 'fra', 6, 1, timeout=5)
+
+def test_disk_cache_lru_eviction(tmp_path):
+    """Test du cache disque : compteurs hit/miss et éviction LRU par taille."""
+    from app import DiskCache
+    cache = DiskCache(tmp_path, max_bytes=800, name="test")
+    assert cache.get("a" * 40) is None
+    for key in ("a", "b", "c"):
+        cache.put(key * 40, {"text": key * 300})
+        time.sleep(0.01)
+    assert cache.get("a" * 40) is None # Le plus ancien a été évincé
+    assert cache.get("c" * 40) == {"text": "c" * 300}
+    stats = cache.snapshot()
+    assert stats["hits"] == 1 and stats["misses"] == 2 and stats["evictions"] >= 1
+    assert stats["size_bytes"] <= 800
+
+def test_preprocess_for_ocr_deskew_and_downscale():
+    """Test du prétraitement : redressement et réduction à la hauteur d'x cible."""
+    from app import preprocess_for_ocr
+    from PIL import Image, ImageDraw
+    page = Image.new('RGB', (1200, 1600), 'white')
+    draw = ImageDraw.Draw(page)
+    for y in range(100, 1500, 100):
+        draw.rectangle([100, y, 1100, y + 60], fill='black') # Lignes de texte de 60 px
+    skewed = page.rotate(2, fillcolor='white')
+    processed, info = preprocess_for_ocr(skewed, ("grayscale", "deskew", "downscale"), target_x_height=15)
+    assert processed.mode == 'L'
+    assert abs(info["skew_deg"] + 2) <= 0.25
+    assert abs(info["scale"] - 0.5) < 0.05
+    assert processed.size == (int(1200 * info["scale"]), int(1600 * info["scale"]))
+    assert set(info["timings"]) == {"grayscale", "deskew", "downscale"}
+
+def test_detect_table_llm_cache(monkeypatch, tmp_path):
+    """Test du cache des réponses LLM pour la détection de tableaux."""
+    import app as app_module
+    calls = []
+    def fake_call(prompt, *args, **kwargs):
+        calls.append(prompt)
+        return {"tableDetected": True, "confidenceScore": 0.9}
+    monkeypatch.setattr(app_module, 'llm_cache', app_module.DiskCache(tmp_path, 1024 * 1024, "llm", ttl_seconds=60))
+    monkeypatch.setattr(app_module, 'call_gemini_for_json', fake_call)
+    first = app_module.detect_table("Bagages | 1 000 €")
+    second = app_module.detect_table("Bagages | 1 000 €")
+    bypassed = app_module.detect_table("Bagages | 1 000 €", bypass_cache=True)
+    assert first["cache_hit"] is False and second["cache_hit"] is True and bypassed["cache_hit"] is False
+    assert second["response"] == {"tableDetected": True, "confidenceScore": 0.9}
+    assert len(calls) == 2
+
+def test_table_detection_batcher(monkeypatch):
+    """Test de la détection groupée : un seul appel pour plusieurs pages, repli page par page si la réponse est invalide."""
+    import app as app_module
+    from concurrent.futures import ThreadPoolExecutor
+    monkeypatch.setattr(app_module, 'llm_cache', None)
+    batch_calls, single_calls = [], []
+    def fake_call(prompt, expect_list=False, **kwargs):
+        if expect_list:
+            batch_calls.append(prompt)
+            return [{"page": n, "tableDetected": n % 2 == 0, "confidenceScore": 0.8} for n in (1, 2, 3)]
+        single_calls.append(prompt)
+        return {"tableDetected": False, "confidenceScore": 0.5}
+    monkeypatch.setattr(app_module, 'call_gemini_for_json', fake_call)
+    batcher = app_module.TableDetectionBatcher(max_pages=3, token_budget=10000, linger_sec=5)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(lambda n: batcher.detect(n, f"texte de la page {n}"), (1, 2, 3)))
+    assert len(batch_calls) == 1 and not single_calls
+    assert [r["response"]["tableDetected"] for r in results] == [False, True, False]
+    assert app_module.validate_table_detection_response([{"page": 1, "tableDetected": True, "confidenceScore": 0.2}], expected_pages=[2]) is False
+
+def test_table_detection_batcher_page_deadline(monkeypatch):
+    """Test de la détection groupée : l'attente d'un lot ne dépasse pas l'échéance de la page."""
+    import app as app_module
+    from concurrent.futures import ThreadPoolExecutor
+    monkeypatch.setattr(app_module, 'llm_cache', None)
+    def slow_batch(prompt, expect_list=False, **kwargs):
+        time.sleep(1) # Lot envoyé par la page sans échéance, plus lent que l'échéance de l'autre page
+        return [{"page": n, "tableDetected": False, "confidenceScore": 0.8} for n in (1, 2)]
+    monkeypatch.setattr(app_module, 'call_gemini_for_json', slow_batch)
+    batcher = app_module.TableDetectionBatcher(max_pages=2, token_budget=10000, linger_sec=5)
+    def detect(page_num, deadline_sec):
+        token = app_module.page_deadline.set(time.monotonic() + deadline_sec if deadline_sec else None)
+        start = time.monotonic()
+        try:
+            return batcher.detect(page_num, f"texte de la page {page_num}")
+        except app_module.LLMDeadlineExceeded:
+            return time.monotonic() - start
+        finally:
+            app_module.page_deadline.reset(token)
+    assert detect(1, 0.2) < 1 # Seule en file : retirée du lot à l'échéance, sans attendre linger_sec
+    assert batcher.pending == []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        waiting = executor.submit(detect, 1, 0.3)
+        time.sleep(0.05)
+        sender = executor.submit(detect, 2, None) # Complète le lot et l'envoie
+        assert waiting.result() < 0.8
+        assert sender.result()["response"]["tableDetected"] is False
+
+def test_async_llm_client_retry_and_limits():
+    """Test du client LLM asynchrone : délai de reprise indiqué par le serveur et limite de concurrence."""
+    import asyncio
+    from app import AsyncLLMClient, retry_after_seconds
+    assert retry_after_seconds(Exception("429 Quota exceeded. Please retry in 1.5s.")) == 1.5
+    assert retry_after_seconds(Exception("500 Internal error")) is None
+    client = AsyncLLMClient(max_concurrency=2, rpm_limit=0, tpm_limit=0, max_retries=3, backoff_base=0.01, backoff_max=0.5)
+    attempts = []
+    async def flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RuntimeError("429 Resource exhausted, retry in 0.2s")
+        return "ok"
+    assert client.run(flaky) == "ok"
+    assert 0.2 <= attempts[1] - attempts[0] < 1
+    async def slow():
+        await asyncio.sleep(0.1)
+        return "done"
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        assert list(executor.map(lambda _: client.run(slow), range(6))) == ["done"] * 6
+    stats = client.snapshot()
+    assert stats["retries"] == 1 and stats["max_in_flight"] == 2 and stats["in_flight"] == 0
+
+def test_gemini_model_registry_reuse():
+    """Test du registre de modèles Gemini : un seul modèle par étape et configuration, réutilisé ensuite."""
+    from app import GeminiModelRegistry
+    registry = GeminiModelRegistry()
+    first = registry.get_model("json", {"temperature": 0.1})
+    assert registry.get_model("json", {"temperature": 0.1}) is first
+    assert registry.get_model("html") is not first
+    stats = registry.snapshot()
+    assert stats["models"] == 2
+    assert stats["by_stage"] == {"json": {"created": 1, "reused": 1}, "html": {"created": 1, "reused": 0}}
+
+def test_detect_table_and_extract_html(monkeypatch):
+    """Test du mode combiné : détection et HTML en un seul appel avec l'image de la page."""
+    import app as app_module
+    from PIL import Image
+    calls = []
+    def fake_call(prompt, images=None, **kwargs):
+        calls.append(images)
+        if "Bagages 1 000 €" in prompt:
+            return {"tableDetected": True, "confidenceScore": 0.9, "html": " <html><body><table></table></body></html> "}
+        return {"tableDetected": False, "confidenceScore": 0.8, "html": ""}
+    monkeypatch.setattr(app_module, 'llm_cache', None)
+    monkeypatch.setattr(app_module, 'call_gemini_for_json', fake_call)
+    page = Image.new('RGB', (100, 100), 'white')
+    table = app_module.detect_table_and_extract_html(page, "Bagages 1 000 € Franchise 50 €")
+    prose = app_module.detect_table_and_extract_html(page, "Les garanties de votre contrat.")
+    assert len(calls) == 2 and calls[0][0]["mime_type"] == "image/jpeg"
+    assert table["error"] is None and table["response"]["tableDetected"] is True
+    assert table["html"] == "<html><body><table></table></body></html>"
+    assert prose["response"] == {"tableDetected": False, "confidenceScore": 0.8} and prose["html"] == ""
+
+def test_html_stream_writer_strips_fences(tmp_path):
+    """Test de l'écriture en flux du HTML : suppression des balises markdown au fil des fragments."""
+    from app import HTMLStreamWriter, clean_ai_html_response
+    chunks = ["  ``", "`ht", "ml\n<html><body>", "<p>1 000 €</p>", "</body></html>\n`", "``\n"]
+    writer = HTMLStreamWriter(tmp_path / "page_1_full.html")
+    writer.write("<html>partiel") # Tentative interrompue puis relancée
+    writer.reset()
+    for chunk in chunks:
+        writer.write(chunk)
+    html = writer.close()
+    assert html == clean_ai_html_response("".join(chunks).strip()) == "<html><body><p>1 000 €</p></body></html>"
+    assert (tmp_path / "page_1_full.html").read_text(encoding="utf-8") == html
+    assert writer.first_byte_sec is not None
+
+def test_llm_client_stream_idle_timeout(monkeypatch, tmp_path):
+    """Test du flux LLM : un flux bloqué est interrompu par le délai d'inactivité puis relancé."""
+    import asyncio
+    import app as app_module
+    from types import SimpleNamespace
+    attempts = []
+    def chunk(text):
+        return SimpleNamespace(text=text, candidates=[SimpleNamespace(content=SimpleNamespace(parts=[text]))])
+    class FakeStream:
+        def __init__(self, stall):
+            self.items = iter([chunk("<html>"), None if stall else chunk("</html>")])
+        def __aiter__(self):
+            return self
+        async def __anext__(self):
+            item = next(self.items, StopAsyncIteration)
+            if item is StopAsyncIteration: raise StopAsyncIteration
+            if item is None: await asyncio.sleep(5) # Flux bloqué
+            return item
+    class FakeModel:
+        async def generate_content_async(self, contents, stream=False):
+            attempts.append(stream)
+            return FakeStream(stall=len(attempts) == 1)
+    monkeypatch.setattr(app_module.gemini_models, 'get_model', lambda *args: FakeModel())
+    client = app_module.AsyncLLMClient(rpm_limit=0, tpm_limit=0, backoff_base=0.01)
+    writer = app_module.HTMLStreamWriter(tmp_path / "page.html")
+    write_threads = []
+    original_write = writer.write
+    def tracking_write(text):
+        write_threads.append(threading.current_thread())
+        original_write(text)
+    writer.write = tracking_write
+    client.stream_content("html", "prompt", writer, idle_timeout=0.2)
+    assert attempts == [True, True]
+    assert writer.close() == "<html></html>"
+    assert client.snapshot()["retries"] == 1
+    assert write_threads and client.thread not in write_threads # Écritures hors de la boucle asyncio
+
+def test_llm_client_stream_ignores_call_timeout(monkeypatch, tmp_path):
+    """Test du flux LLM : un flux régulier plus long que LLM_CALL_TIMEOUT_SEC n'est pas interrompu."""
+    import asyncio
+    import app as app_module
+    from types import SimpleNamespace
+    class FakeStream:
+        def __init__(self):
+            self.remaining = 6
+        def __aiter__(self):
+            return self
+        async def __anext__(self):
+            if not self.remaining: raise StopAsyncIteration
+            self.remaining -= 1
+            await asyncio.sleep(0.1) # Moins que le délai d'inactivité, plus que call_timeout au total
+            return SimpleNamespace(text="<p></p>", candidates=[SimpleNamespace(content=SimpleNamespace(parts=["<p></p>"]))])
+    class FakeModel:
+        async def generate_content_async(self, contents, stream=False):
+            return FakeStream()
+    monkeypatch.setattr(app_module.gemini_models, 'get_model', lambda *args: FakeModel())
+    client = app_module.AsyncLLMClient(rpm_limit=0, tpm_limit=0, max_retries=1, call_timeout=0.3)
+    writer = app_module.HTMLStreamWriter(tmp_path / "page.html")
+    client.stream_content("html", "prompt", writer, idle_timeout=0.5)
+    assert writer.close() == "<p></p>" * 6
+    assert client.snapshot()["attempt_timeouts"] == 0
+
+def test_optimize_image_payload():
+    """Test de l'optimisation de l'image envoyée à Gemini : recadrage, taille maximale et format."""
+    from app import optimize_image_payload
+    from PIL import Image, ImageDraw
+    page = Image.new('RGB', (2550, 3300), 'white')
+    ImageDraw.Draw(page).rectangle([500, 600, 1500, 2000], fill='black')
+    blob, info = optimize_image_payload(page, max_edge=1000, image_format="webp", quality=60, crop=True)
+    assert blob["mime_type"] == "image/webp" and info["bytes"] == len(blob["data"])
+    assert info["crop_box"] == [449, 534, 1552, 2067]
+    assert max(info["sent_size"]) == 1000
+    decoded = Image.open(io.BytesIO(blob["data"]))
+    assert decoded.format == "WEBP" and list(decoded.size) == info["sent_size"]
+    png_blob, png_info = optimize_image_payload(page, max_edge=0, image_format="png", crop=False)
+    assert png_blob["mime_type"] == "image/png" and png_info["sent_size"] == [2550, 3300] and png_info["quality"] is None
+    with pytest.raises(ValueError):
+        optimize_image_payload(page, image_format="gif")
+
+def test_compact_detection_text():
+    """Test de la compaction du texte de détection : espaces, en-têtes/pieds répétés et troncature."""
+    from app import find_boilerplate_lines, compact_detection_text
+    page = "CONDITIONS GÉNÉRALES\n\n\n\n{garantie}      1 000 €\nFranchise    50 €\n\nPage {n} / 32"
+    pages = [page.format(garantie=garantie, n=n) for n, garantie in enumerate(["Bagages", "Annulation", "Assistance"], 1)]
+    boilerplate = find_boilerplate_lines(pages, edge_lines=1, min_pages=2)
+    assert boilerplate == find_boilerplate_lines(reversed(pages), edge_lines=1, min_pages=2)
+    compacted = [compact_detection_text(text, boilerplate, edge_lines=1) for text in pages]
+    text, stats = compacted[0] # Même résultat pour la première page que pour les suivantes
+    assert text == "Bagages\t1 000 €\nFranchise\t50 €" and compacted[2][0] == "Assistance\t1 000 €\nFranchise\t50 €"
+    assert stats["removed_boilerplate_lines"] == 2 and stats["tokens_after"] < stats["tokens_before"]
+    long_text = "\n".join(f"Ligne {i} du tableau des garanties" for i in range(200))
+    truncated, stats = compact_detection_text(long_text, max_tokens=50)
+    assert truncated.splitlines()[0] == "Ligne 0 du tableau des garanties"
+    assert truncated.endswith("more lines truncated]") and stats["truncated_lines"] > 0 and stats["tokens_after"] <= 60
+
+def test_record_llm_usage_scope(job_db):
+    """Test de la comptabilisation des tokens : agrégation par page, et par utilisateur dans la base."""
+    from types import SimpleNamespace
+    app_module, user_ids = job_db
+    page_usage = {}
+    token = app_module.llm_usage_scope.set(page_usage)
+    try:
+        metadata = SimpleNamespace(prompt_token_count=120, candidates_token_count=30, total_token_count=150)
+        app_module.record_llm_usage("detectTable", SimpleNamespace(usage_metadata=metadata))
+        app_module.record_llm_usage("detectTable", SimpleNamespace()) # SDK sans usage_metadata
+    finally:
+        app_module.llm_usage_scope.reset(token)
+    assert page_usage["detectTable"] == {"calls": 2, "unreported_calls": 1, "prompt_token_count": 120,
+                                         "candidates_token_count": 30, "total_token_count": 150}
+    with app.app_context():
+        first = app_module.record_user_llm_usage(user_ids[0], page_usage)
+    with app.app_context(): # Nouvelle session : le total vient de la base, pas de la mémoire du processus
+        second = app_module.record_user_llm_usage(user_ids[0], page_usage)
+        assert app_module.record_user_llm_usage(user_ids[1], {}) == {}
+    assert first["detectTable"]["total_token_count"] == 150 and second["detectTable"]["total_token_count"] == 300
+    assert second["detectTable"]["calls"] == 4 and second["detectTable"]["unreported_calls"] == 2
+
+def test_llm_client_hedging_and_deadline():
+    """Test des requêtes dupliquées au-delà du p95 et de l'échéance par page."""
+    import asyncio
+    import app as app_module
+    client = app_module.AsyncLLMClient(rpm_limit=0, tpm_limit=0, max_retries=1, hedging=True, hedge_min_samples=3)
+    client.latencies["json"] = __import__("collections").deque([0.05, 0.05, 0.1])
+    calls, cancelled = [], []
+    async def request():
+        calls.append(len(calls))
+        try:
+            await asyncio.sleep(5 if len(calls) == 1 else 0.01) # Le premier appel est lent
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return len(calls)
+    start = time.monotonic()
+    assert client.run(request, stage="json", hedge=True) == 2
+    assert time.monotonic() - start < 1 and len(calls) == 2
+    time.sleep(0.05)
+    stats = client.snapshot()
+    assert stats["hedges"] == 1 and stats["hedge_wins"] == 1 and cancelled == [True]
+    token = app_module.page_deadline.set(time.monotonic() + 0.2)
+    try:
+        with pytest.raises(app_module.LLMDeadlineExceeded):
+            client.run(lambda: asyncio.sleep(5), stage="html")
+    finally:
+        app_module.page_deadline.reset(token)
+    time.sleep(0.05)
+    assert client.snapshot()["in_flight"] == 0 and client.snapshot()["deadline_exceeded"] == 1
+
+def test_llm_process_count(monkeypatch):
+    """Test du partage des quotas LLM entre processus web et workers de tâches."""
+    import app as app_module
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    monkeypatch.setenv("JOB_WORKERS", "2")
+    monkeypatch.setenv("JOB_WORKER_MODE", "embedded")
+    assert app_module.llm_process_count() == 12
+    monkeypatch.setenv("JOB_WORKER_MODE", "external")
+    assert app_module.llm_process_count() == 6
+
+def test_local_llm_backend(monkeypatch, tmp_path):
+    """Test du backend LLM local : réponses déterministes, latence simulée et flux HTML, sans réseau."""
+    import app as app_module
+    from PIL import Image
+    backend = app_module.LocalLLMBackend(latency_median={"json": 0.01, "html": 0.05}, latency_sigma=0, table_rate=0.5, html_chars=500, seed="1")
+    monkeypatch.setattr(app_module, 'llm_backend', backend)
+    monkeypatch.setattr(app_module, 'llm_cache', None)
+    monkeypatch.setattr(app_module, 'GEMINI_API_KEY', None)
+    detections = [app_module.detect_table(f"Page {n}\nBagages 1 000 €") for n in range(10)]
+    assert all(result["error"] is None for result in detections)
+    assert {result["response"]["tableDetected"] for result in detections} == {True, False}
+    assert app_module.detect_table("Page 3\nBagages 1 000 €")["response"] == detections[3]["response"]
+    batch = app_module.detect_tables_batch([(1, "Bagages 1 000 €"), (2, "Franchise 50 €")])
+    assert sorted(batch) == [1, 2]
+    html_result = app_module.extract_full_page_html_from_image(Image.new('RGB', (200, 300), 'white'), "Bagages 1 000 €",
+                                                               output_path=tmp_path / "page_1_full.html")
+    assert html_result["error"] is None and html_result["ttfb_sec"] is not None
+    assert (tmp_path / "page_1_full.html").read_text(encoding="utf-8").startswith("<!DOCTYPE html>")
+
+def test_convert_html_pages_batches_and_fallback(monkeypatch, tmp_path):
+    """Test de la conversion HTML→PDF par lots : repli fichier par fichier si le nombre de pages ne correspond pas."""
+    import app as app_module
+    from pathlib import Path
+    from PyPDF2 import PdfReader, PdfWriter
+    calls = []
+    def fake_from_file(source, output_path, options=None):
+        sources = source if isinstance(source, list) else [source]
+        calls.append(len(sources))
+        writer = PdfWriter()
+        for html_path in sources:
+            page_num = int(Path(html_path).name.split("_")[1])
+            writer.add_blank_page(width=1000 + page_num, height=800)
+            if page_num == 5: writer.add_blank_page(width=10, height=10) # Débordement sur une deuxième page
+        with open(output_path, "wb") as f_out:
+            writer.write(f_out)
+    monkeypatch.setattr(app_module.pdfkit, 'from_file', fake_from_file)
+    monkeypatch.setattr(app_module, 'html_renderer', app_module.HTMLRenderer(workers=0)) # Appels pdfkit ponctuels
+    html_files = {}
+    for page_num in (1, 2, 3, 4, 5, 6):
+        html_files[page_num] = tmp_path / f"page_{page_num}_full.html"
+        html_files[page_num].write_text("<html></html>")
+    results = app_module.convert_html_pages(html_files, tmp_path, workers=2, batch_size=3)
+    assert sorted(calls) == [1, 1, 1, 3, 3]
+    for page_num, (pdf_path, index, error) in results.items():
+        assert error is None
+        assert float(PdfReader(str(pdf_path)).pages[index].mediabox.width) == 1000 + page_num
+    assert results[1][0] == results[3][0] and results[4][0] != results[6][0]
+
+def test_pdf_assembler_out_of_order(monkeypatch, tmp_path):
+    """Test de l'assemblage en flux : pages signalées dans le désordre, fusionnées dans l'ordre."""
+    import app as app_module
+    from PyPDF2 import PdfReader, PdfWriter
+    original = PdfWriter()
+    for page_num in (1, 2, 3, 4):
+        original.add_blank_page(width=100 + page_num, height=100)
+    original_path = tmp_path / "original.pdf"
+    with open(original_path, "wb") as f_out:
+        original.write(f_out)
+    def fake_from_file(source, output_path, options=None):
+        time.sleep(0.1)
+        writer = PdfWriter()
+        writer.add_blank_page(width=500, height=100)
+        with open(output_path, "wb") as f_out:
+            writer.write(f_out)
+    monkeypatch.setattr(app_module.pdfkit, 'from_file', fake_from_file)
+    monkeypatch.setattr(app_module, 'html_renderer', app_module.HTMLRenderer(workers=0)) # Appels pdfkit ponctuels
+    assembler = app_module.PDFAssembler(original_path, tmp_path / "job")
+    (assembler.folders["tableContainerHTML"] / "page_2_full.html").write_text("<html></html>")
+    for page_num in (3, 2, 1): # La page 4 n'est jamais signalée : l'original est conservé
+        assembler.page_ready(page_num)
+    assert assembler.next_page == 2 # La page 2 attend encore sa conversion
+    success, output_path, error = assembler.finish()
+    assert success and error is None
+    assert [float(page.mediabox.width) for page in PdfReader(str(output_path)).pages] == [101, 500, 103, 104]
+
+def test_deduplicate_pdf_streams(tmp_path):
+    """Test de la fusion : pages originales copiées sans fichier temporaire et flux identiques dédupliqués."""
+    import app as app_module
+    from PyPDF2 import PdfReader, PdfWriter
+    from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+    original_path = tmp_path / "original.pdf"
+    parts = []
+    for part_index in range(2): # Deux fichiers distincts embarquant le même flux, comme deux pages HTML converties
+        writer = PdfWriter()
+        writer.add_blank_page(width=100, height=100)
+        page = writer.pages[0]
+        stream = DecodedStreamObject(); stream.set_data(b"identical font program")
+        page[NameObject("/Resources")] = DictionaryObject({NameObject("/Shared"): writer._add_object(stream)})
+        part_path = tmp_path / f"part_{part_index}.pdf"
+        with open(part_path, "wb") as f_out:
+            writer.write(f_out)
+        parts.append(part_path)
+    joined = PdfWriter()
+    for part_path in parts:
+        joined.append(str(part_path))
+    assert app_module.deduplicate_pdf_streams(joined) == 1
+    with open(original_path, "wb") as f_out:
+        joined.write(f_out)
+    pages = PdfReader(str(original_path)).pages
+    assert pages[0]["/Resources"].raw_get("/Shared").idnum == pages[1]["/Resources"].raw_get("/Shared").idnum
+
+    reader = PdfReader(str(original_path))
+    assembler = app_module.PDFAssembler(original_path, tmp_path / "job", reader=reader)
+    assert assembler.input_pdf_reader is reader
+    success, output_path, error = assembler.finish()
+    assert success and error is None
+    assert len(PdfReader(str(output_path)).pages) == 2
+    assert not any(path.is_file() for path in (tmp_path / "job").rglob("*") if path != output_path)
+    entry = assembler.report_entry(success, output_path, error)
+    assert entry["output_bytes"] == output_path.stat().st_size and entry["source_bytes"] == original_path.stat().st_size
+
+def test_html_renderer_pool_recycles_processes(tmp_path):
+    """Test du pool wkhtmltopdf persistant : un processus par lot de tâches, recyclé après max_jobs, repli en cas d'échec."""
+    import app as app_module
+    import sys
+    log_path = tmp_path / "jobs.log"
+    fake_wkhtmltopdf = tmp_path / "wkhtmltopdf"
+    fake_wkhtmltopdf.write_text(f"""#!{sys.executable}
+import os, shlex, sys
+assert sys.argv[1:] == ["--read-args-from-stdin"]
+for line in sys.stdin:
+    args = shlex.split(line)
+    with open({str(log_path)!r}, "a") as log: log.write(f"{{os.getpid()}} {{' '.join(args)}}\\n")
+    if "broken" in args[-2]:
+        sys.stderr.write("Error: Failed loading page broken.html\\n"); sys.exit(1)
+    with open(args[-1], "wb") as f_out: f_out.write(b"%PDF-1.4")
+    sys.stderr.write("Loading pages (1/6)\\r[======] 100%\\rDone\\n"); sys.stderr.flush()
+""")
+    fake_wkhtmltopdf.chmod(0o755)
+    renderer = app_module.HTMLRenderer(workers=1, max_jobs=2, executable=str(fake_wkhtmltopdf))
+    try:
+        for page_num in (1, 2, 3):
+            renderer.render([tmp_path / f"page {page_num}.html"], tmp_path / f"page_{page_num}.pdf")
+            assert (tmp_path / f"page_{page_num}.pdf").exists()
+        with pytest.raises(RuntimeError, match="Failed loading page"):
+            renderer.render([tmp_path / "broken.html"], tmp_path / "broken.pdf")
+        renderer.render([tmp_path / "page 4.html", tmp_path / "page 5.html"], tmp_path / "pages_4-5.pdf")
+    finally:
+        renderer.close()
+    jobs = [line.split(" ", 1) for line in log_path.read_text().splitlines()]
+    pids = [pid for pid, _ in jobs]
+    assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4] # Recyclé après 2 tâches, relancé après l'échec
+    assert "--page-size A4" in jobs[0][1] and "--quiet" not in jobs[0][1] and "page 1.html" in jobs[0][1]
+    stats = renderer.snapshot()
+    assert stats["pooled"] == 4 and stats["failures"] == 1 and stats["processes_started"] == 3 and stats["processes_recycled"] == 1
+    assert stats["queue_depth"] == 0 and stats["busy"] == 0 and stats["render_sec_avg"] is not None
+
+def test_shared_stylesheets_and_minification(tmp_path):
+    """Test du post-traitement HTML : blocs <style> équivalents regroupés dans une feuille partagée, balisage minifié."""
+    import app as app_module
+    stylesheets = app_module.SharedStylesheets(tmp_path)
+    page = """<!DOCTYPE html>
+<html>
+  <head>
+    <!-- généré -->
+    <style>
+      table { border-collapse: collapse; }
+      td, th { padding: 4px; }
+    </style>
+  </head>
+  <body>
+    <p>Garantie   <b>Bagages</b> <i>1 000 €</i></p>
+    <table>
+      <tr> <td>A</td> </tr>
+    </table>
+  </body>
+</html>"""
+    for page_num, html in ((1, page), (2, page.replace("padding: 4px; }", "padding:4px}   /* même règle */"))):
+        (tmp_path / f"page_{page_num}_full.html").write_text(html, encoding="utf-8")
+        sizes = stylesheets.process_file(tmp_path / f"page_{page_num}_full.html")
+        assert sizes["bytes_after"] < sizes["bytes_before"]
+    css_files = list(tmp_path.glob("styles_*.css"))
+    assert len(css_files) == 1 and css_files[0].read_text() == "table{border-collapse:collapse}td,th{padding:4px}"
+    processed = (tmp_path / "page_2_full.html").read_text(encoding="utf-8")
+    assert processed == (f'<!DOCTYPE html><html><head><link rel="stylesheet" href="{css_files[0].name}"></head>'
+                         '<body><p>Garantie <b>Bagages</b> <i>1 000 €</i></p><table><tr><td>A</td></tr></table></body></html>')
+    assert stylesheets.snapshot()["pages"] == 2 and stylesheets.snapshot()["stylesheets"] == 1
+    assert app_module.minify_html("<pre>  a\n  b</pre>") == "<pre>  a\n  b</pre>"
+    print_page = '<html><head><style>td{padding:4px}</style><style media="print">td { color: black; }</style></head><body></body></html>'
+    linked = stylesheets.process(print_page)
+    css_name = app_module.re.search(r'href="([^"]+)"', linked).group(1)
+    assert (tmp_path / css_name).read_text() == "td{padding:4px}@media print{td{color:black}}" # L'attribut media est conservé
+
+def test_job_api_validation_and_progress(client, monkeypatch):
+    """Test de l'API de tâches : refus des fichiers non PDF et progression par page tirée du rapport."""
+    import app as app_module
+    monkeypatch.setitem(app.config, 'LOGIN_DISABLED', True)
+    assert client.post('/api/jobs', data={}).status_code == 400
+    response = client.post('/api/jobs', data={'file': (io.BytesIO(b"texte"), 'notes.txt')}, content_type='multipart/form-data')
+    assert response.status_code == 400
+    report = {"num_pages": 3, "pages": {1: {"path": "text_layer", "success": True, "error": None, "duration_sec": 0.1},
+                                        2: {"text_layer": {"usable": False}}}} # Page 2 encore en cours
+    progress = app_module.page_progress(report)
+    assert progress == {"1": {"path": "text_layer", "success": True, "error": None, "duration_sec": 0.1}}
+    job = app_module.Job(id="job-1", user_id=1, filename="cgv.pdf", input_path="job_uploads/job-1/cgv.pdf", status="running",
+                         pages_total=3, pages_done=1, progress=json.dumps(progress))
+    assert app_module.job_to_dict(job)["progress"] == {"pages_total": 3, "pages_done": 1, "pages": progress}
+
+def run_fake_pipeline(monkeypatch, tmp_path, page_texts, options=None, text_layers=None, ocr_sec=0, overrides=None):
+    """Exécute process_pdf_in_tempdir sur un PDF de pages blanches, rendu, OCR et LLM simulés.
+
+    Les images simulées encodent leur numéro de page (largeur) et leur DPI (hauteur). `text_layers` donne
+    la couche texte de chaque page (vide par défaut), `ocr_sec` la durée simulée de l'OCR et `overrides` des
+    attributs de app à remplacer en plus des simulations par défaut. Renvoie le
+    résultat, le rapport et les appels enregistrés, dont la séquence des rendus ("render@<dpi>" par page) et
+    des OCR dans "events".
+    """
+    import app as app_module
+    from PIL import Image
+    from PyPDF2 import PageObject, PdfWriter
+    calls = {"render": [], "ocr": [], "detect": [], "html": [], "events": []}
+    writer = PdfWriter()
+    for page_index, _ in enumerate(page_texts):
+        writer.add_blank_page(width=100, height=100 + page_index) # La hauteur identifie la page pour la couche texte
+    text_layers = text_layers or [""] * len(page_texts)
+    monkeypatch.setattr(PageObject, 'extract_text', lambda page, *args, **kwargs: text_layers[round(float(page.mediabox.height)) - 100])
+    pdf_path = tmp_path / "document.pdf"
+    with open(pdf_path, "wb") as f_out:
+        writer.write(f_out)
+    def fake_convert(pdf_path, dpi, first_page, last_page, **kwargs):
+        calls["render"].append((first_page, last_page, dpi))
+        calls["events"].extend([f"render@{dpi}"] * (last_page - first_page + 1))
+        return [Image.new('L', (page_num, dpi)) for page_num in range(first_page, last_page + 1)]
+    def fake_run_ocr(image, *args, **kwargs):
+        calls["ocr"].append((image.width, image.height))
+        calls["events"].append("ocr_start")
+        time.sleep(ocr_sec)
+        calls["events"].append("ocr_end")
+        return {"text": page_texts[image.width - 1], "words": []}
+    def fake_detect_table(text, bypass_cache=False):
+        calls["detect"].append(text)
+        if not text: return {"response": None, "response_time": 0, "error": "Input page text was empty."}
+        return {"response": {"tableDetected": "TABLEAU" in text, "confidenceScore": 0.9}, "response_time": 0, "error": None}
+    def fake_extract_html(image, ocr_text, image_name=None, bypass_cache=False, output_path=None, payload_options=None):
+        calls["html"].append((image.width, image.height))
+        return {"html": f"<html><body>{ocr_text}</body></html>", "response_time": 0, "error": None}
+    monkeypatch.setattr(app_module, 'convert_from_path', fake_convert)
+    monkeypatch.setattr(app_module, 'run_ocr', fake_run_ocr)
+    monkeypatch.setattr(app_module, 'detect_table', fake_detect_table)
+    monkeypatch.setattr(app_module, 'extract_full_page_html_from_image', fake_extract_html)
+    monkeypatch.setattr(app_module, 'ocr_cache', None)
+    monkeypatch.setattr(app_module, 'llm_cache', None)
+    for name, value in (overrides or {}).items():
+        monkeypatch.setattr(app_module, name, value)
+    job_options = {"local_table_classifier": "off", "detection_batching": False, "detection_mode": "two_step", "detection_compaction": False,
+                   "pipelined_merge": False, "html_streaming": False, "html_postprocess": False, "page_deadline_sec": 0, **(options or {})}
+    report = {}
+    result = app_module.process_pdf_in_tempdir(pdf_path, tmp_path / "job", options=job_options, report=report)
+    return result, report, calls
+
+def test_local_classifier_on_with_empty_page(monkeypatch, tmp_path):
+    """Test du pré-classifieur local en mode "on" : une page sans texte n'échoue pas."""
+    table_text = "\n".join(["TABLEAU Bagages", "• 1 000 € / personne", "Franchise", "• 50 € / dossier"] * 5)
+    (success, error), report, calls = run_fake_pipeline(monkeypatch, tmp_path, ["", table_text], {"local_table_classifier": "on"})
+    assert success and error is None
+    assert report["pages"][1]["success"] and "local_classifier" not in report["pages"][1]
+    assert report["pages"][2]["detection_source"] == "local" and len(calls["html"]) == 1
+
+def test_tiered_rendering(monkeypatch, tmp_path):
+    """Test du rendu à deux niveaux : DPI bas pour l'OCR, html_dpi seulement pour les pages avec tableau."""
+    import app as app_module
+    monkeypatch.setattr(app_module, 'RENDER_BATCH_SIZE', 0)
+    prose = "Les garanties de votre contrat sont régies par le Code des assurances. " * 5
+    table = "TABLEAU Bagages 1 000 € par personne, franchise 50 € par dossier. " * 5
+    page_texts = ["Conditions générales", "TABLEAU Bagages 1 000 €", prose, table]
+    (success, error), report, calls = run_fake_pipeline(monkeypatch, tmp_path, page_texts,
+                                                        {"tiered_rendering": True, "ocr_dpi": 100, "html_dpi": 300},
+                                                        text_layers=["", "", prose, table])
+    assert success and error is None
+    assert [report["pages"][n]["path"] for n in range(1, 5)] == ["ocr", "ocr", "text_layer", "text_layer"]
+    ocr_pass = [(first, last) for first, last, dpi in calls["render"] if dpi == 100]
+    assert ocr_pass == [(1, 2)] # Les pages avec couche texte ne sont pas rendues pour l'OCR
+    assert calls["ocr"] == [(1, 100), (2, 100)]
+    assert sorted((first, last, dpi) for first, last, dpi in calls["render"] if dpi != 100) == [(2, 2, 300), (4, 4, 300)]
+    assert sorted(calls["html"]) == [(2, 300), (4, 300)]
+
+def test_windowed_processing(monkeypatch, tmp_path):
+    """Test de la fenêtre de pages : pages en cours et pages rendues bornées, ordre et résultats inchangés."""
+    import app as app_module
+    monkeypatch.setattr(app_module, 'RENDER_BATCH_SIZE', 1)
+    monkeypatch.setattr(app_module, 'PAGE_WORKERS', 4)
+    page_texts = [f"TABLEAU page {n}" if n % 3 == 0 else f"Texte page {n}" for n in range(1, 10)]
+    def max_pending(events, increments):
+        pending = peak = 0
+        for event in events:
+            pending += increments.get(event, 0)
+            peak = max(peak, pending)
+        return peak
+    runs = {}
+    for window_size in (0, 2):
+        (tmp_path / f"window_{window_size}").mkdir()
+        (success, error), report, calls = run_fake_pipeline(monkeypatch, tmp_path / f"window_{window_size}", page_texts,
+                                                            {"window_size": window_size}, ocr_sec=0.05)
+        assert success and error is None
+        runs[window_size] = report, calls
+    (report, calls), (unbounded_report, unbounded_calls) = runs[2], runs[0]
+    assert max_pending(calls["events"], {"ocr_start": 1, "ocr_end": -1}) <= 2
+    ocr_render = f"render@{app_module.RENDER_DPI_OCR}"
+    assert max_pending(calls["events"], {ocr_render: 1, "ocr_end": -1}) <= 2 + 1 # La fenêtre plus un lot de rendu en attente
+    assert max_pending(unbounded_calls["events"], {"ocr_start": 1, "ocr_end": -1}) > 2
+    assert sorted(report["pages"]) == list(range(1, 10))
+    for page_num in range(1, 10):
+        for key in ("success", "path", "error"):
+            assert report["pages"][page_num].get(key) == unbounded_report["pages"][page_num].get(key)
+    html_dpi = app_module.RENDER_DPI_HTML
+    assert sorted(calls["html"]) == sorted(unbounded_calls["html"]) == [(3, html_dpi), (6, html_dpi), (9, html_dpi)]
+
+def test_page_deadline_fallback_only_for_llm_deadline(monkeypatch, tmp_path):
+    """Test de l'échéance par page : seule une échéance LLM dépassée garde la page d'origine, les autres échecs restent des échecs."""
+    import app as app_module
+    def fake_detect_table(text, bypass_cache=False):
+        time.sleep(0.3) # Au-delà de l'échéance de la page
+        if "LENT" in text: raise app_module.page_deadline_exceeded("Page deadline expired during the Gemini JSON call")
+        return {"response": None, "response_time": 0, "error": "Gemini API call failed after 3 attempts: 500"}
+    (success, error), report, calls = run_fake_pipeline(monkeypatch, tmp_path, ["TABLEAU LENT", "TABLEAU CASSE"],
+                                                        {"page_deadline_sec": 0.1}, overrides={"detect_table": fake_detect_table})
+    assert report["pages"][1]["success"] and report["pages"][1]["deadline_fallback"] and report["pages"][1]["error"] is None
+    assert not report["pages"][2]["success"] and "deadline_fallback" not in report["pages"][2]
+    assert "500" in report["pages"][2]["error"] and not success and "Page 2" in error
+    class ExpiredClient:
+        def generate_content(self, *args, **kwargs):
+            raise app_module.page_deadline_exceeded("Page deadline expired before the Gemini JSON call")
+    monkeypatch.setattr(app_module, 'get_llm_client', lambda: ExpiredClient())
+    monkeypatch.setattr(app_module.llm_backend, 'configuration_error', lambda: None)
+    result = app_module.call_gemini_for_json("prompt")
+    assert result["deadline_exceeded"] and result["error"].startswith("Page deadline exceeded")
+
+@pytest.fixture
+def job_db(monkeypatch, tmp_path):
+    """Base en mémoire avec deux utilisateurs ; dossiers d'upload et de sortie temporaires.
+
+    Le contexte applicatif n'est pas conservé : les requêtes du client de test doivent ouvrir le leur.
+    """
+    import app as app_module
+    monkeypatch.setattr(app_module, 'JOB_UPLOAD_DIR', str(tmp_path / "job_uploads"))
+    monkeypatch.setattr(app_module, 'LOCAL_OUTPUT_DIR', str(tmp_path / "outputs"))
+    with app.app_context():
+        app_module.db.create_all()
+        users = [app_module.User(username=name, email=f"{name}@example.com", password="x") for name in ("alice", "bob")]
+        app_module.db.session.add_all(users)
+        app_module.db.session.commit()
+        user_ids = [user.id for user in users]
+    yield app_module, user_ids
+    with app.app_context():
+        app_module.db.drop_all()
+
+def add_job(app_module, user_id, input_path, **fields):
+    job = app_module.Job(id=str(app_module.uuid.uuid4()), user_id=user_id, filename="cgv.pdf", input_path=str(input_path), **fields)
+    app_module.db.session.add(job)
+    app_module.db.session.commit()
+    return job.id
+
+def test_job_api_create_and_get(client, job_db):
+    """Test de l'API de tâches : création en file d'attente (202), consultation par le propriétaire seulement."""
+    app_module, (alice_id, bob_id) = job_db
+    with client.session_transaction() as session:
+        session['_user_id'] = str(alice_id)
+    response = client.post('/api/jobs', data={'file': (io.BytesIO(b"%PDF-1.4"), 'CGV voyage.pdf')}, content_type='multipart/form-data')
+    assert response.status_code == 202 and response.json['status'] == 'queued'
+    with app.app_context():
+        job = app_module.db.session.get(app_module.Job, response.json['job_id'])
+        assert job.status == 'queued' and job.user_id == alice_id and Path(job.input_path).read_bytes() == b"%PDF-1.4"
+    status = client.get(response.json['status_url'])
+    assert status.status_code == 200 and status.json['job_id'] == response.json['job_id'] and status.json['progress']['pages_done'] == 0
+    with client.session_transaction() as session:
+        session['_user_id'] = str(bob_id)
+    assert client.get(response.json['status_url']).status_code == 404
+
+def test_main_block_is_last():
+    """Test de `python app.py worker` : tout le module est défini avant le bloc __main__ qui lance le worker."""
+    import ast
+    import app as app_module
+    tree = ast.parse(Path(app_module.__file__).read_text(encoding="utf-8"))
+    main_index = next(i for i, node in enumerate(tree.body) if isinstance(node, ast.If) and "__main__" in ast.unparse(node.test))
+    defined_after = [node.name for node in tree.body[main_index + 1:] if isinstance(node, (ast.FunctionDef, ast.ClassDef))]
+    assert defined_after == [] # Sinon NameError dans un worker externe, ex. clean_ai_html_response
+
+def test_start_job_workers_replaces_dead_workers(monkeypatch):
+    """Test des workers embarqués : seul le worker mort est relancé, les autres continuent."""
+    import app as app_module
+    started = []
+    class FakeProcess:
+        def __init__(self, target, name, args):
+            self.name, self.alive, self.exitcode = name, False, None
+        def start(self):
+            self.alive = True
+            started.append(self)
+        def is_alive(self):
+            return self.alive
+    class FakeContext:
+        Process = FakeProcess
+    monkeypatch.setattr(app_module, 'JOB_WORKER_MODE', 'embedded')
+    monkeypatch.setattr(app_module, 'JOB_WORKERS', 3)
+    monkeypatch.setattr(app_module, 'job_workers', [])
+    monkeypatch.setattr(app_module, 'job_workers_stop', threading.Event())
+    monkeypatch.setattr(app_module.multiprocessing, 'get_context', lambda method: FakeContext())
+    app_module.start_job_workers()
+    assert [process.name for process in started] == ["job-worker-0", "job-worker-1", "job-worker-2"]
+    app_module.start_job_workers() # Tous vivants : rien à relancer
+    assert len(started) == 3
+    started[1].alive, started[1].exitcode = False, -9 # Tué (OOM)
+    app_module.start_job_workers()
+    assert [process.name for process in started[3:]] == ["job-worker-1"]
+    assert app_module.job_workers == [started[0], started[3], started[2]]
+    app_module.job_workers_stop.set()
+    started[0].alive = False
+    app_module.start_job_workers() # Arrêt demandé : pas de relance
+    assert len(started) == 4
+
+def test_claim_next_job_only_once(job_db, tmp_path):
+    """Test de la prise de tâche : une tâche en file n'est attribuée qu'à un seul worker."""
+    app_module, (alice_id, _) = job_db
+    with app.app_context():
+        job_id = add_job(app_module, alice_id, tmp_path / "cgv.pdf")
+        claimed = app_module.claim_next_job("worker-1")
+        assert claimed.id == job_id and claimed.status == 'running' and claimed.worker == "worker-1" and claimed.attempts == 1
+        assert app_module.claim_next_job("worker-2") is None
+
+def test_run_job_succeeds_or_fails(job_db, monkeypatch, tmp_path):
+    """Test de l'exécution d'une tâche : résultat enregistré en cas de succès, erreur sinon."""
+    app_module, (alice_id, _) = job_db
+    with app.app_context():
+        def fake_process(input_pdf_path, temp_dir_path, options=None, report=None):
+            if input_pdf_path.name == "illisible.pdf":
+                return False, "Failed to read/parse PDF"
+            report.update({"num_pages": 1, "pages": {1: {"path": "text_layer", "success": True, "error": None, "duration_sec": 0.1}},
+                           "summary": {"user_id": options["user_id"]}})
+            return True, None
+        def fake_finalize(input_pdf_path, temp_dir_path, report):
+            merged_pdf_path = temp_dir_path / "final_merged.pdf"
+            merged_pdf_path.write_bytes(b"%PDF-1.4 fusion")
+            return True, merged_pdf_path, None
+        monkeypatch.setattr(app_module, 'process_pdf_in_tempdir', fake_process)
+        monkeypatch.setattr(app_module, 'finalize_pdf', fake_finalize)
+        results = {}
+        for filename in ("cgv.pdf", "illisible.pdf"):
+            upload_folder = Path(app_module.JOB_UPLOAD_DIR) / filename
+            upload_folder.mkdir(parents=True)
+            (upload_folder / filename).write_bytes(b"%PDF-1.4")
+            add_job(app_module, alice_id, upload_folder / filename)
+            job = app_module.claim_next_job("worker-1")
+            app_module.run_job(job.id)
+            app_module.db.session.refresh(job)
+            results[filename] = job
+            assert not upload_folder.exists()
+        succeeded, failed = results["cgv.pdf"], results["illisible.pdf"]
+        assert succeeded.status == 'succeeded' and Path(succeeded.result_location).read_bytes() == b"%PDF-1.4 fusion"
+        assert succeeded.pages_done == 1 and json.loads(succeeded.summary) == {"user_id": alice_id}
+        assert failed.status == 'failed' and failed.error == "Failed to read/parse PDF" and failed.result_location is None
+
+def test_recover_stale_jobs(job_db, tmp_path):
+    """Test du bail des tâches : une tâche abandonnée est remise en file, puis en échec après JOB_MAX_ATTEMPTS."""
+    app_module, (alice_id, _) = job_db
+    with app.app_context():
+        stale = app_module.datetime.now(app_module.timezone.utc) - app_module.timedelta(seconds=app_module.JOB_LEASE_SEC + 60)
+        requeued_id = add_job(app_module, alice_id, tmp_path / "a.pdf", status='running', worker="w", attempts=1, heartbeat_at=stale)
+        failed_id = add_job(app_module, alice_id, tmp_path / "b.pdf", status='running', worker="w", attempts=app_module.JOB_MAX_ATTEMPTS, heartbeat_at=stale)
+        alive_id = add_job(app_module, alice_id, tmp_path / "c.pdf", status='running', worker="w", attempts=1,
+                           heartbeat_at=app_module.datetime.now(app_module.timezone.utc))
+        assert app_module.recover_stale_jobs() == 2
+        app_module.db.session.expire_all()
+        statuses = {job_id: app_module.db.session.get(app_module.Job, job_id).status for job_id in (requeued_id, failed_id, alive_id)}
+        assert statuses == {requeued_id: 'queued', failed_id: 'failed', alive_id: 'running'}